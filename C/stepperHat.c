@@ -1,34 +1,247 @@
 /****************************
  * stepperHat.c implements code to run the Adafruit motor hat in C.
  *
- * example compilation:
- *    gcc -o stepperHat stepperHat.c -l wiringPi
+ * It drives the two steppers the same way adafruit_motor does with
+ * MICROSTEP steps, but takes a whole move in one call: the coil currents
+ * and the timing of every step are worked out here, and each step is a
+ * single I2C write of all four coils instead of four.
+ *
+ * The hat can also be opened as a mock, which keeps the registers in
+ * memory, so this can be built and tested on any Linux box.
+ *
+ * example compilation, as the shared library control.py loads:
+ *    make lib
  ************/
+#include <errno.h>
+#include <fcntl.h>
+#include <linux/i2c-dev.h>
+#include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
-#include <wiringPiI2C.h>
+#include <string.h>
+#include <sys/ioctl.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "stepperHat.h"
 
 #define HAT_ADDR 0x60
+#define HAT_BUS 1
 
 #define MODE_1_REG 0x00
 #define MODE_2_REG 0x01
 #define PRESCALE_REG 0xFE
 #define PWM_REGS_BASE 0x06 // 16 registers start from here
 
+#define MODE_1_SLEEP 0x10
+#define MODE_1_AUTO_INCREMENT 0x20
+#define MODE_1_RESTART 0x80
+
 #define PWM_FREQUENCY 1600.00
+#define OSCILLATOR_FREQUENCY 25000000.0
+
+#define FULL_ON 0xFFFF
+
+typedef struct {
+  int pwmChannels[2];   // enable channels, always fully on
+  int coilChannels[4];  // in adafruit_motor's coil order (ain2, bin1, ain1, bin2)
+  int firstCoilChannel; // coil channels are next to each other from here
+  int microsteps;
+  long currentMicrostep;
+  int curve[HAT_MAX_MICROSTEPS + 1];
+} stepperState;
+
+struct motorHat {
+  int fd;            // the I2C device, -1 for the mock
+  uint8_t regs[256]; // registers written to the mock
+  long writes;       // I2C writes made
+  stepperState steppers[2];
+};
+
+/*******************
+ * hatWrite() writes bytes to consecutive registers starting at reg, in one
+ * I2C write, which relies on the hat auto incrementing the register
+ *
+ * @param hat: motorHat*, the hat
+ * @param reg: int, the first register
+ * @param data: const uint8_t*, the bytes to write
+ * @param length: int, how many bytes to write
+ *
+ * @return: int, 0 on success, -1 on failure with errno set
+ **************/
+static int hatWrite(motorHat *hat, int reg, const uint8_t *data, int length) {
+  hat->writes++;
+
+  if (hat->fd < 0) {
+    memcpy(hat->regs + reg, data, length);
+    return 0;
+  }
+
+  uint8_t buffer[1 + 64];
+  buffer[0] = reg;
+  memcpy(buffer + 1, data, length);
+  return write(hat->fd, buffer, length + 1) == length + 1 ? 0 : -1;
+}
+
+static int hatWriteReg8(motorHat *hat, int reg, uint8_t value) {
+  return hatWrite(hat, reg, &value, 1);
+}
+
+/*******************
+ * encodeDutyCycle() turns a 16 bit duty cycle into the 4 bytes of a channel's
+ * ON and OFF registers, the same way adafruit_pca9685 does
+ **************/
+static void encodeDutyCycle(int dutyCycle, uint8_t *regs) {
+  int on = 0, off;
+  if (dutyCycle == FULL_ON) {
+    on = 0x1000;
+    off = 0;
+  } else if (dutyCycle < 0x0010) {
+    off = 0x1000;
+  } else {
+    off = dutyCycle >> 4;
+  }
+
+  regs[0] = on & 0xFF;
+  regs[1] = on >> 8;
+  regs[2] = off & 0xFF;
+  regs[3] = off >> 8;
+}
+
+// python's // and %, the microstep can go negative
+static long floorDiv(long a, long b) { return a / b - ((a % b != 0) && ((a < 0) != (b < 0))); }
+static long floorMod(long a, long b) { return a - floorDiv(a, b) * b; }
+
+/*******************
+ * updateCoils() energizes the coils of a stepper for its current microstep,
+ * like adafruit_motor's StepperMotor._update_coils() when microstepping
+ *
+ * @param hat: motorHat*, the hat
+ * @param stepper: stepperState*, the stepper
+ * @param release: int, turn every coil off instead
+ *
+ * @return: int, 0 on success, -1 on failure
+ **************/
+static int updateCoils(motorHat *hat, stepperState *stepper, int release) {
+  int dutyCycles[4] = {0, 0, 0, 0};
+
+  if (!release) {
+    int trailingCoil = floorMod(floorDiv(stepper->currentMicrostep, stepper->microsteps), 4);
+    int leadingCoil = (trailingCoil + 1) % 4;
+    int microstep = floorMod(stepper->currentMicrostep, stepper->microsteps);
+    dutyCycles[leadingCoil] = stepper->curve[microstep];
+    dutyCycles[trailingCoil] = stepper->curve[stepper->microsteps - microstep];
+  }
+
+  uint8_t regs[16];
+  for (int i = 0; i < 4; i++) {
+    int channel = stepper->coilChannels[i] - stepper->firstCoilChannel;
+    encodeDutyCycle(dutyCycles[i], regs + 4 * channel);
+  }
+
+  return hatWrite(hat, PWM_REGS_BASE + 4 * stepper->firstCoilChannel, regs, sizeof(regs));
+}
+
+static double monotonicNow(void) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return now.tv_sec + now.tv_nsec / 1e9;
+}
+
+static void sleepUntil(double deadline) {
+  struct timespec until = {
+      .tv_sec = (time_t)deadline,
+      .tv_nsec = (long)((deadline - (time_t)deadline) * 1e9),
+  };
+  while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &until, NULL) == EINTR)
+    ;
+}
+
+static motorHat *motorHatAlloc(int fd) {
+  motorHat *hat = calloc(1, sizeof(motorHat));
+  if (hat == NULL)
+    return NULL;
+  hat->fd = fd;
+
+  // channels as wired on the hat, see adafruit_motorkit
+  stepperState stepper1 = {.pwmChannels = {8, 13}, .coilChannels = {9, 11, 10, 12}, .firstCoilChannel = 9};
+  stepperState stepper2 = {.pwmChannels = {7, 2}, .coilChannels = {3, 5, 4, 6}, .firstCoilChannel = 3};
+  hat->steppers[0] = stepper1;
+  hat->steppers[1] = stepper2;
+
+  return hat;
+}
+
+/*******************
+ * motorHatOpen() opens the hat on an I2C bus and resets it
+ *
+ * @param bus: int, the I2C bus number, /dev/i2c-<bus>
+ * @param address: int, the hat's I2C address
+ *
+ * @return: motorHat*, the hat, or NULL on failure with errno set
+ **************/
+motorHat *motorHatOpen(int bus, int address) {
+  char path[32];
+  snprintf(path, sizeof(path), "/dev/i2c-%d", bus);
+
+  int fd = open(path, O_RDWR);
+  if (fd < 0)
+    return NULL;
+
+  motorHat *hat;
+  if (ioctl(fd, I2C_SLAVE, address) < 0 || (hat = motorHatAlloc(fd)) == NULL) {
+    close(fd);
+    return NULL;
+  }
+
+  if (motorHatReset(hat) < 0) {
+    motorHatClose(hat);
+    return NULL;
+  }
+  return hat;
+}
+
+/*******************
+ * motorHatOpenMock() opens a hat that only exists in memory
+ *
+ * @return: motorHat*, the hat, or NULL if out of memory
+ **************/
+motorHat *motorHatOpenMock(void) {
+  motorHat *hat = motorHatAlloc(-1);
+  if (hat != NULL)
+    motorHatReset(hat);
+  return hat;
+}
+
+void motorHatClose(motorHat *hat) {
+  if (hat->fd >= 0)
+    close(hat->fd);
+  free(hat);
+}
 
 /*******************
- * motorHatReset() resets the control register of the hat
+ * motorHatReset() resets the control register of the hat and sets its PWM
+ * frequency, with register auto increment on
  *
- * @param fd: int, the file descriptor representing the hat I2C device
+ * @param hat: motorHat*, the hat
  *
- * @return: nothing
+ * @return: int, 0 on success, -1 on failure
  **************/
-void motorHatReset(int fd) {
-  if (wiringPiI2CWriteReg8(fd, MODE_1_REG, 0x00) < 0) {
+int motorHatReset(motorHat *hat) {
+  int prescale = (int)(OSCILLATOR_FREQUENCY / 4096.0 / PWM_FREQUENCY + 0.5) - 1;
+
+  if (hatWriteReg8(hat, MODE_1_REG, 0x00) < 0 ||
+      hatWriteReg8(hat, MODE_1_REG, MODE_1_SLEEP) < 0 ||
+      hatWriteReg8(hat, PRESCALE_REG, prescale) < 0 ||
+      hatWriteReg8(hat, MODE_1_REG, 0x00) < 0) {
     fprintf(stderr, "Unable to write to register %d\n", MODE_1_REG);
-    exit(-1);
+    return -1;
   }
+
+  if (hat->fd >= 0)
+    usleep(5000); // oscillator start up
+
+  return hatWriteReg8(hat, MODE_1_REG, MODE_1_RESTART | MODE_1_AUTO_INCREMENT);
 }
 
 /*******************
@@ -37,14 +250,109 @@ void motorHatReset(int fd) {
  * @return: int, the file descriptor of the hat I2C device
  **************/
 int motorHatSetup() {
-  int fd = wiringPiI2CSetup(HAT_ADDR);
-  if (fd < 0) {
+  motorHat *hat = motorHatOpen(HAT_BUS, HAT_ADDR);
+  if (hat == NULL) {
     fprintf(stderr, "Unable to register at at %d\n", HAT_ADDR);
     exit(-1);
   }
   puts("Registered hat!");
 
-  motorHatReset(fd);
+  return hat->fd;
+}
+
+/*******************
+ * motorHatStepperInit() sets up a stepper for microstepping and energizes it
+ * at microstep 0, like adafruit_motor's StepperMotor
+ *
+ * @param hat: motorHat*, the hat
+ * @param stepper: int, 1 or 2, like MotorKit's stepper1 and stepper2
+ * @param microsteps: int, microsteps per step, even and at least 2
+ *
+ * @return: int, 0 on success, -1 on failure
+ **************/
+int motorHatStepperInit(motorHat *hat, int stepper, int microsteps) {
+  if (stepper < 1 || stepper > 2 || microsteps < 2 || microsteps % 2 || microsteps > HAT_MAX_MICROSTEPS) {
+    errno = EINVAL;
+    return -1;
+  }
+
+  stepperState *state = &hat->steppers[stepper - 1];
+  state->microsteps = microsteps;
+  state->currentMicrostep = 0;
+  for (int i = 0; i <= microsteps; i++)
+    state->curve[i] = (int)round(FULL_ON * sin(M_PI / (2 * microsteps) * i));
+
+  uint8_t fullOn[4];
+  encodeDutyCycle(FULL_ON, fullOn);
+  for (int i = 0; i < 2; i++)
+    if (hatWrite(hat, PWM_REGS_BASE + 4 * state->pwmChannels[i], fullOn, 4) < 0)
+      return -1;
+
+  return updateCoils(hat, state, 0);
+}
+
+/*******************
+ * motorHatMove() moves a stepper by a number of microsteps, each at a
+ * deadline set by the intervals between steps. Deadlines are kept from the
+ * start of the move; if stepping falls behind by more than an interval the
+ * schedule starts again from the current time instead of rushing.
+ *
+ * @param hat: motorHat*, the hat
+ * @param stepper: int, 1 or 2
+ * @param direction: int, HAT_FORWARD or HAT_BACKWARD
+ * @param steps: long, how many microsteps to take
+ * @param intervals: const double*, seconds from each step to the next, or NULL to step as fast as possible
+ * @param release: int, turn the coils off afterwards
+ *
+ * @return: long, how many steps were taken, or -1 on failure
+ **************/
+long motorHatMove(motorHat *hat, int stepper, int direction, long steps,
+                  const double *intervals, int release) {
+  if (stepper < 1 || stepper > 2 || hat->steppers[stepper - 1].microsteps == 0) {
+    errno = EINVAL;
+    return -1;
+  }
+
+  stepperState *state = &hat->steppers[stepper - 1];
+  int delta = direction == HAT_FORWARD ? 1 : -1;
+  double deadline = monotonicNow();
+
+  long taken;
+  for (taken = 0; taken < steps; taken++) {
+    if (intervals != NULL)
+      sleepUntil(deadline);
+
+    state->currentMicrostep += delta;
+    if (updateCoils(hat, state, 0) < 0)
+      return -1;
+
+    if (intervals != NULL) {
+      deadline += intervals[taken];
+      double now = monotonicNow();
+      if (now > deadline + intervals[taken])
+        deadline = now;
+    }
+  }
+
+  if (release && motorHatRelease(hat, stepper) < 0)
+    return -1;
+  return taken;
+}
+
+int motorHatRelease(motorHat *hat, int stepper) {
+  return updateCoils(hat, &hat->steppers[stepper - 1], 1);
+}
+
+long motorHatCurrentMicrostep(const motorHat *hat, int stepper) {
+  return hat->steppers[stepper - 1].currentMicrostep;
+}
+
+// what has been written to a register of a mock hat
+int motorHatMockRegister(const motorHat *hat, int reg) {
+  return hat->regs[reg];
+}
 
-  return fd;
+// how many I2C writes have been made
+long motorHatWrites(const motorHat *hat) {
+  return hat->writes;
 }
@@ -1 +1,29 @@
+#ifndef STEPPER_HAT_H
+#define STEPPER_HAT_H
+
+#include <stdint.h>
+
+// directions, the same values as adafruit_motor.stepper
+#define HAT_FORWARD 1
+#define HAT_BACKWARD 2
+
+#define HAT_MAX_MICROSTEPS 256
+
+typedef struct motorHat motorHat;
+
+motorHat *motorHatOpen(int bus, int address);
+motorHat *motorHatOpenMock(void);
+void motorHatClose(motorHat *hat);
+int motorHatReset(motorHat *hat);
 int motorHatSetup();
+
+int motorHatStepperInit(motorHat *hat, int stepper, int microsteps);
+long motorHatMove(motorHat *hat, int stepper, int direction, long steps,
+                  const double *intervals, int release);
+int motorHatRelease(motorHat *hat, int stepper);
+long motorHatCurrentMicrostep(const motorHat *hat, int stepper);
+
+int motorHatMockRegister(const motorHat *hat, int reg);
+long motorHatWrites(const motorHat *hat);
+
+#endif
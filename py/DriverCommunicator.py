@@ -7,10 +7,14 @@
 import posix_ipc
 from typing import Callable
 import threading
+import asyncio
+import json
+import socket
 
 class BrailleDriverCommunicator:
     STATUS_QUEUE = "/text2touch_status_pipe"
     COMMAND_QUEUE = "/text2touch_command_pipe"
+    JOB_SOCKET = "/var/run/user/1000/text2touch_socket"
 
     def __init__(self):
         if not posix_ipc.MESSAGE_QUEUES_SUPPORTED:
@@ -19,6 +23,7 @@ class BrailleDriverCommunicator:
         # create message queue if need be
         self.status_mq = posix_ipc.MessageQueue(self.STATUS_QUEUE, posix_ipc.O_CREAT)
         self.command_mq = posix_ipc.MessageQueue(self.COMMAND_QUEUE, posix_ipc.O_CREAT)
+        self.__estimator = None
     
     def stop(self) -> None:
         print("\nExiting...")
@@ -29,12 +34,21 @@ class BrailleDriverCommunicator:
         except posix_ipc.ExistentialError:
             pass
     
-    def write_status(self, message: str, priority: int = 0) -> None:
-        self.status_mq.send(message, None, priority)
+    def write_status(self, message: str, priority: int = 0) -> bool:
+        '''Send a status without waiting for room in the queue. Returns whether it was sent.'''
+        try:
+            self.status_mq.send(message, 0, priority)
+        except posix_ipc.BusyError:
+            return False
+        return True
 
     def read_status(self) -> str:
         message, priority = self.status_mq.receive()
         return message.decode()
+
+    def read_event(self) -> dict:
+        '''Read a status sent by the daemon, which is a JSON event, see status.py'''
+        return json.loads(self.read_status())
         
     def write_cmd(self, message: str, priority: int = 0) -> None:
         self.command_mq.send(message, None, priority)
@@ -43,6 +57,90 @@ class BrailleDriverCommunicator:
         message, priority = self.command_mq.receive()
         return message.decode()
     
+    def submit_job(self, text: str, priority: int = 0) -> dict:
+        '''
+        Send a job to the daemon's job socket, and wait for it to be spooled.
+
+        Args:
+            text (string): the entire text to be printed
+            priority (int): jobs with a higher priority print sooner, when the daemon schedules by priority
+        Returns:
+            dict: the daemon's answer, {"job": its ID, "position": its place in the queue},
+                or {"error": why it wasn't spooled}
+        '''
+        # imported here so clients that don't submit jobs don't need it
+        from protocol import encode_document
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.JOB_SOCKET)
+            connection.sendall(encode_document(text, length_prefixed=True, priority=priority))
+            connection.shutdown(socket.SHUT_WR)
+            answer = connection.makefile("r").readline()
+        return json.loads(answer) if answer else {"error": "no answer from the daemon"}
+
+    def estimate(self, text: str):
+        '''
+        Estimate how long a job will take to print, without any hardware. The
+        estimates are calibrated by the daemon's measurements of the jobs it prints.
+
+        Args:
+            text (string): the entire text to be printed
+        Returns:
+            PrintEstimate: the estimate, see estimator.py
+        '''
+        # imported here so only clients that estimate need the driver's modules
+        if self.__estimator is None:
+            from estimator import PrintEstimator
+            self.__estimator = PrintEstimator()
+        self.__estimator.load_calibration()
+        return self.__estimator.estimate(text.split('\n'))
+
+    def cancel_job(self, job_id: int | None = None) -> None:
+        '''Ask the daemon to cancel a job, by default the one printing, which stops at the end of its line'''
+        self.write_cmd(f"cancel {job_id}" if job_id is not None else "cancel")
+
+    def pause_printing(self) -> None:
+        '''Ask the daemon to pause printing at the end of the line'''
+        self.write_cmd("pause")
+
+    def resume_printing(self) -> None:
+        self.write_cmd("resume")
+
+    def skip_page(self) -> None:
+        '''Ask the daemon to eject the sheet printing, and carry on with the job on the next one'''
+        self.write_cmd("page")
+
+    def next_job(self) -> None:
+        '''Tell the daemon to start the next job, see set_auto_advance()'''
+        self.write_cmd("next")
+
+    def set_auto_advance(self, auto_advance: bool) -> None:
+        '''Have the daemon start each job as soon as the last is done, or wait for next_job()'''
+        self.write_cmd("auto on" if auto_advance else "auto off")
+
+    def set_metrics(self, enabled: bool) -> None:
+        '''Have the daemon start or stop counting and timing the phases of printing, see metrics.py'''
+        self.write_cmd("metrics on" if enabled else "metrics off")
+
+    def profile_job(self, job_id: int | None = None) -> None:
+        '''Have the daemon print a job, the next one by default, under cProfile'''
+        self.write_cmd("profile" if job_id is None else f"profile {job_id}")
+
+    def prioritize_job(self, job_id: int, priority: int) -> None:
+        '''Ask the daemon to change the priority of a job that is waiting to print'''
+        self.write_cmd(f"priority {job_id} {priority}")
+
+    def move_job(self, job_id: int, position: int) -> None:
+        '''Ask the daemon to move a job that is waiting to print to a place in the queue, 1 being next'''
+        self.write_cmd(f"move {job_id} {position}")
+
+    def query_jobs(self) -> None:
+        '''
+        Ask the daemon which jobs are waiting to print. It answers, like it does
+        every change to the queue, with a "jobs" event, see status.py.
+        '''
+        self.write_cmd("jobs")
+
     def listen_status(self, listen_cb: Callable[[str], None]) -> None:
         def thread():
             while True:
@@ -57,6 +155,31 @@ class BrailleDriverCommunicator:
 
         threading.Thread(target=thread,daemon=True).start()
 
+    def watch_status(self, loop: asyncio.AbstractEventLoop, listen_cb: Callable[[str], None]) -> None:
+        '''Like listen_status(), but calls listen_cb on an event loop instead of a thread of its own'''
+        self.__watch(loop, self.status_mq, listen_cb)
+
+    def watch_cmd(self, loop: asyncio.AbstractEventLoop, listen_cb: Callable[[str], None]) -> None:
+        '''Like listen_cmd(), but calls listen_cb on an event loop instead of a thread of its own'''
+        self.__watch(loop, self.command_mq, listen_cb)
+
+    def unwatch(self, loop: asyncio.AbstractEventLoop) -> None:
+        '''Stop watching both queues on an event loop'''
+        loop.remove_reader(self.status_mq.mqd)
+        loop.remove_reader(self.command_mq.mqd)
+
+    def __watch(self, loop: asyncio.AbstractEventLoop, mq: posix_ipc.MessageQueue, listen_cb: Callable[[str], None]) -> None:
+        # on Linux a message queue is a file descriptor, so the loop can wait on it with everything else
+        def receive_all() -> None:
+            while True:
+                try:
+                    message, priority = mq.receive(0)
+                except posix_ipc.BusyError:
+                    return
+                listen_cb(message.decode())
+
+        loop.add_reader(mq.mqd, receive_all)
+
 
 if __name__ == "__main__":
     from time import sleep
@@ -69,6 +192,20 @@ if __name__ == "__main__":
     sleep(1)
     assert(driver_comm.read_cmd() == "commanding!")
 
+    # watching on an event loop gets every message without a thread
+    async def watch() -> list[str]:
+        loop = asyncio.get_running_loop()
+        received: list[str] = []
+        watcher = BrailleDriverCommunicator()
+        watcher.watch_cmd(loop, received.append)
+        for command in ("one", "two"):
+            driver_comm.write_cmd(command)
+        await asyncio.sleep(0.1)
+        watcher.unwatch(loop)
+        return received
+
+    assert(asyncio.run(watch()) == ["one", "two"])
+
     # setup dummy listeners
     driver_comm.listen_status(print)
     driver_comm.listen_cmd(print)
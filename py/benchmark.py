@@ -0,0 +1,275 @@
+############################
+## Benchmarks transcription, job ingestion, and printing on the simulated
+## printer, and writes the results to a JSON file so runs of different
+## versions can be compared.
+##
+## Usage:
+##     python3 benchmark.py [--quick] [--output results.json] [--compare old.json]
+##
+## Metrics ending in _per_second or _per_minute are better higher, and
+## metrics ending in _seconds are better lower.
+############################
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable
+
+import control
+import prerender
+from control import BraillePrinterDriver
+from simulator import SimulatedHardware
+from transcriber import BrailleTranscriber
+
+HERE = Path(__file__).resolve().parent
+DEFAULT_OUTPUT = HERE / "benchmark-results.json"
+
+# how much worse a metric has to be than before to count as a regression
+REGRESSION_THRESHOLD = 0.10
+
+def synthetic_corpus(words: int, seed: int = 0) -> list[str]:
+    '''
+    Make a document of about so many words, drawn from endpoem.txt and mixed
+    with numbers, capitals, and punctuation so every path of the transcriber
+    is exercised. The same seed always makes the same document.
+
+    Args:
+        words (int): how many words
+        seed (int): seed for the random choices
+    Returns:
+        list[string]: the lines of the document
+    '''
+    rng = random.Random(seed)
+    vocabulary = (HERE / "endpoem.txt").read_text().split()
+
+    lines, line = [], []
+    for _ in range(words):
+        word = rng.choice(vocabulary)
+        roll = rng.random()
+        if roll < 0.05:
+            word = str(rng.randrange(10_000))
+        elif roll < 0.15:
+            word = word.capitalize()
+        elif roll < 0.20:
+            word += rng.choice(",.;:!?")
+        line.append(word)
+
+        if len(line) >= rng.randrange(6, 14):
+            lines.append(" ".join(line))
+            line = []
+            if rng.random() < 0.1:
+                lines.append("")
+    if line:
+        lines.append(" ".join(line))
+    return lines
+
+def corpora(quick: bool) -> dict[str, list[str]]:
+    '''Every corpus benchmarked, by name'''
+    sizes = (1_000, 10_000) if quick else (1_000, 10_000, 100_000)
+    documents = {"endpoem": (HERE / "endpoem.txt").read_text().split("\n")}
+    documents.update({f"synthetic_{size}": synthetic_corpus(size) for size in sizes})
+    return documents
+
+def best_of(run: Callable[[], Any], repeat: int) -> float:
+    '''Seconds the fastest of repeat runs took'''
+    return min(timeit.Timer(run).repeat(repeat=repeat, number=1))
+
+def benchmark_transcription(documents: dict[str, list[str]], repeat: int) -> dict[str, float]:
+    '''Microbenchmarks of the transcriber over each corpus, in characters per second'''
+    transcriber = BrailleTranscriber()
+    results: dict[str, float] = {}
+
+    for name, lines in documents.items():
+        text = "\n".join(lines)
+        ascii_braille = "".join(transcriber.transliterate_string(line) for line in lines)
+        supported = [c for c in ascii_braille if 0x20 <= ord(c.upper()) <= 0x5F]
+        unicode_braille = [transcriber.ascii2braille(c) for c in supported]
+
+        seconds = best_of(lambda: [transcriber.transliterate_string(line) for line in lines], repeat)
+        results[f"transcription.transliterate_string.{name}.chars_per_second"] = len(text) / seconds
+
+        seconds = best_of(lambda: [transcriber.ascii2braille(c) for c in supported], repeat)
+        results[f"transcription.ascii2braille.{name}.chars_per_second"] = len(supported) / seconds
+
+        seconds = best_of(lambda: [transcriber.braille2array(b) for b in unicode_braille], repeat)
+        results[f"transcription.braille2array.{name}.chars_per_second"] = len(unicode_braille) / seconds
+
+        seconds = best_of(lambda: transcriber.encode_cells(ascii_braille), repeat)
+        results[f"transcription.encode_cells.{name}.chars_per_second"] = len(ascii_braille) / seconds
+
+        seconds = best_of(lambda: [prerender.render_string(line, control.BraillePrinterDriver.CHARS_PER_LINE) for line in lines], repeat)
+        results[f"transcription.render_string.{name}.chars_per_second"] = len(text) / seconds
+
+    return results
+
+def benchmark_ingestion(documents: dict[str, list[str]], repeat: int) -> dict[str, float]:
+    '''
+    Time a job from being written to a FIFO to being spooled, to its first line
+    being ready to print, and to its last, through the daemon's own code.
+
+    Importing the daemon opens its message queues but not the printer, which
+    it only opens in main(), so this runs off the Pi whatever HARDWARE is.
+    '''
+    import daemon
+
+    async def ingest(path: str, data: bytes) -> tuple[float, float, float]:
+        def write() -> None:
+            with open(path, "wb") as pipe:
+                pipe.write(data)
+
+        reader, transport = await daemon.open_pipe(path)
+        start = perf_counter()
+        writer = asyncio.create_task(asyncio.to_thread(write))
+        spooling = asyncio.create_task(daemon.spool_stream(reader))
+
+        job = await daemon.SCHEDULER.get()
+        spooled = perf_counter() - start
+
+        # the job is printed from another thread, like the hardware thread would
+        def drain() -> tuple[float, float]:
+            job_lines = daemon.SPOOL.lines(job)
+            next(job_lines)
+            first_line = perf_counter() - start
+            for _ in job_lines:
+                pass
+            return first_line, perf_counter() - start
+        first_line, last_line = await asyncio.to_thread(drain)
+
+        await asyncio.gather(writer, spooling)
+        transport.close()
+        daemon.SPOOL.finish(job)
+        return spooled, first_line, last_line
+
+    # the daemon's queues belong to one event loop, so every run shares it
+    async def ingest_all() -> dict[str, float]:
+        results: dict[str, float] = {}
+
+        # jobs go to a spool of their own rather than the printer's
+        spool_dir = tempfile.TemporaryDirectory()
+        daemon.SPOOL = daemon.Spool(Path(spool_dir.name))
+        daemon.SPOOL.recover()
+        for name, lines in documents.items():
+            data = "\n".join(lines).encode()
+            spooled, first_line, last_line = [], [], []
+
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as tmp:
+                    path = os.path.join(tmp, "pipe")
+                    os.mkfifo(path)
+                    times = await ingest(path, data)
+                for measurements, seconds in zip((spooled, first_line, last_line), times):
+                    measurements.append(seconds)
+
+            results[f"ingestion.{name}.spooled_seconds"] = statistics.median(spooled)
+            results[f"ingestion.{name}.first_line_seconds"] = statistics.median(first_line)
+            results[f"ingestion.{name}.all_lines_seconds"] = statistics.median(last_line)
+            results[f"ingestion.{name}.bytes_per_second"] = len(data) / statistics.median(last_line)
+
+        daemon.SPOOL.close_journal()
+        spool_dir.cleanup()
+        return results
+
+    return asyncio.run(ingest_all())
+
+def benchmark_printing(documents: dict[str, list[str]], max_lines: int) -> dict[str, float]:
+    '''
+    Print the start of each corpus on the simulated printer and report its
+    throughput and where the time went, in virtual seconds.
+    '''
+    control.DEBUG = False
+    results: dict[str, float] = {}
+
+    for name, lines in documents.items():
+        hardware = SimulatedHardware.from_config(BraillePrinterDriver.config)
+        driver = BraillePrinterDriver(hardware)
+
+        rendered = [cells for line in lines for cells in driver.render_string(line)][:max_lines]
+        start = perf_counter()
+        driver.print_rendered_lines(iter(rendered))
+        real_seconds = perf_counter() - start
+
+        stats = hardware.stats()
+        minutes = stats["seconds"] / 60
+        results[f"printing.{name}.cells_per_minute"] = sum(map(len, rendered)) / minutes
+        results[f"printing.{name}.lines_per_minute"] = len(rendered) / minutes
+        results[f"printing.{name}.simulated_seconds"] = stats["seconds"]
+        results[f"printing.{name}.real_seconds"] = real_seconds
+        for phase, seconds in sorted(driver.phase_totals().items()):
+            results[f"printing.{name}.phase.{phase.replace(' ', '_')}_seconds"] = seconds
+
+    return results
+
+def environment() -> dict[str, str]:
+    '''What the benchmarks ran on and against, for telling results apart'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+def compare(old: dict[str, float], new: dict[str, float], threshold: float) -> list[str]:
+    '''
+    Compare the metrics of two runs.
+
+    Args:
+        old (dict[str, float]): metrics of the earlier run
+        new (dict[str, float]): metrics of this run
+        threshold (float): fraction a metric may get worse by before it is a regression
+    Returns:
+        list[string]: the regressions, empty if there are none
+    '''
+    regressions = []
+    for metric, value in new.items():
+        if (before := old.get(metric)) is None or before == 0:
+            continue
+        change = (value - before) / before
+        worse = -change if metric.endswith(("_per_second", "_per_minute")) else change
+        print(f"{metric}: {before:.6g} -> {value:.6g} ({change:+.1%})")
+        if worse > threshold:
+            regressions.append(metric)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transcription, ingestion, and simulated printing")
+    parser.add_argument("--quick", action="store_true", help="smaller corpora and fewer repeats")
+    parser.add_argument("--output", type=Path, default=DEFAULT_OUTPUT, help="where to write the results")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run to check for regressions")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["transcription", "ingestion", "printing"])
+    args = parser.parse_args()
+
+    repeat = 3 if args.quick else 7
+    documents = corpora(args.quick)
+    metrics: dict[str, float] = {}
+
+    if "transcription" not in args.skip:
+        metrics.update(benchmark_transcription(documents, repeat))
+    if "ingestion" not in args.skip:
+        metrics.update(benchmark_ingestion(documents, repeat))
+    if "printing" not in args.skip:
+        metrics.update(benchmark_printing(documents, 10 if args.quick else 60))
+
+    args.output.write_text(json.dumps({"environment": environment(), "metrics": metrics}, indent=2) + "\n")
+    print(f"Wrote {len(metrics)} metrics to {args.output}")
+
+    if args.compare is not None:
+        old = json.loads(args.compare.read_text())["metrics"]
+        if regressions := compare(old, metrics, REGRESSION_THRESHOLD):
+            print(f"{len(regressions)} regression(s) over {REGRESSION_THRESHOLD:.0%}:", *regressions, sep="\n  ")
+            sys.exit(1)
@@ -0,0 +1,168 @@
+############################
+## What the operator has asked of the job printing: pause, resume,
+## cancel, or skip to the next page. Commands are given on the event loop
+## and taken up by the hardware thread between lines, where checking for
+## them costs one attribute read when there are none.
+##
+## Nothing in here runs hardware.
+############################
+import threading
+
+# what the printing thread should do before its next line
+CONTINUE  = "continue"
+STOP      = "stop"       # the job was cancelled, or the daemon is shutting down
+NEXT_PAGE = "next page"  # eject the sheet, and carry on with the job on the next one
+
+class PrintCommands:
+    '''Commands for the job printing, shared between the event loop and the hardware thread'''
+
+    def __init__(self, auto_advance: bool = False) -> None:
+        '''
+        Args:
+            auto_advance (bool): start each job as soon as the last is done, instead of waiting to be told to
+        '''
+        self.auto_advance = auto_advance
+
+        self.__changed = threading.Condition()
+        self.__job_id: int | None = None
+        self.__paused = False
+        self.__cancelled = False
+        self.__next_page = False
+        self.__stopping = False
+
+        # whether there is anything for the printing thread to do, read without the lock
+        self.__pending = False
+
+    @property
+    def job_id(self) -> int | None:
+        '''The job printing, None between jobs'''
+        return self.__job_id
+
+    @property
+    def paused(self) -> bool:
+        return self.__paused
+
+    @property
+    def cancelled(self) -> bool:
+        '''Whether the job printing was cancelled'''
+        return self.__cancelled
+
+    @property
+    def stopping(self) -> bool:
+        '''Whether the daemon is shutting down'''
+        return self.__stopping
+
+    def start_job(self, job_id: int) -> None:
+        '''Called by the printing thread as it starts a job. A pause carries over from the last job.'''
+        with self.__changed:
+            self.__job_id = job_id
+            self.__cancelled = self.__next_page = False
+            self.__update()
+
+    def end_job(self) -> None:
+        '''Called by the printing thread once a job is done'''
+        with self.__changed:
+            self.__job_id = None
+
+    def pause(self) -> None:
+        '''Pause printing before the next line'''
+        with self.__changed:
+            self.__paused = True
+            self.__update()
+
+    def resume(self) -> None:
+        with self.__changed:
+            self.__paused = False
+            self.__update()
+
+    def cancel(self, job_id: int | None = None) -> bool:
+        '''
+        Cancel the job printing before its next line, even if it is paused.
+
+        Args:
+            job_id (int | None): only cancel it if it is this job
+        Returns:
+            bool: whether a job was cancelled
+        '''
+        with self.__changed:
+            if self.__job_id is None or job_id not in (None, self.__job_id):
+                return False
+            self.__cancelled = True
+            self.__update()
+            return True
+
+    def next_page(self) -> bool:
+        '''Eject the sheet before the next line of the job printing. Returns whether a job is printing.'''
+        with self.__changed:
+            if self.__job_id is None:
+                return False
+            self.__next_page = True
+            self.__update()
+            return True
+
+    def stop(self) -> None:
+        '''Stop printing before the next line for good, for when the daemon shuts down'''
+        with self.__changed:
+            self.__stopping = True
+            self.__update()
+
+    def between_lines(self) -> str:
+        '''
+        Called by the printing thread before every line. Waits for as long as
+        printing is paused.
+
+        Returns:
+            string: CONTINUE, STOP, or NEXT_PAGE
+        '''
+        if not self.__pending:
+            return CONTINUE
+
+        with self.__changed:
+            self.__changed.wait_for(lambda: not self.__paused or self.__cancelled or self.__stopping)
+            if self.__cancelled or self.__stopping:
+                return STOP
+            if self.__next_page:
+                self.__next_page = False
+                self.__update()
+                return NEXT_PAGE
+            return CONTINUE
+
+    def __update(self) -> None:
+        '''Called with the lock held whenever a command changes'''
+        self.__pending = self.__paused or self.__cancelled or self.__next_page or self.__stopping
+        self.__changed.notify_all()
+
+
+if __name__ == "__main__":
+    import time
+
+    commands = PrintCommands()
+    assert(commands.between_lines() == CONTINUE)
+    assert(not commands.cancel() and not commands.next_page()) # nothing printing
+
+    commands.start_job(1)
+    assert(commands.next_page() and commands.between_lines() == NEXT_PAGE and commands.between_lines() == CONTINUE)
+
+    # a paused job waits until it is resumed
+    commands.pause()
+    started = time.monotonic()
+    threading.Timer(0.1, commands.resume).start()
+    assert(commands.between_lines() == CONTINUE and time.monotonic() - started >= 0.1)
+
+    # or cancelled, but only by its own ID
+    commands.pause()
+    assert(not commands.cancel(2))
+    threading.Timer(0.1, commands.cancel, (1,)).start()
+    assert(commands.between_lines() == STOP and commands.cancelled)
+
+    # the next job starts afresh, but still paused
+    commands.end_job()
+    commands.start_job(2)
+    assert(not commands.cancelled and commands.paused)
+    commands.resume()
+    assert(commands.between_lines() == CONTINUE)
+
+    commands.stop()
+    assert(commands.between_lines() == STOP and commands.stopping)
+
+    print("All tests passed!")
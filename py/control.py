@@ -1,23 +1,38 @@
-from typing import Any, TextIO
-# gives access to SINGLE, DOUBLE, FORWARD, BACKWARD, INTERLEAVE, MICROSTEP
-from adafruit_motor import stepper
-from adafruit_motorkit import MotorKit
-import RPi.GPIO as GPIO
-from time import sleep
+from typing import Any, Callable, Iterable, TextIO
+from pathlib import Path
 import math
 from transcriber import BrailleTranscriber
+import prerender
+import metrics
+from planner import LinePlanner, LinePlan, LineLayout, MOVE, FIRE, DWELL
+from stepping import StepperAxis, VelocityProfile, FORWARD, BACKWARD, MICROSTEP
+from hardware import PrinterHardware, open_hardware
+from firing import FiringScheduler, FiringEvent
 import tomllib
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from queue import Empty, Full, Queue
 
 DEBUG = True
 
 class BraillePrinterDriver:
-    with open("config.toml", "rb") as f:
+    with open(Path(__file__).resolve().parent / "config.toml", "rb") as f:
         config = tomllib.load(f)
-    motor_kit = MotorKit()
 
     CHARS_PER_LINE = config["SIZES"]["CHARS_PER_LINE"]
+    RENDER_AHEAD_LINES = config["DRIVER"]["RENDER_AHEAD_LINES"]
+    BIDIRECTIONAL = config["DRIVER"]["BIDIRECTIONAL"]
+    HOME_EVERY_LINES = config["DRIVER"]["HOME_EVERY_LINES"]
+    DRIFT_PER_REVERSAL = config["DRIVER"]["DRIFT_PER_REVERSAL"]
+    MAX_DRIFT_STEPS = config["DRIVER"]["MAX_DRIFT_STEPS"]
     SERIAL_SOLENOIDS = config["SOLENOIDS"]["SERIAL_SOLENOIDS"]
     SOL_PAUSE = config["SOLENOIDS"]["SOL_PAUSE"]
+    SOL_ON_TIMES = config["SOLENOIDS"]["SOL_ON_TIMES"]
+    SOL_SETTLE_TIMES = config["SOLENOIDS"]["SOL_SETTLE_TIMES"]
+    SOL_CURRENTS = config["SOLENOIDS"]["SOL_CURRENTS"]
+    MAX_SIMULTANEOUS_SOLENOIDS = config["SOLENOIDS"]["MAX_SIMULTANEOUS_SOLENOIDS"]
+    MAX_SOLENOID_CURRENT = config["SOLENOIDS"]["MAX_SOLENOID_CURRENT"]
     SOL_DUTY_CYCLE = config["SOLENOIDS"]["SOL_DUTY_CYCLE"]
     SOL_PWM_FREQ = config["SOLENOIDS"]["SOL_PWM_FREQ"]
     MICROSTEPS = config["STEPPERS"]["MICROSTEPS"]
@@ -31,56 +46,87 @@ class BraillePrinterDriver:
 
     SOL_CHANNELS      = (SOL_0_PIN, SOL_1_PIN, SOL_2_PIN)
     STEPS_PER_ROTATION = int(360 / STEPPER_DEGREES) * MICROSTEPS
-    HALF_CHAR_STEPS   = int(config["SIZES"]["HALF_CHAR_STEPS"]  / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION))
-    SPACE_STEPS       = int(config["SIZES"]["SPACE_STEPS"]      / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION))
-    RESET_STEPS       = int(config["SIZES"]["RESET_STEPS"]      / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION))
-    NEW_LINE_STEPS    = int(config["SIZES"]["NEW_LINE_STEPS"]   / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION))
-    EJECT_STEPS       = int(config["SIZES"]["EJECT_STEPS"]      / ((math.pi * PAPER_STEPPER_DIAMETER) / STEPS_PER_ROTATION))
-
-    def __init__(self) -> None:
+    # sizes in steps are exact, fractions of a step are carried over from move to move instead of dropped
+    HALF_CHAR_STEPS   = config["SIZES"]["HALF_CHAR_STEPS"]  / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION)
+    SPACE_STEPS       = config["SIZES"]["SPACE_STEPS"]      / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION)
+    RESET_STEPS       = config["SIZES"]["RESET_STEPS"]      / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION)
+    NEW_LINE_STEPS    = config["SIZES"]["NEW_LINE_STEPS"]   / ((math.pi * HEAD_STEPPER_DIAMETER)  / STEPS_PER_ROTATION)
+    EJECT_STEPS       = config["SIZES"]["EJECT_STEPS"]      / ((math.pi * PAPER_STEPPER_DIAMETER) / STEPS_PER_ROTATION)
+
+    def __init__(self, hardware: PrinterHardware | None = None) -> None:
+        '''
+        Args:
+            hardware (PrinterHardware | None): the printer to drive, by default the one named by HARDWARE in config.toml
+        '''
         assert(self.SPACE_STEPS >= 2 * self.HALF_CHAR_STEPS)
 
-        self.head_stepper = self.motor_kit.stepper2
-        self.paper_stepper = self.motor_kit.stepper1
-
-        # solenoid GPIO setup
-        GPIO.setmode(GPIO.BCM) # use broadcom (GPIO) pin numbers
-        GPIO.setup(self.SOL_CHANNELS, GPIO.OUT) # setup solenoid pins
-
-        self.pwm_solenoids: list[GPIO.PWM] = [GPIO.PWM(channel, self.SOL_PWM_FREQ) for channel in self.SOL_CHANNELS]
+        self.hardware = hardware if hardware is not None else open_hardware(self.config)
+        self.clock = self.hardware.clock
+        self.head_stepper = self.hardware.head_stepper
+        self.paper_stepper = self.hardware.paper_stepper
+        self.pwm_solenoids = self.hardware.solenoids
 
-        # set pull up resistor on button
-        GPIO.setup(self.BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-        # stepper motor setup
-        for stepper in [self.head_stepper, self.paper_stepper]:
-            self.set_microsteps(stepper, self.MICROSTEPS)
-
-        # ensure steppers are released
-        self.head_stepper.release()
-        self.paper_stepper.release()
+        # each stepper is stepped on its own thread, ramping up and down as set in [STEPPERS]
+        self.head_axis = StepperAxis(self.head_stepper, VelocityProfile.from_config(self.config["STEPPERS"], "HEAD"), MICROSTEP, name="head stepper", clock=self.clock)
+        self.paper_axis = StepperAxis(self.paper_stepper, VelocityProfile.from_config(self.config["STEPPERS"], "PAPER"), MICROSTEP, name="paper stepper", clock=self.clock)
 
         self.transcriber = BrailleTranscriber()
+        self.planner = LinePlanner(self.HALF_CHAR_STEPS, self.SPACE_STEPS, self.SOL_PAUSE)
+        self.firing = FiringScheduler.from_config(self.config["SOLENOIDS"])
+
+        # print head position in (micro)steps from the home button. Until the head is
+        # homed it is assumed to be at the start of the line, and the next new line homes it
+        self.head_position: int = round(self.RESET_STEPS)
+        self.__head_target: float = self.RESET_STEPS # exact position the head was last sent to
+        self.__homed = False
+        self.__home_requested = False
+        self.__lines_since_home = 0
+
+        # how far the head may have slipped since it was homed, in steps
+        self.drift_estimate = 0.0
+        self.__head_direction = 0
+
+        # paper position in steps since the sheet was loaded
+        self.__paper_position = 0
+        self.__paper_target = 0.0
         
+        # seconds spent in each phase of printing by the driver's clock. Phases don't overlap,
+        # time outside any of them (like waiting on rendering) is "other"
+        self.phase_seconds: defaultdict[str, float] = defaultdict(float)
+        self.__phase = "other"
+        self.__phase_started = self.clock.now()
+
         self.__diagnostic_message = "0: Machine up and running\n"
 
     def __del__(self):
         '''Clean up resources used and stop hold current on steppers'''
-        GPIO.cleanup()
-        self.head_stepper.release()
-        self.paper_stepper.release()
-
-    def set_microsteps(self, stepper, microsteps):
-        '''
-        Set the microsteps for a stepper motor. "Hijacks" Adafruits library.
-        '''
-        stepper._curve = [
-            int(round(0xFFFF * math.sin(math.pi / (2 * microsteps) * i)))
-            for i in range(microsteps + 1)
-        ]
-        stepper._current_microstep = 0
-        stepper._microsteps = microsteps
-        stepper._update_coils()
+        # the hardware is missing if opening it failed
+        if (hardware := getattr(self, "hardware", None)) is not None:
+            hardware.close()
+
+    @contextmanager
+    def timed_phase(self, phase: str):
+        '''Count the time spent in the with block towards a phase, instead of whatever phase it is in'''
+        outer = self.__switch_phase(phase)
+        started = self.__phase_started if metrics.ENABLED else None
+        try:
+            yield
+        finally:
+            self.__switch_phase(outer)
+            if started is not None:
+                metrics.observe("driver", phase, self.__phase_started - started)
+
+    def phase_totals(self) -> dict[str, float]:
+        '''Seconds spent in each phase so far, including the phase it is in now'''
+        self.__switch_phase(self.__phase)
+        return dict(self.phase_seconds)
+
+    def __switch_phase(self, phase: str) -> str:
+        now = self.clock.now()
+        self.phase_seconds[self.__phase] += now - self.__phase_started
+        self.__phase_started = now
+        previous, self.__phase = self.__phase, phase
+        return previous
 
     def reset_print_head(self) -> None:
         '''
@@ -90,11 +136,23 @@ class BraillePrinterDriver:
         Returns:
             None
         '''
+        with self.timed_phase("homing"):
+            self.__reset_print_head()
+
+    def __reset_print_head(self) -> None:
         # reach edge of enclosure
-        while GPIO.input(self.BUTTON_PIN) == GPIO.HIGH:
-            self.head_stepper.onestep(style=stepper.MICROSTEP)
+        steps_taken = self.head_axis.move_until(self.hardware.home_pressed, FORWARD).wait()
 
-        self.head_stepper.release()
+        # how far the head actually was from where it was tracked to be
+        _ = DEBUG and self.__homed and print(f"reset_print_head(): measured drift {steps_taken - self.head_position} steps, estimated {self.drift_estimate}")
+
+        self.head_position = 0
+        self.__head_target = 0.0
+        self.__head_direction = 0
+        self.drift_estimate = 0.0
+        self.__homed = True
+        self.__home_requested = False
+        self.__lines_since_home = 0
 
 
     def start_print_head(self) -> None:
@@ -106,85 +164,153 @@ class BraillePrinterDriver:
             None
         '''
         # move over to start of line
-        self.__move_stepper_n_steps(self.head_stepper, self.RESET_STEPS)
+        with self.timed_phase("homing"):
+            self.__move_head_to(self.RESET_STEPS)
 
     def new_line(self) -> None:
-        self.__move_stepper_n_steps(self.paper_stepper, -self.NEW_LINE_STEPS)
-        self.reset_print_head()
-        self.start_print_head()
+        '''
+        Feeds the paper to the next line. The print head is only homed when
+        homing_due() says so; otherwise it is moved back to the start of the
+        line by its tracked position, or left where it is when printing
+        bidirectionally. The paper feeds while the print head moves.
+
+        Returns:
+            None
+        '''
+        with self.timed_phase("line feed"):
+            self.__paper_target += self.NEW_LINE_STEPS
+            self.__move_paper_to(self.__paper_target, wait=False)
+
+            self.__lines_since_home += 1
+            if self.homing_due():
+                self.reset_print_head()
+                self.start_print_head()
+            elif not self.BIDIRECTIONAL:
+                self.__move_head_to(self.RESET_STEPS)
+
+            self.paper_axis.wait()
+
+    def homing_due(self) -> bool:
+        '''
+        Whether the print head should be homed at the next new line: it has never
+        been homed, homing was requested, HOME_EVERY_LINES lines have been printed
+        since it was (if set), or its estimated drift is over MAX_DRIFT_STEPS.
+        '''
+        return (
+            not self.__homed
+            or self.__home_requested
+            or (self.HOME_EVERY_LINES > 0 and self.__lines_since_home >= self.HOME_EVERY_LINES)
+            or self.drift_estimate > self.MAX_DRIFT_STEPS
+        )
+
+    def request_homing(self) -> None:
+        '''Home the print head at the next new line'''
+        self.__home_requested = True
 
     def eject_paper(self) -> None:
-        self.__move_stepper_n_steps(self.paper_stepper, -self.EJECT_STEPS)
+        self.__paper_target += self.EJECT_STEPS
+        with self.timed_phase("eject"):
+            self.__move_paper_to(self.__paper_target)
+
+        # a new sheet starts from nothing
+        self.__paper_position = 0
+        self.__paper_target = 0.0
 
     def __mm_to_steps(self, circumference_mm: float, n_mm: float) -> int:
         return int(n_mm / (circumference_mm / self.STEPS_PER_ROTATION)) # return number of steps to move n_mm
 
-    def __move_stepper_n_steps(self, motor: stepper.StepperMotor, n: int) -> None:
+    def __move_head_to(self, position: float, release: bool = True) -> None:
+        '''
+        Move the print head to an exact position in steps from the home button. The
+        head goes to the nearest whole step, and the fraction is carried over to the next move.
+        '''
+        self.__move_stepper_n_steps(self.head_stepper, round(position) - self.head_position, release)
+        self.__head_target = position
+
+    def __move_paper_to(self, position: float, wait: bool = True) -> None:
+        '''Feed the paper to an exact position in steps, like __move_head_to()'''
+        n = round(position) - self.__paper_position
+        self.__move_stepper_n_steps(self.paper_stepper, -n, wait=wait)
+        self.__paper_position += n
+
+    def __move_stepper_n_steps(self, motor: Any, n: int, release: bool = True, wait: bool = True) -> None:
         '''
         Move a stepper motor by n steps.
 
         Args:
             motor (int): The stepper motor to run. 0 for stepper 0, 1 for stepper 1.
             distance (int): How many steps to move by.
+            release (bool): Release the motor afterwards, otherwise it keeps holding torque.
+            wait (bool): Wait for the move to finish, otherwise it runs on the motor's stepping thread.
         Returns:
             None
         '''
         # if n > 0, for motor1 step backward 
         # if n > 0, for motor0 step forward 
         # xor acts as selective invertor
-        dir = stepper.FORWARD if ((n > 0) ^ (motor == self.head_stepper)) else stepper.BACKWARD
+        dir = FORWARD if ((n > 0) ^ (motor == self.head_stepper)) else BACKWARD
 
         # we've selected the direction above based on the sign of n
         # so we can just print for the absolute value of n here
-        for _ in range(abs(n)):
-            motor.onestep(direction = dir, style=stepper.MICROSTEP)
+        axis = self.head_axis if motor == self.head_stepper else self.paper_axis
+        move = axis.move(abs(n), dir, release)
 
-        motor.release()
+        if motor == self.head_stepper and n != 0:
+            self.head_position += n
+            self.__head_target = self.head_position
 
-    def __print_half_character(self, *sol_values: bool, serial_solenoids=True) -> None:
+            # every change of direction can lose a little to backlash
+            direction = 1 if n > 0 else -1
+            if self.__head_direction not in (0, direction):
+                self.drift_estimate += self.DRIFT_PER_REVERSAL
+            self.__head_direction = direction
+
+        if wait:
+            move.wait()
+
+    def __print_half_character(self, sol_mask: int) -> None:
         '''
-        Runs all three solenoids at specified parameters and resets them after.
-        Additionally moves the print head. This function runs hardware.
+        Fires the solenoids in a mask as scheduled by self.firing, each powered for
+        its own on time and then given its settle time. This function runs hardware.
 
         Args:
-            sol_values (tuple<bool>):
-                A tuple of exectly 3 boolean values. For each value at index i, 
-                if true, solenoid i is set high, otherwise set low.
+            sol_mask (int):
+                A 3 bit mask of the solenoids to fire. For each bit i, 
+                if set, solenoid i is set high, otherwise set low.
         Returns:
             None
         '''
-        if len(sol_values) != 3:
-            raise ValueError("print_half_character(): need exactly three values for solenoids")
+        if not (0 <= sol_mask <= 0b111):
+            raise ValueError("print_half_character(): solenoid mask must be 3 bits")
 
         # only bother running solenoid if there are values that need to be 
         # printed. otherwise, just move to next half
-        if sum(sol_values) > 0:
-            if serial_solenoids:
-                for i in range(3):
-                    # GPIO.output(SOL_CHANNELS[i], sol_values[i])
-                    if sol_values[i]: # if this solenoid should fire
-                        self.pwm_solenoids[i].start(self.SOL_DUTY_CYCLE)
-                        sleep(self.SOL_PAUSE)
-                        self.pwm_solenoids[i].stop()
-                        sleep(self.SOL_PAUSE)
-            else:
-                for i in range(3):
-                    if sol_values[i]: # if this solenoid should fire
-                        self.PWM_SOLENOIDS[i].start(self.SOL_DUTY_CYCLE)
-                sleep(self.SOL_PAUSE)
-                for i in range(3):
-                    self.PWM_SOLENOIDS[i].stop()
-                sleep(self.SOL_PAUSE)
+        if sol_mask:
+            self.__run_firing(*self.firing.schedule(sol_mask))
 
-    def encode_char(self, char: str) -> None:
+    def pulse_solenoid(self, solenoid: int, on_time: float) -> None:
         '''
-        Print a character onto the paper. This function runs hardware
+        Fire one solenoid for on_time seconds, then wait for its settle time.
+        Used to calibrate on times. This function runs hardware.
+        '''
+        self.__run_firing([(0, solenoid, True), (on_time, solenoid, False)], on_time + self.SOL_SETTLE_TIMES[solenoid])
+
+    def __run_firing(self, events: list[FiringEvent], duration: float) -> None:
+        # every event is timed from the start of the firing so sleeps don't add up
+        start = self.clock.now()
+        for at, solenoid, on in events:
+            self.clock.sleep_until(start + at)
+            if on:
+                self.pwm_solenoids[solenoid].start(self.SOL_DUTY_CYCLE)
+            else:
+                self.pwm_solenoids[solenoid].stop()
+        self.clock.sleep_until(start + duration)
 
-        Args:
-            char (character): The character to be printed
-        Returns:
-            None
+    def execute_plan(self, plan: LinePlan) -> None:
         '''
+        Run the events of a plan from LinePlanner. The print head holds its
+        torque for the whole plan and is released at the end.
+        This function runs hardware.
 
         ####################
         # each character is a unique combination of six dots (2 horizontally, 3 vertically)
@@ -198,29 +324,85 @@ class BraillePrinterDriver:
         #
         ##########
 
+        Args:
+            plan (LinePlan): the events to run, in order
+        Returns:
+            None
+        '''
+        for kind, value in plan:
+            if kind == MOVE:
+                with self.timed_phase("moves"):
+                    self.__move_stepper_n_steps(self.head_stepper, value, release=False)
+            elif kind == FIRE:
+                with self.timed_phase("firing"):
+                    self.__print_half_character(value)
+            elif kind == DWELL:
+                with self.timed_phase("dwell"):
+                    self.clock.sleep(value)
+
+        self.head_stepper.release()
+
+    def encode_char(self, char: str) -> None:
+        '''
+        Print a character onto the paper. This function runs hardware
+
+        Args:
+            char (character): The character to be printed
+        Returns:
+            None
+        '''
         if char == '\n':
             self.new_line()
             return
 
         _ = DEBUG and print("encode_char(): printing " + char)
-        try:
-            unicode_braille = self.transcriber.ascii2braille(char)
-        except Exception as e:
-            _ = DEBUG and print(e)
+        cells, unsupported = self.transcriber.encode_cells(char)
+        if unsupported:
+            _ = DEBUG and print(f"encode_char(): unsupported character '{char}'")
             return
 
-        _ = DEBUG and print("encode_char(): printing (braille) " + unicode_braille)
-        array_braille = self.transcriber.braille2array(unicode_braille)
+        # the character starts where the head was sent, and the head is left at the start of the next one
+        origin = self.__head_target
+        layout = self.planner.layout(cells)
+        self.execute_plan(self.planner.plan(layout, self.head_position, origin))
+        self.__move_head_to(origin + self.SPACE_STEPS)
+
+    def render_string(self, s: str) -> list[bytes]:
+        '''
+        Prepare a string for printing without running any hardware. This handles
+        the transliteration, chunking into lines of CHARS_PER_LINE, and putting
+        the cells in the order they are printed.
 
-        # second half first because paper is punched upside down, 
-        # so the characters need to be vertically reflected 
-        sleep(self.SOL_PAUSE)
-        self.__print_half_character(*array_braille[1], serial_solenoids=self.SERIAL_SOLENOIDS)
-        self.__move_stepper_n_steps(self.head_stepper, self.HALF_CHAR_STEPS)
+        Args:
+            s (string): The string to be printed
+        Returns:
+            list[bytes]: the cells of each physical line, in printing order
+        '''
+        lines = prerender.render_string(s, self.CHARS_PER_LINE)
+        _ = DEBUG and print(f"render_string(): rendered '{s}' as {len(lines)} line(s)")
+        return lines
 
-        sleep(self.SOL_PAUSE)
-        self.__print_half_character(*array_braille[0], serial_solenoids=self.SERIAL_SOLENOIDS)
-        self.__move_stepper_n_steps(self.head_stepper, self.SPACE_STEPS - self.HALF_CHAR_STEPS) # because one half char was already printed
+    def print_rendered_line(self, cells: bytes) -> None:
+        '''
+        Print one physical line from render_string() and move on to the next line.
+        This function runs hardware.
+
+        Args:
+            cells (bytes): the cells of the line, in printing order
+        Returns:
+            None
+        '''
+        self.__print_line_layout(self.planner.layout(cells))
+
+    def __print_line_layout(self, layout: LineLayout) -> None:
+        '''
+        Print a laid out physical line and move on to the next line. When printing
+        bidirectionally the line is printed from whichever end the head is closest to.
+        '''
+        reverse = self.BIDIRECTIONAL and self.planner.nearest_end_is_last(layout, self.head_position, self.RESET_STEPS)
+
+        self.execute_plan(self.planner.plan(layout, self.head_position, self.RESET_STEPS, reverse))
+        self.new_line()
 
     def encode_string(self, s: str) -> None:
         '''
@@ -234,26 +416,92 @@ class BraillePrinterDriver:
         Returns:
             None
         '''
-        _ = DEBUG and print("encode_string(): printing " + s)
-        transliterated_s = self.transcriber.transliterate_string(s)
-        _ = DEBUG and print("encode_string(): printing (transliterated)" + transliterated_s)
+        for cells in self.render_string(s):
+            self.print_rendered_line(cells)
 
-        chunk = 0 # start at the first chunk of the string
-        chars_to_print = len(transliterated_s) # keep track of how many characters we've printed
+        self.head_stepper.release()
+        self.paper_stepper.release()
 
-        while chars_to_print > 0:
-            in_index = chunk * self.CHARS_PER_LINE
-            out_index = in_index + min(self.CHARS_PER_LINE, chars_to_print)
-            _ = DEBUG and print(f"encode_string(): chunk {chunk} '{transliterated_s[in_index:out_index]}'")
+    def print_lines(self, lines: Iterable[str]) -> None:
+        '''
+        Print many strings, rendering them ahead of the hardware, see
+        print_rendered_lines().
 
-            for char in reversed(transliterated_s[in_index:out_index]):
-                self.encode_char(char)
+        Args:
+            lines (Iterable[string]): The strings to be printed, devoid of new lines
+        Returns:
+            None
+        '''
+        self.print_rendered_lines(cells for line in lines for cells in self.render_string(line))
 
-            # difference between out_index and in_index 
-            # is how many characters that we're printed in this iteration
-            chars_to_print -= out_index - in_index
-            chunk += 1
-            self.new_line()
+    def print_rendered_lines(self, rendered_lines: Iterable[bytes], line_printed: Callable[[], None] | None = None,
+                             before_line: Callable[[], bool] | None = None) -> None:
+        '''
+        Print physical lines from render_string(), rendering and laying out up to
+        RENDER_AHEAD_LINES of them ahead on another thread while the current one
+        is printing, so the hardware never waits on rendering. Rendering waits
+        whenever it is that far ahead.
+
+        Args:
+            rendered_lines (Iterable[bytes]): the cells of each physical line, in printing order
+            line_printed (Callable[[], None] | None): called after each line is printed and the paper fed
+            before_line (Callable[[], bool] | None): called before each line, printing stops there if it returns False
+        Returns:
+            None
+        '''
+        if self.RENDER_AHEAD_LINES <= 0:
+            for cells in rendered_lines:
+                if before_line is not None and not before_line():
+                    break
+                self.print_rendered_line(cells)
+                if line_printed is not None:
+                    line_printed()
+        else:
+            laid_out: Queue[LineLayout | Exception | None] = Queue(maxsize=self.RENDER_AHEAD_LINES)
+            stopped = threading.Event()
+
+            def hand_over(item: LineLayout | Exception | None) -> bool:
+                # wait for room in the queue, but give up once printing has stopped
+                while not stopped.is_set():
+                    try:
+                        laid_out.put(item, timeout=0.1)
+                        return True
+                    except Full:
+                        pass
+                return False
+
+            def render_ahead() -> None:
+                try:
+                    for cells in rendered_lines:
+                        if not hand_over(self.planner.layout(cells)):
+                            return
+                    hand_over(None) # done rendering
+                except Exception as e:
+                    # hand the error over to be raised on the printing thread
+                    hand_over(e)
+
+            renderer = threading.Thread(target=render_ahead, daemon=True)
+            renderer.start()
+            try:
+                while (layout := laid_out.get()) is not None:
+                    if isinstance(layout, Exception):
+                        raise layout
+                    if before_line is not None and not before_line():
+                        break
+                    self.__print_line_layout(layout)
+                    if line_printed is not None:
+                        line_printed()
+            finally:
+                # however printing ended, make room for whatever is being rendered so the renderer sees it
+                # was stopped. A renderer waiting on its source for more lines stops once it gets one, or
+                # the source ends, so it isn't waited on for long
+                stopped.set()
+                while True:
+                    try:
+                        laid_out.get_nowait()
+                    except Empty:
+                        break
+                renderer.join(timeout=1.0)
 
         self.head_stepper.release()
         self.paper_stepper.release()
@@ -1,83 +1,576 @@
 import os
 import signal
-import threading
-from control import BraillePrinterDriver
-from queue import Queue
+import asyncio
+import tomllib
+import json
 import time
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+from control import BraillePrinterDriver
+from collections import deque
+from pathlib import Path
+from typing import Callable, Iterator
 from DriverCommunicator import BrailleDriverCommunicator
+from prerender import prerender_lines, start_pool
+from spool import Spool, SpoolJob
+from scheduler import JobScheduler
+from commands import PrintCommands
+from status import StatusPublisher, JobProgress
+import commands
+import metrics
+from estimator import PrintEstimator
+import protocol
 
 PIPE_PATH = "/var/run/user/1000/text2touch_pipe"
 
-# Spooler queue to manage print jobs
-SPOOLER_QUEUE = Queue()
+with open(Path(__file__).resolve().parent / "config.toml", "rb") as f:
+    CONFIG = tomllib.load(f)
+
+STREAM_JOBS         = CONFIG["DAEMON"]["STREAM_JOBS"]
+STREAM_CHUNK_SIZE   = CONFIG["DAEMON"]["STREAM_CHUNK_SIZE"]
+PRERENDER_WORKERS     = CONFIG["DAEMON"]["PRERENDER_WORKERS"]
+PRERENDER_PIECE_LINES = CONFIG["DAEMON"]["PRERENDER_PIECE_LINES"]
+PRERENDER_MIN_BYTES   = CONFIG["DAEMON"]["PRERENDER_MIN_BYTES"]
+MAX_CLIENTS           = CONFIG["DAEMON"]["MAX_CLIENTS"]
+CLIENT_TIMEOUT        = CONFIG["DAEMON"]["CLIENT_TIMEOUT"]
+SPOOL_DIR             = Path(__file__).resolve().parent / CONFIG["DAEMON"]["SPOOL_DIR"]
+METRICS_FILE          = Path(__file__).resolve().parent / CONFIG["METRICS"]["FILE"] if CONFIG["METRICS"]["FILE"] else None
+METRICS_FILE_INTERVAL = CONFIG["METRICS"]["FILE_INTERVAL"]
+METRICS_SOCKET        = CONFIG["METRICS"]["SOCKET"]
+PROFILE_DIR           = Path(__file__).resolve().parent / CONFIG["METRICS"]["PROFILE_DIR"]
+
+metrics.enable(CONFIG["METRICS"]["ENABLED"])
+
+# decides which job prints next, only used on the event loop
+SCHEDULER = JobScheduler(CONFIG["DAEMON"]["SCHEDULING"], CONFIG["DAEMON"]["PRIORITY_AGING"], CONFIG["DAEMON"]["SHORTEST_AGING"])
+
+# where jobs are kept until they are printed, recovered in serve()
+SPOOL = Spool(SPOOL_DIR)
+
+# tasks serving clients of the job socket, and estimating jobs
+CLIENTS: set[asyncio.Task] = set()
+ESTIMATES: set[asyncio.Task] = set()
 
-CONTROL      = BraillePrinterDriver()
+# a "next" for every job the operator has said to start, and a wake up whenever auto-advance
+# is turned on, only used on the event loop
+ADVANCE: asyncio.Queue[str] = asyncio.Queue()
+
+# built in main() once the pre-render workers are forked, since the driver starts the stepping threads
+CONTROL: BraillePrinterDriver | None = None
 DRIVER_COMMS = BrailleDriverCommunicator()
+ESTIMATOR    = PrintEstimator()
+
+# status events, sent from serve() on without ever waiting on whoever reads them
+STATUS = StatusPublisher(DRIVER_COMMS, CONFIG["DAEMON"]["STATUS_MAX_RATE"])
+
+# the one thread that runs the hardware, so CONTROL is only ever used by one thing at a time
+HARDWARE = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hardware")
+
+# estimates jobs one at a time, so long jobs don't hold up the event loop
+ESTIMATING = ThreadPoolExecutor(max_workers=1, thread_name_prefix="estimating")
+
+# pause, resume, cancel, and skip pages of the job printing, and stop printing when the daemon is shutting down
+PRINT_COMMANDS = PrintCommands(auto_advance=CONFIG["DAEMON"]["AUTO_ADVANCE"])
+
+# writes the metrics to METRICS_FILE for as long as they are on, only used on the event loop
+METRICS_WRITER: asyncio.Task | None = None
+
+# jobs to print under cProfile, None being whichever prints next, only used on the event loop
+PROFILE_JOBS: set[int | None] = set()
 
-def spool_job(data: str) -> None:
+# started in main(), before any threads, when jobs are pre-rendered in parallel
+PRERENDER_POOL = None
+
+async def run_on_hardware(function: Callable, *args):
+    '''Run a function on the hardware thread, and wait for it without blocking the event loop'''
+    return await asyncio.get_running_loop().run_in_executor(HARDWARE, function, *args)
+
+def spool_job(job: SpoolJob) -> tuple[int, int]:
     '''
     Adds a print job to the spooler queue.
 
     Args:
-        data (string): The entire text to be printed
+        job (SpoolJob): the job, whose text may still be arriving
+    Returns:
+        tuple[int, int]: the job's ID, and its place in the queue
+    '''
+    SPOOL.queue(job)
+    position = schedule_job(job)
+    if metrics.ENABLED:
+        metrics.count("spooler", "jobs spooled")
+    print(f"Job {job.id} added to spooler at {position}. Queue size: {len(SCHEDULER)}")
+    publish_jobs()
+    return job.id, position
+
+def publish_jobs() -> None:
+    '''Publish the jobs waiting to print as a "jobs" event'''
+    STATUS.publish("jobs", {"jobs": [scheduled.as_dict(position) for position, scheduled in enumerate(SCHEDULER.ordered(), 1)]})
+
+def schedule_job(job: SpoolJob) -> int:
+    '''Hand a spooled job to the scheduler, estimating it if it is all here. Returns its place in the queue.'''
+    position = SCHEDULER.add(job)
+    # streamed jobs aren't all here yet, and are estimated once they are
+    if job.complete:
+        estimate_job(job)
+    return position
+
+def estimate_job(job: SpoolJob) -> None:
+    '''Estimate a whole job on the estimating thread, then send the estimate and tell the scheduler its cost'''
+    async def estimate() -> None:
+        try:
+            estimate = await asyncio.get_running_loop().run_in_executor(
+                ESTIMATING, lambda: ESTIMATOR.estimate(line for _, _, line in SPOOL.lines(job)))
+        except OSError:
+            return # cancelled, and deleted, before it was estimated
+        job.estimate = estimate
+        STATUS.publish("estimate", {"job": job.id, **estimate._asdict()})
+        if SCHEDULER.set_cost(job.id, estimate.seconds):
+            publish_jobs()
+
+    task = asyncio.create_task(estimate())
+    ESTIMATES.add(task)
+    task.add_done_callback(ESTIMATES.discard)
+
+def cancel_job(job_id: int) -> None:
+    '''Cancel a job waiting to print, and delete it from the spool'''
+    job = SCHEDULER.cancel(job_id)
+    if job is None:
+        print(f"Job {job_id} isn't waiting to print, not cancelled")
+        return
+    SPOOL.finish(job)
+    print(f"Job {job_id} cancelled. Queue size: {len(SCHEDULER)}")
+
+def prioritize_job(job_id: int, priority: int) -> None:
+    '''Change the priority of a job waiting to print'''
+    job = SCHEDULER.set_priority(job_id, priority)
+    if job is None:
+        print(f"Job {job_id} isn't waiting to print, priority not changed")
+        return
+    SPOOL.prioritize(job, priority)
+
+def handle_command(command: str) -> None:
+    '''
+    Carry out a command from the command message queue straight away, even
+    while a job is printing. Commands to the scheduler are answered with the
+    jobs waiting as a "jobs" event.
+
+    Args:
+        command (string): one of
+            "next"                       start the next job
+            "auto on", "auto off"        start each job as soon as the last is done, or wait for "next"
+            "pause", "resume"            pause printing before the next line, or carry on
+            "page"                       eject the sheet, and carry on with the job on the next one
+            "cancel [job]"               cancel the job printing, or a job waiting to print
+            "priority <job> <priority>"  change the priority of a job waiting to print
+            "move <job> <place>"         move a job waiting to print to a place in the queue
+            "jobs"                       send the jobs waiting as a "jobs" event
+            "metrics on", "metrics off"  start or stop counting and timing the phases of printing
+            "profile [job]"              print the next job, or a job, under cProfile, see profile_job()
     Returns:
         None
     '''
-    SPOOLER_QUEUE.put(data)
-    print(f"Job added to spooler. Queue size: {SPOOLER_QUEUE.qsize()}")
-    DRIVER_COMMS.write_status(f"queue size: {SPOOLER_QUEUE.qsize()}")
+    name, *args = command.split() or [""]
+    try:
+        if name == "next":
+            ADVANCE.put_nowait(name)
+        elif name == "auto":
+            PRINT_COMMANDS.auto_advance = {"on": True, "off": False}[args[0]]
+            ADVANCE.put_nowait(name) # don't leave a job waiting for a "next" that isn't needed any more
+        elif name == "pause":
+            PRINT_COMMANDS.pause()
+        elif name == "resume":
+            PRINT_COMMANDS.resume()
+        elif name == "page":
+            if not PRINT_COMMANDS.next_page():
+                print("No job printing, no page to skip")
+        elif name == "cancel":
+            job_id = int(args[0]) if args else None
+            if PRINT_COMMANDS.cancel(job_id):
+                print(f"Job {PRINT_COMMANDS.job_id} cancelled, stopping at the end of the line")
+                return
+            if job_id is None:
+                print("No job printing, nothing cancelled")
+                return
+            cancel_job(job_id)
+        elif name == "priority":
+            prioritize_job(int(args[0]), int(args[1]))
+        elif name == "move":
+            if not SCHEDULER.move(int(args[0]), int(args[1])):
+                print(f"Job {args[0]} isn't waiting to print, not moved")
+        elif name == "metrics":
+            metrics.enable({"on": True, "off": False}[args[0]])
+            start_metrics_writer()
+        elif name == "profile":
+            PROFILE_JOBS.add(int(args[0]) if args else None)
+        elif name != "jobs":
+            print(f"Unknown command '{command}', ignored")
+            return
+    except (IndexError, KeyError, ValueError):
+        print(f"Command '{command}' not understood, ignored")
+        return
 
-def process_spooler() -> None:
+    if name in ("cancel", "priority", "move", "jobs"):
+        publish_jobs()
+
+async def process_spooler() -> None:
     '''
-    Continuously processes jobs from the spooler queue.
-    This function should run in a separate thread.
+    Continuously processes jobs from the spooler queue, printing each on the
+    hardware thread. This should run as a task on the event loop.
 
     Returns:
         None
     '''
     while True:
-        job = SPOOLER_QUEUE.get()  # blocks until a job is available
-        print(f"Processing job. Queue size: {SPOOLER_QUEUE.qsize()}")
-        print_job(job)
-        SPOOLER_QUEUE.task_done()
-        pause_for_next_job()
+        job = await SCHEDULER.get()  # waits until a job is available
+        print(f"Processing job {job.id}. Queue size: {len(SCHEDULER)}")
+        publish_jobs()
+        if metrics.ENABLED:
+            metrics.observe("spooler", "queued", SCHEDULER.last_waited)
+
+        profile = bool(PROFILE_JOBS & {None, job.id})
+        PROFILE_JOBS.difference_update({None, job.id})
+        # done with on the event loop, which may still be writing the job's text
+        if await run_on_hardware(profile_job if profile else print_job, job):
+            SPOOL.finish(job)
+        await pause_for_next_job()
 
-def pause_for_next_job() -> None:
+async def pause_for_next_job() -> None:
     '''
-    Waits to start the next job in the spooler queue.
-    This function should be called when a job is completed.
+    Waits to start the next job in the spooler queue, until the "next" command
+    unless auto-advancing. A "next" sent while a job prints starts the next
+    job as soon as it is done. This function should be called when a job is completed.
 
     Returns:
         None
     '''
-    while True:
-        command = DRIVER_COMMS.read_cmd()
-        if command == "next":
-            return
-        elif input("Next doc? (y/n): ").strip().lower() == "y":
+    while not PRINT_COMMANDS.auto_advance:
+        if await ADVANCE.get() == "next":
             return
-        else:
-            time.sleep(1)  # wait for a second before checking again
 
-def print_job(data: str) -> None:
+def print_job(job: SpoolJob) -> bool:
+    '''
+    Prints a job from where it was last checkpointed, checkpointing every
+    physical line once it is printed. This runs the hardware, so it is only run
+    on the hardware thread.
+
+    Commands in PRINT_COMMANDS are taken up between lines. A job is done once
+    it is printed or cancelled, or once its text can't be read, or left in the
+    spool to be finished after a restart if the daemon is shutting down. Afterwards the time each phase of
+    printing took calibrates ESTIMATOR, see calibrate_estimator().
+
+    Args:
+        job (SpoolJob): the job
+    Returns:
+        bool: whether the job is done
+    '''
+    start = job.offset
+    before = CONTROL.phase_totals()
+    started = time.monotonic()
+
+    # (start, end) byte offsets of the lines handed over to rendering, in order
+    rendering: deque[tuple[int, int]] = deque()
+    unreadable: list[OSError] = [] # why the job's text couldn't be read, which ends the job there
+    def text() -> Iterator[str]:
+        try:
+            for line_start, line_end, line in SPOOL.lines(job):
+                rendering.append((line_start, line_end))
+                yield line
+        except OSError as e:
+            unreadable.append(e)
+
+    try:
+        text_left = os.path.getsize(job.path) - job.offset
+    except OSError:
+        text_left = 0 # and text() finds out why
+
+    # a job still arriving is rendered line by line, so each line prints as soon as it is here
+    # rather than waiting on the rest of its piece
+    if PRERENDER_POOL is not None and job.complete and text_left >= PRERENDER_MIN_BYTES:
+        rendered = prerender_lines(text(), PRERENDER_POOL, CONTROL.CHARS_PER_LINE, PRERENDER_PIECE_LINES, 2 * PRERENDER_WORKERS)
+    else:
+        rendered = (CONTROL.render_string(line) for line in text())
+
+    # the checkpoint to make once each physical line handed to the driver is printed, and its cells
+    printing: deque[tuple[int, int, bytes]] = deque()
+    def physical_lines() -> Iterator[bytes]:
+        skip = job.skip # physical lines of the first line that were printed before
+        for line_cells in rendered:
+            line_start, line_end = rendering.popleft()
+            for printed, cells in enumerate(line_cells[skip:], skip + 1):
+                printing.append((line_start, printed, cells) if printed < len(line_cells) else (line_end, 0, cells))
+                yield cells
+            skip = 0
+
+    progress = JobProgress(job.id)
+    line_started = 0.0
+    def before_line() -> bool:
+        nonlocal line_started
+        if PRINT_COMMANDS.paused:
+            STATUS.publish("progress", progress.event("paused", job.estimate))
+        command = PRINT_COMMANDS.between_lines()
+        if command == commands.NEXT_PAGE:
+            print(f"Skipping to the next page of job {job.id}")
+            CONTROL.eject_paper()
+        line_started = time.monotonic()
+        return command != commands.STOP
+
+    def line_printed() -> None:
+        offset, skip, cells = printing.popleft()
+        checkpoint_started = time.perf_counter() if metrics.ENABLED else None
+        SPOOL.checkpoint(job, offset, skip)
+        if checkpoint_started is not None:
+            metrics.observe("spooler", "checkpoint", time.perf_counter() - checkpoint_started)
+        progress.line_printed(cells, time.monotonic() - line_started)
+        STATUS.publish("progress", progress.event("printing", job.estimate))
+
+    STATUS.publish("progress", progress.event("printing", job.estimate))
+    PRINT_COMMANDS.start_job(job.id)
+    try:
+        CONTROL.print_rendered_lines(physical_lines(), line_printed, before_line)
+    finally:
+        PRINT_COMMANDS.end_job()
+
+    measured = {phase: seconds - before.get(phase, 0) for phase, seconds in CONTROL.phase_totals().items()}
+    stopped_early = PRINT_COMMANDS.stopping or PRINT_COMMANDS.cancelled or bool(unreadable)
+    calibrate_estimator(job, start, job.offset, measured, None if stopped_early else job.estimate)
+
+    if PRINT_COMMANDS.stopping:
+        print(f"Shutting down, job {job.id} will carry on from here when the daemon is back")
+        state = "stopped"
+    elif unreadable:
+        print(f"Job {job.id} can't be read, giving up on it:", unreadable[0])
+        CONTROL.eject_paper()
+        state = "failed"
+    else:
+        if job.eject or PRINT_COMMANDS.cancelled:
+            CONTROL.eject_paper()
+        state = "cancelled" if PRINT_COMMANDS.cancelled else "done"
+    STATUS.publish("progress", progress.event(state, job.estimate))
+
+    if metrics.ENABLED:
+        seconds = time.monotonic() - started
+        metrics.observe("spooler", "job", seconds)
+        metrics.count("spooler", f"jobs {state}")
+        metrics.job_totals(job.id, {**measured, "elapsed": seconds, "lines": progress.lines, "cells": progress.cells})
+    return state != "stopped"
+
+def calibrate_estimator(job: SpoolJob, start: int, end: int, measured: dict[str, float], estimate=None) -> None:
+    '''
+    Calibrate ESTIMATOR against how long printing part of a job took, on the
+    estimating thread so the hardware thread can carry on with the next job.
+
+    Args:
+        job (SpoolJob): the job
+        start (int), end (int): byte offsets of what was printed
+        measured (dict[str, float]): seconds printing it spent in each phase, see BraillePrinterDriver.phase_totals()
+        estimate (PrintEstimate | None): the estimate of what was printed if there is one, like the
+            job's own when it printed to the end, otherwise it is estimated again
+    '''
+    def calibrate() -> None:
+        printed = estimate
+        if printed is None:
+            try:
+                printed = ESTIMATOR.estimate(line for _, _, line in SPOOL.lines(job, start, end))
+            except OSError:
+                return # finished, and deleted, before it was estimated
+        ESTIMATOR.calibrate(printed, measured)
+
+    if estimate is not None or end > start:
+        ESTIMATING.submit(calibrate)
+
+def profile_job(job: SpoolJob) -> bool:
+    '''
+    Prints a job like print_job() under cProfile, and writes the stats to
+    PROFILE_DIR/job-<ID>.prof for pstats or snakeviz. Only the hardware
+    thread is profiled, not rendering ahead or pre-render workers.
+
+    Args:
+        job (SpoolJob): the job
+    Returns:
+        bool: whether the job is done
     '''
-    Sets up a chunk of data to be printed. This is meant to be the entry point of 
-    a thread, where each thread is a job to be printed.
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(print_job, job)
+    finally:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"job-{job.id}.prof"
+        profiler.dump_stats(path)
+        print(f"Profile of job {job.id} written to {path}")
+
+async def spool_stream(reader: asyncio.StreamReader, spooled: Callable[[int, int], None] | None = None,
+        timeout: float | None = None) -> None:
+    '''
+    Spools every document that arrives on a pipe or socket, see protocol.md. Documents
+    between @startdoc and @enddoc are spooled whole as soon as their @enddoc
+    arrives, and the paper is ejected after them.
+
+    Text outside of them is spooled as soon as its first line arrives if
+    STREAM_JOBS, and keeps being written to the spool while it prints.
+    Otherwise it is spooled once the writers have left. Either way documents
+    are written to disk as they arrive, so a writer that is ahead of the
+    printer never grows the daemon's memory.
 
     Args:
-        data (string): The entire text to be printed
+        reader (asyncio.StreamReader): the opened pipe or socket
+        spooled (Callable[[int, int], None] | None): called with the ID and place in
+            the queue of every job spooled
+        timeout (float | None): seconds to wait for the writer to send something, before
+            raising TimeoutError
     Returns:
         None
     '''
-    # critical section because ecoding will be running the hardware
-    for line in data.split('\n'):
-        CONTROL.encode_string(line)
+    parser = protocol.DocumentParser()
+    framed = False
+    job: SpoolJob | None = None
+    queued = False
+    lines: list[str] = [] # lines not written to the spool yet
 
-def handle_kill(sig, frame) -> None:
-    '''Do routine cleanup and remove pipe. For when a kill signal is detected'''
-    os.remove(PIPE_PATH)
-    SPOOLER_THREAD.join()
-    exit(0)
+    def spool(job: SpoolJob) -> None:
+        job_id, position = spool_job(job)
+        if spooled is not None:
+            spooled(job_id, position)
+
+    try:
+        while True:
+            # read returns whatever is available rather than waiting for a full chunk
+            chunk = await asyncio.wait_for(reader.read(STREAM_CHUNK_SIZE), timeout)
+            if metrics.ENABLED:
+                metrics.count("spooler", "bytes received", len(chunk))
+            for kind, value in parser.feed(chunk) if chunk else parser.close():
+                if kind == protocol.START:
+                    framed, job, queued = value, SPOOL.create(eject=value), False
+                elif kind == protocol.LINE:
+                    lines.append(value)
+                    if not (queued or framed or not STREAM_JOBS):
+                        SPOOL.append(job, lines)
+                        lines.clear()
+                        spool(job)
+                        queued = True
+                elif kind == protocol.END:
+                    SPOOL.append(job, lines)
+                    lines.clear()
+                    if queued:
+                        SPOOL.close(job)
+                        if job.id in SCHEDULER:
+                            estimate_job(job)
+                    elif framed and not value:
+                        print(f"Document ended without {protocol.ENDDOC}, not printing it")
+                        SPOOL.discard(job)
+                    elif os.path.getsize(job.path) > 0:
+                        SPOOL.close(job)
+                        spool(job)
+                    else:
+                        SPOOL.discard(job)
+                    job = None
+                elif kind == protocol.CONTROL:
+                    name, _, argument = value.partition(" ")
+                    if name == protocol.PRIORITY and job is not None and argument.strip().lstrip("-").isdigit():
+                        if queued:
+                            prioritize_job(job.id, int(argument))
+                        else:
+                            job.priority = int(argument)
+                    else:
+                        print(f"Unknown control code '{value}', ignored")
+
+            if job is not None and lines:
+                SPOOL.append(job, lines)
+                lines.clear()
+            if not chunk:
+                return
+    finally:
+        # end the job even if reading failed or was cancelled, so printing never waits on it
+        if job is not None and queued:
+            SPOOL.close(job)
+        elif job is not None:
+            SPOOL.discard(job)
+
+async def open_pipe(path: str) -> tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    '''
+    Open the pipe for reading without waiting for a writer. The event loop
+    only wakes up for it once a writer has connected and written or left.
+    '''
+    loop = asyncio.get_running_loop()
+    pipe = os.fdopen(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb", buffering=0)
+    reader = asyncio.StreamReader(limit=STREAM_CHUNK_SIZE)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+async def watch_pipe(path: str) -> None:
+    '''
+    Spool the documents writers send every time they connect to the pipe, until they have all left.
+    This should run as a task on the event loop.
+    '''
+    while True:
+        # have to keep opening the pipe because the connection closes
+        # after all writers are done
+        reader, transport = await open_pipe(path)
+        try:
+            await spool_stream(reader)
+        finally:
+            transport.close()
+
+async def serve_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    '''
+    Spool the documents a client of the job socket sends. Every job is answered
+    as soon as it is spooled with a line of JSON, {"job": ID, "position": place in
+    the queue}, and problems with {"error": why}. Every client is served on its
+    own, so a slow one only ever holds itself up.
+    '''
+    def answer(message: dict) -> None:
+        writer.write((json.dumps(message) + "\n").encode())
+
+    if len(CLIENTS) >= MAX_CLIENTS:
+        answer({"error": f"already serving {MAX_CLIENTS} clients, try again later"})
+    else:
+        task = asyncio.current_task()
+        CLIENTS.add(task)
+        try:
+            await spool_stream(reader, lambda job_id, position: answer({"job": job_id, "position": position}), CLIENT_TIMEOUT)
+        except TimeoutError:
+            answer({"error": f"nothing sent for {CLIENT_TIMEOUT} seconds"})
+        except ConnectionError:
+            pass
+        finally:
+            CLIENTS.discard(task)
+
+    try:
+        writer.close()
+        await asyncio.wait_for(writer.wait_closed(), CLIENT_TIMEOUT)
+    except (ConnectionError, TimeoutError):
+        pass
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    '''Answer a client of the metrics socket with the metrics in Prometheus' text format, then hang up'''
+    writer.write(metrics.render().encode())
+    try:
+        writer.close()
+        await asyncio.wait_for(writer.wait_closed(), CLIENT_TIMEOUT)
+    except (ConnectionError, TimeoutError):
+        pass
+
+async def write_metrics(path: Path, interval: float) -> None:
+    '''Write the metrics to a file every so many seconds until they are turned off. This should run as a task on the event loop.'''
+    while metrics.ENABLED:
+        metrics.write_file(path)
+        await asyncio.sleep(interval)
+
+def start_metrics_writer() -> None:
+    '''Start writing the metrics to METRICS_FILE if they are on, and it isn't being written already'''
+    global METRICS_WRITER
+    if METRICS_FILE is None or not metrics.ENABLED or (METRICS_WRITER is not None and not METRICS_WRITER.done()):
+        return
+    METRICS_WRITER = asyncio.create_task(write_metrics(METRICS_FILE, METRICS_FILE_INTERVAL), name="metrics")
+
+async def start_socket(path: str, client_connected: Callable = serve_client) -> asyncio.AbstractServer:
+    '''Start serving a socket, the job socket by default, replacing whatever socket a previous daemon left behind'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    server = await asyncio.start_unix_server(client_connected, path, limit=STREAM_CHUNK_SIZE)
+    print(f"{path} socket ready")
+    return server
 
 def safe_start_pipe(path: str) -> None:
     try:
@@ -91,26 +584,82 @@ def safe_start_pipe(path: str) -> None:
     finally:
         print(f"{path} pipe ready")
 
-SPOOLER_THREAD: threading.Thread = threading.Thread(target=process_spooler, daemon=True)
+async def serve() -> None:
+    '''Run the daemon on the event loop until it is told to stop by SIGINT or SIGTERM'''
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    DRIVER_COMMS.watch_cmd(loop, handle_command)
+    STATUS.start(loop)
+
+    # carry on with the jobs that were left when the daemon last stopped
+    for job in SPOOL.recover():
+        print(f"Job {job.id} recovered from the spool, carrying on from byte {job.offset}")
+        schedule_job(job)
+
+    # reset the print head
+    await run_on_hardware(CONTROL.new_line)
+
+    servers = [await start_socket(DRIVER_COMMS.JOB_SOCKET)]
+    if METRICS_SOCKET:
+        servers.append(await start_socket(METRICS_SOCKET, serve_metrics))
+    tasks = [
+        asyncio.create_task(process_spooler(), name="spooler"),
+        asyncio.create_task(watch_pipe(PIPE_PATH), name="pipe"),
+    ]
+    # nothing is written while metrics are off, so the SD card isn't written to for nothing
+    start_metrics_writer()
+    print("Spooler started")
+
+    # a task that fails takes the daemon down with it rather than leaving it half running
+    waiting = asyncio.create_task(stop.wait())
+    done, _ = await asyncio.wait([waiting, *tasks], return_when=asyncio.FIRST_COMPLETED)
+    for task in done - {waiting}:
+        print(f"{task.get_name()} stopped:", task.exception())
+
+    # stop taking jobs, and let the one printing finish its line
+    PRINT_COMMANDS.stop()
+    DRIVER_COMMS.unwatch(loop)
+    for server in servers:
+        server.close()
+    tasks += CLIENTS | ESTIMATES
+    if METRICS_WRITER is not None:
+        tasks.append(METRICS_WRITER)
+    for task in [waiting, *tasks]:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for path in (DRIVER_COMMS.JOB_SOCKET, METRICS_SOCKET):
+        if path:
+            os.remove(path)
+    if METRICS_FILE is not None and metrics.ENABLED:
+        metrics.write_file(METRICS_FILE)
+    await run_on_hardware(CONTROL.hardware.close)
+    STATUS.stop()
+    SPOOL.close_journal()
+
 def main() -> None:
-    signal.signal(signal.SIGINT, handle_kill)
+    global PRERENDER_POOL, CONTROL
 
     # Set up pipes
     safe_start_pipe(PIPE_PATH)
 
-    # Start spooler thread
-    SPOOLER_THREAD.start()
-    print("Spooler thread started")
-
-    # reset the print head
-    CONTROL.new_line()
+    # workers are forked, so they have to be started before any other threads
+    if PRERENDER_WORKERS > 0:
+        PRERENDER_POOL = start_pool(PRERENDER_WORKERS)
+        print(f"Pre-rendering on {PRERENDER_WORKERS} workers")
+    CONTROL = BraillePrinterDriver()
 
-    while True:
-        # have to keep opening the pipe because the connection closes
-        # after all writers are done
-        with open(PIPE_PATH, "r") as pipe:
-            spool_job(pipe.read().strip())
+    try:
+        asyncio.run(serve())
+    finally:
+        HARDWARE.shutdown(wait=True)
+        ESTIMATING.shutdown(wait=True, cancel_futures=True)
+        if PRERENDER_POOL is not None:
+            PRERENDER_POOL.shutdown(cancel_futures=True)
+        os.remove(PIPE_PATH)
+        print("Daemon stopped")
 
 if __name__ == "__main__":
     main()
-
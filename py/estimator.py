@@ -0,0 +1,235 @@
+############################
+## Estimates how long a job will take to print, and how much paper and
+## punching it needs, from the same planning the driver does and the
+## timings in config.toml. Nothing in here touches hardware.
+##
+## Estimates calibrate themselves: after every job the daemon compares
+## what was estimated for each phase of printing with what was measured,
+## and the calibration is saved for the next run.
+############################
+import json
+import math
+from pathlib import Path
+from typing import Any, Iterable, NamedTuple
+import prerender
+from control import BraillePrinterDriver
+from firing import FiringScheduler
+from planner import LinePlanner, MOVE, FIRE, DWELL
+from stepping import VelocityProfile
+
+CALIBRATION_PATH = Path(__file__).resolve().parent / "print-calibration.json"
+
+# shortest time a step takes whatever the profile, roughly the I2C writes of one step
+STEP_SECONDS_FLOOR = 0.001
+
+# how much each job's measurements move the calibration, 0 never moves it and 1 only trusts the last job
+CALIBRATION_WEIGHT = 0.2
+
+# phases of printing that are estimated, named like BraillePrinterDriver.phase_seconds
+PHASES = ("moves", "dwell", "firing", "line feed", "homing")
+
+class PrintEstimate(NamedTuple):
+    seconds: float               # how long printing takes
+    lines: int                   # physical lines of braille
+    pages: int                   # sheets of paper
+    cells: int                   # braille cells punched, not counting blanks at the ends of lines
+    firings: int                 # solenoid firings, one per dot
+    phases: dict[str, float]     # seconds in each phase of printing
+    raw_phases: dict[str, float] # seconds in each phase before calibration
+
+
+class PrintEstimator:
+    '''Predicts print jobs on the printer described by config.toml'''
+
+    def __init__(self, calibration_path: Path | None = CALIBRATION_PATH) -> None:
+        '''
+        Args:
+            calibration_path (Path | None): where the calibration is kept, None to not keep one
+        '''
+        driver = BraillePrinterDriver
+        self.planner = LinePlanner(driver.HALF_CHAR_STEPS, driver.SPACE_STEPS, driver.SOL_PAUSE)
+        self.firing = FiringScheduler.from_config(driver.config["SOLENOIDS"])
+        self.head_profile = VelocityProfile.from_config(driver.config["STEPPERS"], "HEAD")
+        self.paper_profile = VelocityProfile.from_config(driver.config["STEPPERS"], "PAPER")
+
+        # a sheet is as long as an eject feeds
+        self.lines_per_page = max(1, int(driver.config["SIZES"]["EJECT_STEPS"] // driver.config["SIZES"]["NEW_LINE_STEPS"]))
+
+        # measured / estimated for each phase, and time outside the phases per line
+        self.scales = {phase: 1.0 for phase in PHASES}
+        self.other_per_line = 0.0
+        self.jobs_calibrated = 0
+
+        self.calibration_path = calibration_path
+        self.__move_seconds: dict[tuple[int, int], float] = {}
+        self.load_calibration()
+
+    def move_seconds(self, profile: VelocityProfile, steps: int) -> float:
+        '''How long a move of so many steps takes'''
+        key = (id(profile), abs(steps))
+        if (seconds := self.__move_seconds.get(key)) is None:
+            seconds = sum(max(interval, STEP_SECONDS_FLOOR) for interval in profile.intervals(abs(steps)))
+            self.__move_seconds[key] = seconds
+        return seconds
+
+    def homing_seconds(self, head_position: int) -> float:
+        '''How long homing takes from a head position: back to the button at start speed, then to the start of the line'''
+        driver = BraillePrinterDriver
+        interval = 1 / self.head_profile.start_speed if self.head_profile.kind != VelocityProfile.NONE else 0.0
+        return head_position * max(interval, STEP_SECONDS_FLOOR) + self.move_seconds(self.head_profile, round(driver.RESET_STEPS))
+
+    def estimate(self, lines: Iterable[str]) -> PrintEstimate:
+        '''
+        Estimate a job by rendering and planning it the way the driver would,
+        and adding up how long every event takes. The print head is taken to
+        start homed, at the start of a line.
+
+        Args:
+            lines (Iterable[string]): the lines of the job, devoid of new lines
+        Returns:
+            PrintEstimate: the estimate
+        '''
+        driver = BraillePrinterDriver
+        raw = {phase: 0.0 for phase in PHASES}
+        physical_lines = cells = firings = 0
+        line_feed_seconds = self.move_seconds(self.paper_profile, round(driver.NEW_LINE_STEPS))
+
+        # tracked like the driver tracks its print head
+        origin = driver.RESET_STEPS
+        head = round(origin)
+        direction = lines_since_home = 0
+        drift = 0.0
+
+        def move_head(n: int) -> float:
+            nonlocal head, direction, drift
+            if n != 0:
+                head += n
+                if direction not in (0, 1 if n > 0 else -1):
+                    drift += driver.DRIFT_PER_REVERSAL
+                direction = 1 if n > 0 else -1
+            return self.move_seconds(self.head_profile, n)
+
+        for line in lines:
+            for line_cells in prerender.render_string(line, driver.CHARS_PER_LINE):
+                physical_lines += 1
+                cells += len(line_cells.rstrip(b"\x00"))
+
+                layout = self.planner.layout(line_cells)
+                reverse = driver.BIDIRECTIONAL and self.planner.nearest_end_is_last(layout, head, origin)
+                for kind, value in self.planner.plan(layout, head, origin, reverse):
+                    if kind == MOVE:
+                        raw["moves"] += move_head(value)
+                    elif kind == FIRE:
+                        raw["firing"] += self.firing.schedule(value)[1]
+                        firings += value.bit_count()
+                    elif kind == DWELL:
+                        raw["dwell"] += value
+
+                # the paper feeds while the head homes or goes back to the start of the line
+                lines_since_home += 1
+                if (driver.HOME_EVERY_LINES > 0 and lines_since_home >= driver.HOME_EVERY_LINES) or drift > driver.MAX_DRIFT_STEPS:
+                    homing = self.homing_seconds(head)
+                    raw["homing"] += homing
+                    raw["line feed"] += max(line_feed_seconds - homing, 0)
+                    head, direction, drift, lines_since_home = round(origin), 0, 0.0, 0
+                elif not driver.BIDIRECTIONAL:
+                    raw["line feed"] += max(line_feed_seconds, move_head(round(origin) - head))
+                else:
+                    raw["line feed"] += line_feed_seconds
+
+        phases = {phase: seconds * self.scales[phase] for phase, seconds in raw.items()}
+        return PrintEstimate(
+            seconds=sum(phases.values()) + self.other_per_line * physical_lines,
+            lines=physical_lines,
+            pages=math.ceil(physical_lines / self.lines_per_page),
+            cells=cells,
+            firings=firings,
+            phases=phases,
+            raw_phases=raw,
+        )
+
+    def calibrate(self, estimate: PrintEstimate, measured: dict[str, float]) -> None:
+        '''
+        Move the calibration towards what a job actually took, and save it.
+
+        Args:
+            estimate (PrintEstimate): the estimate of the job
+            measured (dict[str, float]): seconds the job spent in each phase, like BraillePrinterDriver.phase_totals()
+        Returns:
+            None
+        '''
+        for phase in PHASES:
+            if estimate.raw_phases[phase] > 0 and measured.get(phase, 0) > 0:
+                ratio = measured[phase] / estimate.raw_phases[phase]
+                self.scales[phase] += CALIBRATION_WEIGHT * (ratio - self.scales[phase])
+
+        if estimate.lines > 0:
+            per_line = measured.get("other", 0) / estimate.lines
+            self.other_per_line += CALIBRATION_WEIGHT * (per_line - self.other_per_line)
+
+        self.jobs_calibrated += 1
+        self.save_calibration()
+
+    def load_calibration(self) -> None:
+        '''Load the saved calibration, if there is one'''
+        if self.calibration_path is None:
+            return
+        try:
+            calibration = json.loads(self.calibration_path.read_text())
+            self.scales.update({phase: float(scale) for phase, scale in calibration["scales"].items() if phase in PHASES})
+            self.other_per_line = float(calibration["other_per_line"])
+            self.jobs_calibrated = int(calibration["jobs_calibrated"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    def save_calibration(self) -> None:
+        '''Save the calibration so it outlasts the daemon'''
+        if self.calibration_path is None:
+            return
+        calibration: dict[str, Any] = {
+            "scales": self.scales,
+            "other_per_line": self.other_per_line,
+            "jobs_calibrated": self.jobs_calibrated,
+        }
+
+        # write then rename so a reader never sees half a calibration
+        tmp_path = self.calibration_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(calibration, indent=2) + "\n")
+        tmp_path.replace(self.calibration_path)
+
+
+if __name__ == "__main__":
+    from simulator import SimulatedHardware
+    import control
+
+    control.DEBUG = False
+    with open("endpoem.txt", "r") as f:
+        document = f.read().split('\n')[:20]
+
+    estimator = PrintEstimator(calibration_path=None)
+    estimate = estimator.estimate(document)
+    assert(estimate.lines == sum(len(prerender.render_string(line, BraillePrinterDriver.CHARS_PER_LINE)) for line in document))
+    assert(estimate.pages == math.ceil(estimate.lines / estimator.lines_per_page) and estimate.firings > estimate.cells > 0)
+    assert(estimator.estimate([]).seconds == 0)
+
+    # check against the simulator, which counts the same firings and takes about as long
+    hardware = SimulatedHardware(step_seconds=STEP_SECONDS_FLOOR)
+    driver = BraillePrinterDriver(hardware)
+    driver.reset_print_head()
+    driver.start_print_head()
+    before = driver.phase_totals()
+    driver.print_lines(document)
+    measured = {phase: seconds - before.get(phase, 0) for phase, seconds in driver.phase_totals().items()}
+
+    assert(hardware.firings == estimate.firings)
+    assert(abs(sum(measured.values()) - estimate.seconds) < 0.05 * estimate.seconds)
+
+    # calibrating towards a printer twice as slow at moving brings the estimate closer to it
+    slow = dict(measured, moves=2 * measured["moves"])
+    for _ in range(20):
+        estimator.calibrate(estimate, slow)
+    assert(abs(estimator.scales["moves"] - 2 * measured["moves"] / estimate.raw_phases["moves"]) < 0.05)
+    assert(estimator.estimate(document).seconds > estimate.seconds)
+
+    print(f"{estimate.lines} lines, {estimate.pages} page(s), {estimate.firings} firings, {estimate.seconds:.1f} s")
+    print("All tests passed!")
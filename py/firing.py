@@ -0,0 +1,119 @@
+############################
+## Schedules solenoid firings: which solenoids are powered when,
+## so as many fire at once as the power supply allows.
+##
+## Nothing in here runs hardware, BraillePrinterDriver runs the schedules.
+############################
+from typing import Any
+
+# (seconds from the start of the firing, solenoid, whether it is powered on or off)
+FiringEvent = tuple[float, int, bool]
+
+# the events in order, and seconds until every solenoid has settled
+FiringSchedule = tuple[list[FiringEvent], float]
+
+class FiringScheduler:
+    '''
+    Works out when to power each solenoid of a half cell.
+
+    Solenoids are powered as soon as there is room in the power budget: no more
+    than max_solenoids coils at once, drawing no more than max_current between
+    them. The longest pulses are started first. Every solenoid is released after
+    its own on time, and the firing is done once each has had its settle time.
+    '''
+
+    def __init__(self, on_times: list[float], settle_times: list[float], currents: list[float],
+                 max_solenoids: int, max_current: float) -> None:
+        '''
+        Args:
+            on_times (list[float]): seconds each solenoid is powered to punch a dot
+            settle_times (list[float]): seconds each solenoid needs after being released
+            currents (list[float]): amps each solenoid draws while powered
+            max_solenoids (int): most solenoids powered at once
+            max_current (float): most amps drawn by the solenoids at once
+        '''
+        if not (len(on_times) == len(settle_times) == len(currents)):
+            raise ValueError("FiringScheduler(): every solenoid needs an on time, settle time, and current")
+        if max_solenoids < 1 or any(current > max_current for current in currents):
+            raise ValueError("FiringScheduler(): power budget is too small to fire a single solenoid")
+
+        self.on_times = on_times
+        self.settle_times = settle_times
+        self.currents = currents
+        self.max_solenoids = max_solenoids
+        self.max_current = max_current
+
+        # there are only a handful of masks, so every schedule is worked out up front
+        self.__schedules = [self.__schedule(mask) for mask in range(1 << len(on_times))]
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "FiringScheduler":
+        '''Build the scheduler from the [SOLENOIDS] section of config.toml'''
+        return cls(
+            config["SOL_ON_TIMES"], config["SOL_SETTLE_TIMES"], config["SOL_CURRENTS"],
+            1 if config["SERIAL_SOLENOIDS"] else config["MAX_SIMULTANEOUS_SOLENOIDS"],
+            config["MAX_SOLENOID_CURRENT"],
+        )
+
+    def schedule(self, sol_mask: int) -> FiringSchedule:
+        '''
+        Args:
+            sol_mask (int): mask of the solenoids to fire, bit i for solenoid i
+        Returns:
+            FiringSchedule: when to power each solenoid on and off
+        '''
+        return self.__schedules[sol_mask]
+
+    def __schedule(self, sol_mask: int) -> FiringSchedule:
+        waiting = sorted(
+            (i for i in range(len(self.on_times)) if sol_mask & (1 << i)),
+            key=lambda i: self.on_times[i], reverse=True,
+        )
+        powered: list[tuple[float, int]] = [] # (time it is released, solenoid)
+        events: list[FiringEvent] = []
+        now = done = 0.0
+        current = 0.0
+
+        while waiting or powered:
+            for i in list(waiting):
+                if len(powered) < self.max_solenoids and current + self.currents[i] <= self.max_current:
+                    events.append((now, i, True))
+                    powered.append((now + self.on_times[i], i))
+                    current += self.currents[i]
+                    waiting.remove(i)
+
+            # release the next solenoid, which makes room for the ones waiting
+            powered.sort()
+            now, i = powered.pop(0)
+            events.append((now, i, False))
+            current -= self.currents[i]
+            done = max(done, now + self.settle_times[i])
+
+        return events, done
+
+
+if __name__ == "__main__":
+    # one at a time is the same as firing in serial
+    scheduler = FiringScheduler([0.5, 0.5, 0.5], [0.5, 0.5, 0.5], [1, 1, 1], 1, 3)
+    assert(scheduler.schedule(0b000) == ([], 0))
+    assert(scheduler.schedule(0b101) == ([(0, 0, True), (0.5, 0, False), (0.5, 2, True), (1.0, 2, False)], 1.5))
+
+    # all at once
+    scheduler = FiringScheduler([0.2, 0.3, 0.1], [0.1, 0.1, 0.3], [1, 1, 1], 3, 3)
+    events, done = scheduler.schedule(0b111)
+    assert(sorted(events)[:3] == [(0, 0, True), (0, 1, True), (0, 2, True)] and done == 0.4)
+
+    # two at a time by current: the longest pulses go first, the third starts when one is released
+    scheduler = FiringScheduler([0.25, 0.5, 0.125], [0.125, 0.125, 0.125], [1, 1, 1], 3, 2.5)
+    assert(scheduler.schedule(0b111) == (
+        [(0, 1, True), (0, 0, True), (0.25, 0, False), (0.25, 2, True), (0.375, 2, False), (0.5, 1, False)],
+        0.625,
+    ))
+
+    try:
+        FiringScheduler([0.2], [0.1], [3], 1, 2)
+        assert(False)
+    except ValueError:
+        pass
+
+    print("All tests passed!")
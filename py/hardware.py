@@ -0,0 +1,141 @@
+############################
+## The printer's hardware as the driver sees it: two steppers, three
+## solenoids, and the home button. PiHardware is the real printer,
+## simulator.SimulatedHardware runs anywhere.
+##
+## Hardware libraries are only imported when the real printer is
+## opened, so everything else can run off a Raspberry Pi.
+############################
+import math
+from abc import ABC, abstractmethod
+from typing import Any
+from stepping import Clock
+import native
+
+class PrinterHardware(ABC):
+    '''
+    What the driver needs from a printer.
+
+    Attributes:
+        clock (Clock): what the driver times everything by
+        head_stepper (Any): moves the print head, anything with onestep(direction=, style=)
+            and release() like an adafruit_motor StepperMotor, optionally with run()
+            to take a whole move at once like native.NativeStepper
+        paper_stepper (Any): feeds the paper, like head_stepper
+        solenoids (list[Any]): punch the dots, anything with start(duty_cycle) and stop()
+            like an RPi.GPIO PWM
+    '''
+    clock: Clock
+    head_stepper: Any
+    paper_stepper: Any
+    solenoids: list[Any]
+    closed = False
+
+    @abstractmethod
+    def home_pressed(self) -> bool:
+        '''Whether the print head is against the home button'''
+
+    def close(self) -> None:
+        '''Let go of the hardware and stop holding current on the steppers. Closing it again does nothing.'''
+        if self.closed:
+            return
+        self.closed = True
+        self.head_stepper.release()
+        self.paper_stepper.release()
+
+
+class PiHardware(PrinterHardware):
+    '''The real printer: a motor hat for the steppers, and GPIO for the solenoids and button'''
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        '''
+        Args:
+            config (dict[str, Any]): the whole of config.toml
+        '''
+        # imported here so nothing else needs them installed
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.clock = Clock()
+
+        steppers = config["STEPPERS"]
+        microsteps = steppers["MICROSTEPS"]
+
+        # the native library runs whole moves itself, otherwise adafruit_motorkit steps them one by one
+        self.hat = open_native_hat(steppers["I2C_BUS"], steppers["HAT_ADDRESS"]) if steppers["NATIVE_STEPPERS"] else None
+        if self.hat is not None:
+            self.head_stepper = self.hat.stepper(2, microsteps)
+            self.paper_stepper = self.hat.stepper(1, microsteps)
+        else:
+            from adafruit_motorkit import MotorKit
+            motor_kit = MotorKit()
+            self.head_stepper = motor_kit.stepper2
+            self.paper_stepper = motor_kit.stepper1
+            for motor in [self.head_stepper, self.paper_stepper]:
+                set_microsteps(motor, microsteps)
+
+        # ensure steppers are released
+        self.head_stepper.release()
+        self.paper_stepper.release()
+
+        # solenoid GPIO setup
+        channels = (config["PINS"]["SOL_0_PIN"], config["PINS"]["SOL_1_PIN"], config["PINS"]["SOL_2_PIN"])
+        GPIO.setmode(GPIO.BCM) # use broadcom (GPIO) pin numbers
+        GPIO.setup(channels, GPIO.OUT) # setup solenoid pins
+
+        self.solenoids = [GPIO.PWM(channel, config["SOLENOIDS"]["SOL_PWM_FREQ"]) for channel in channels]
+
+        # set pull up resistor on button
+        self.button_pin = config["PINS"]["BUTTON_PIN"]
+        GPIO.setup(self.button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def home_pressed(self) -> bool:
+        return self.GPIO.input(self.button_pin) != self.GPIO.HIGH
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self.GPIO.cleanup()
+        if self.hat is not None:
+            self.hat.close()
+
+
+def open_native_hat(bus: int, address: int) -> native.MotorHat | None:
+    '''Open the motor hat with the native library, or None to fall back to adafruit_motorkit'''
+    if (lib := native.load_library()) is None:
+        print(f"open_native_hat(): {native.LIBRARY_PATH} not built, stepping through adafruit_motorkit")
+        return None
+    try:
+        return native.MotorHat(lib, bus, address)
+    except OSError as e:
+        print(f"open_native_hat(): {e}, stepping through adafruit_motorkit")
+        return None
+
+def set_microsteps(stepper, microsteps):
+    '''
+    Set the microsteps for a stepper motor. "Hijacks" Adafruits library.
+    '''
+    stepper._curve = [
+        int(round(0xFFFF * math.sin(math.pi / (2 * microsteps) * i)))
+        for i in range(microsteps + 1)
+    ]
+    stepper._current_microstep = 0
+    stepper._microsteps = microsteps
+    stepper._update_coils()
+
+def open_hardware(config: dict[str, Any]) -> PrinterHardware:
+    '''
+    Open the hardware named by HARDWARE in the [DRIVER] section of config.toml.
+
+    Args:
+        config (dict[str, Any]): the whole of config.toml
+    Returns:
+        PrinterHardware: the real printer for "pi", or a simulated one for "simulator"
+    '''
+    kind = config["DRIVER"]["HARDWARE"]
+    if kind == "pi":
+        return PiHardware(config)
+    if kind == "simulator":
+        from simulator import SimulatedHardware
+        return SimulatedHardware.from_config(config)
+    raise ValueError(f"open_hardware(): unknown hardware '{kind}'")
@@ -0,0 +1,179 @@
+############################
+## Counts and timings of each phase of printing, for finding out where
+## the time goes on a real job, exported in Prometheus' text format.
+##
+## Hooks check ENABLED before doing anything, like DEBUG in control.py,
+## so they cost one global lookup while metrics are off:
+##     started = perf_counter() if metrics.ENABLED else None
+##     ...
+##     if started is not None:
+##         metrics.observe("transcriber", "transliterate", perf_counter() - started)
+##
+## Metrics are kept per process. Pre-render workers take() what they
+## recorded for every piece they render and send it back with the piece,
+## to be merge()d into the daemon's, see prerender.py. Nothing in here
+## runs hardware.
+############################
+import bisect
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+
+ENABLED = False
+
+# upper bounds of the latency histogram buckets in seconds, each also counts everything below it
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# per job totals are kept for this many of the last jobs
+JOB_HISTORY = 20
+
+PREFIX = "text2touch"
+
+class Histogram:
+    '''How many observations fell at or below each of BUCKETS, and their sum'''
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1) # the last is above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+__lock = threading.Lock()
+__histograms: defaultdict[tuple[str, str], Histogram] = defaultdict(Histogram)
+__counters: defaultdict[tuple[str, str], float] = defaultdict(float)
+__jobs: OrderedDict[int, dict[str, float]] = OrderedDict()
+
+def enable(enabled: bool = True) -> None:
+    global ENABLED
+    ENABLED = enabled
+
+def observe(component: str, phase: str, seconds: float) -> None:
+    '''Record how long one occurrence of a phase took'''
+    with __lock:
+        __histograms[(component, phase)].observe(seconds)
+
+def count(component: str, event: str, n: float = 1) -> None:
+    '''Count occurrences of an event, or an amount of something like bytes'''
+    with __lock:
+        __counters[(component, event)] += n
+
+def job_totals(job_id: int, totals: dict[str, float]) -> None:
+    '''Record totals for a job, like the seconds it spent in each phase. Only the last JOB_HISTORY jobs are kept.'''
+    with __lock:
+        __jobs[job_id] = dict(totals)
+        __jobs.move_to_end(job_id)
+        while len(__jobs) > JOB_HISTORY:
+            __jobs.popitem(last=False)
+
+def take() -> dict[str, dict]:
+    '''
+    Take the counts and histograms recorded so far, leaving none behind, to
+    be merged into another process's with merge(). Per job totals are kept.
+
+    Returns:
+        dict[str, dict]: the histograms and counters, which can be pickled
+    '''
+    with __lock:
+        taken = {"histograms": dict(__histograms), "counters": dict(__counters)}
+        __histograms.clear()
+        __counters.clear()
+    return taken
+
+def merge(taken: dict[str, dict]) -> None:
+    '''Add counts and histograms from take() in another process to this one's'''
+    with __lock:
+        for key, other in taken["histograms"].items():
+            histogram = __histograms[key]
+            histogram.buckets = [n + m for n, m in zip(histogram.buckets, other.buckets)]
+            histogram.count += other.count
+            histogram.sum += other.sum
+        for key, n in taken["counters"].items():
+            __counters[key] += n
+
+def reset() -> None:
+    with __lock:
+        __histograms.clear()
+        __counters.clear()
+        __jobs.clear()
+
+def render() -> str:
+    '''
+    Everything recorded so far in Prometheus' text exposition format.
+
+    Returns:
+        string: the metrics, one sample per line
+    '''
+    lines = [
+        f"# HELP {PREFIX}_phase_seconds How long each occurrence of a phase took.",
+        f"# TYPE {PREFIX}_phase_seconds histogram",
+    ]
+    with __lock:
+        for (component, phase), histogram in sorted(__histograms.items()):
+            labels = f'component="{component}",phase="{phase}"'
+            cumulative = 0
+            for bound, n in zip((*BUCKETS, "+Inf"), histogram.buckets):
+                cumulative += n
+                lines.append(f'{PREFIX}_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{PREFIX}_phase_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{PREFIX}_phase_seconds_count{{{labels}}} {histogram.count}")
+
+        lines += [f"# HELP {PREFIX}_events_total Occurrences of each event.", f"# TYPE {PREFIX}_events_total counter"]
+        for (component, event), n in sorted(__counters.items()):
+            lines.append(f'{PREFIX}_events_total{{component="{component}",event="{event}"}} {n}')
+
+        lines += [f"# HELP {PREFIX}_job_total Totals for each of the last jobs printed.", f"# TYPE {PREFIX}_job_total gauge"]
+        for job_id, totals in __jobs.items():
+            for name, value in sorted(totals.items()):
+                lines.append(f'{PREFIX}_job_total{{job="{job_id}",name="{name}"}} {value}')
+
+    return "\n".join(lines) + "\n"
+
+def write_file(path: Path) -> None:
+    '''Write the metrics to a file, replacing it whole so a scraper never reads half of them'''
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(render())
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    enable()
+    for seconds in (0.0002, 0.003, 0.003, 2.0):
+        observe("driver", "moves", seconds)
+    count("spooler", "jobs spooled")
+    count("spooler", "bytes received", 100)
+    for job_id in range(JOB_HISTORY + 1):
+        job_totals(job_id, {"moves": 1.5, "lines": 3})
+
+    text = render()
+    assert('text2touch_phase_seconds_bucket{component="driver",phase="moves",le="0.0005"} 1' in text)
+    assert('text2touch_phase_seconds_bucket{component="driver",phase="moves",le="0.005"} 3' in text)
+    assert('text2touch_phase_seconds_bucket{component="driver",phase="moves",le="+Inf"} 4' in text)
+    assert('text2touch_phase_seconds_count{component="driver",phase="moves"} 4' in text)
+    assert('text2touch_events_total{component="spooler",event="bytes received"} 100' in text)
+    assert('job="0"' not in text and 'text2touch_job_total{job="20",name="moves"} 1.5' in text)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "metrics.prom"
+        write_file(path)
+        assert(path.read_text() == text and os.listdir(tmp) == ["metrics.prom"])
+
+    # what another process took adds up with what is here
+    import pickle
+    taken = pickle.loads(pickle.dumps(take()))
+    assert("_bucket" not in render() and 'job="20"' in render())
+    observe("driver", "moves", 0.003)
+    merge(taken)
+    assert('text2touch_phase_seconds_bucket{component="driver",phase="moves",le="0.005"} 4' in render())
+    assert('text2touch_events_total{component="spooler",event="bytes received"} 100' in render())
+
+    reset()
+    assert("_bucket" not in render())
+    print("All tests passed!")
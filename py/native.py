@@ -0,0 +1,183 @@
+############################
+## Loads the native motor hat library built from C/stepperHat.c, which
+## runs whole stepper moves in one call. It is optional: without it the
+## driver steps through adafruit_motorkit instead.
+##
+## Build the library with:
+##     make -C ../C lib
+############################
+import ctypes
+from pathlib import Path
+from stepping import FORWARD, BACKWARD
+
+LIBRARY_PATH = Path(__file__).resolve().parent.parent / "C" / "build" / "libstepperhat.so"
+
+def load_library(path: Path = LIBRARY_PATH) -> ctypes.CDLL | None:
+    '''
+    Load the library and declare its functions.
+
+    Args:
+        path (Path): where the library was built
+    Returns:
+        ctypes.CDLL | None: the library, or None if it has not been built
+    '''
+    try:
+        lib = ctypes.CDLL(str(path), use_errno=True)
+    except OSError:
+        return None
+
+    hat = ctypes.c_void_p
+    lib.motorHatOpen.argtypes = [ctypes.c_int, ctypes.c_int]
+    lib.motorHatOpen.restype = hat
+    lib.motorHatOpenMock.argtypes = []
+    lib.motorHatOpenMock.restype = hat
+    lib.motorHatClose.argtypes = [hat]
+    lib.motorHatClose.restype = None
+    lib.motorHatStepperInit.argtypes = [hat, ctypes.c_int, ctypes.c_int]
+    lib.motorHatStepperInit.restype = ctypes.c_int
+    lib.motorHatMove.argtypes = [hat, ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.POINTER(ctypes.c_double), ctypes.c_int]
+    lib.motorHatMove.restype = ctypes.c_long
+    lib.motorHatRelease.argtypes = [hat, ctypes.c_int]
+    lib.motorHatRelease.restype = ctypes.c_int
+    lib.motorHatCurrentMicrostep.argtypes = [hat, ctypes.c_int]
+    lib.motorHatCurrentMicrostep.restype = ctypes.c_long
+    lib.motorHatMockRegister.argtypes = [hat, ctypes.c_int]
+    lib.motorHatMockRegister.restype = ctypes.c_int
+    lib.motorHatWrites.argtypes = [hat]
+    lib.motorHatWrites.restype = ctypes.c_long
+    return lib
+
+def check(result: int) -> int:
+    '''Raise the library's errno if a call failed'''
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"motor hat: {errno}")
+    return result
+
+
+class MotorHat:
+    '''The motor hat, driven by the native library'''
+
+    def __init__(self, lib: ctypes.CDLL, bus: int | None, address: int = 0x60) -> None:
+        '''
+        Args:
+            lib (ctypes.CDLL): the library from load_library()
+            bus (int | None): I2C bus the hat is on, or None for a mock hat that only exists in memory
+            address (int): I2C address of the hat
+        '''
+        self.lib = lib
+        self.handle = lib.motorHatOpenMock() if bus is None else lib.motorHatOpen(bus, address)
+        if not self.handle:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"MotorHat(): could not open the hat on bus {bus} at {address:#x}")
+
+    def stepper(self, number: int, microsteps: int) -> "NativeStepper":
+        '''A stepper on the hat, 1 or 2 like MotorKit's stepper1 and stepper2'''
+        return NativeStepper(self, number, microsteps)
+
+    def register(self, reg: int) -> int:
+        '''What has been written to a register of a mock hat'''
+        return self.lib.motorHatMockRegister(self.handle, reg)
+
+    @property
+    def writes(self) -> int:
+        '''How many I2C writes have been made'''
+        return self.lib.motorHatWrites(self.handle)
+
+    def close(self) -> None:
+        if self.handle:
+            self.lib.motorHatClose(self.handle)
+            self.handle = None
+
+
+class NativeStepper:
+    '''
+    A stepper on a MotorHat. It steps like an adafruit_motor StepperMotor
+    microstepping, and can also run a whole move in one call with run().
+    '''
+
+    def __init__(self, hat: MotorHat, number: int, microsteps: int) -> None:
+        self.hat = hat
+        self.number = number
+        check(hat.lib.motorHatStepperInit(hat.handle, number, microsteps))
+
+    def onestep(self, direction: int = FORWARD, style: int | None = None) -> None:
+        '''Take one microstep, style is ignored since only microsteps are taken'''
+        check(self.hat.lib.motorHatMove(self.hat.handle, self.number, direction, 1, None, 0))
+
+    def run(self, direction: int, intervals: list[float]) -> int:
+        '''
+        Take a step for every interval, each that many seconds after the last,
+        without coming back to Python in between.
+
+        Args:
+            direction (int): FORWARD or BACKWARD
+            intervals (list[float]): seconds from each step to the next, all 0 steps as fast as possible
+        Returns:
+            int: how many steps were taken
+        '''
+        steps = len(intervals)
+        timing = (ctypes.c_double * steps)(*intervals) if any(intervals) else None
+        return check(self.hat.lib.motorHatMove(self.hat.handle, self.number, direction, steps, timing, 0))
+
+    def release(self) -> None:
+        check(self.hat.lib.motorHatRelease(self.hat.handle, self.number))
+
+    @property
+    def current_microstep(self) -> int:
+        return self.hat.lib.motorHatCurrentMicrostep(self.hat.handle, self.number)
+
+
+if __name__ == "__main__":
+    import math
+    from time import perf_counter
+
+    lib = load_library()
+    assert lib is not None, "build the library first: make -C ../C lib"
+
+    # the coil currents adafruit_motor would set for a microstep, in (ain2, bin1, ain1, bin2) order,
+    # to the 12 bits the hat keeps
+    def expected_duty_cycles(microstep: int, microsteps: int) -> list[int]:
+        curve = [int(round(0xFFFF * math.sin(math.pi / (2 * microsteps) * i))) for i in range(microsteps + 1)]
+        duty_cycles = [0, 0, 0, 0]
+        trailing_coil = (microstep // microsteps) % 4
+        leading_coil = (trailing_coil + 1) % 4
+        duty_cycles[leading_coil] = curve[microstep % microsteps]
+        duty_cycles[trailing_coil] = curve[microsteps - microstep % microsteps]
+        return [d if d == 0xFFFF else d >> 4 << 4 for d in duty_cycles]
+
+    def duty_cycle(hat: MotorHat, channel: int) -> int:
+        on_h, off_l, off_h = (hat.register(0x06 + 4 * channel + i) for i in (1, 2, 3))
+        if on_h & 0x10:
+            return 0xFFFF
+        return 0 if off_h & 0x10 else ((off_h << 8) | off_l) << 4
+
+    hat = MotorHat(lib, None)
+    assert(hat.register(0x00) == 0xA0 and hat.register(0xFE) == 3)
+
+    head = hat.stepper(2, 4)
+    assert(duty_cycle(hat, 2) == duty_cycle(hat, 7) == 0xFFFF)
+
+    for direction, steps in ((FORWARD, 7), (BACKWARD, 13), (FORWARD, 1)):
+        for _ in range(steps):
+            head.onestep(direction)
+            coils = [duty_cycle(hat, channel) for channel in (3, 5, 4, 6)]
+            assert(coils == expected_duty_cycles(head.current_microstep, 4))
+    assert(head.current_microstep == -5)
+
+    paper = hat.stepper(1, 4)
+    paper.onestep(BACKWARD)
+    assert([duty_cycle(hat, channel) for channel in (9, 11, 10, 12)] == expected_duty_cycles(-1, 4))
+
+    # a whole move is one write per step, and keeps to its timing
+    writes = hat.writes
+    start = perf_counter()
+    assert(head.run(BACKWARD, [0.002] * 50) == 50)
+    assert(0.098 <= perf_counter() - start < 0.15)
+    assert(hat.writes - writes == 50 and head.current_microstep == -55)
+
+    head.release()
+    assert([duty_cycle(hat, channel) for channel in (3, 4, 5, 6)] == [0, 0, 0, 0])
+
+    hat.close()
+    print("All tests passed!")
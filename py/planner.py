@@ -0,0 +1,135 @@
+############################
+## Compiles physical lines of braille cells into plans of timed
+## events for the print head: moves, solenoid firings, and dwells.
+##
+## Nothing in here runs hardware, BraillePrinterDriver executes the plans.
+############################
+from transcriber import BrailleTranscriber
+
+# kinds of plan event
+MOVE  = "move"   # move the print head by some number of steps
+FIRE  = "fire"   # fire the solenoids in a 3 bit mask
+DWELL = "dwell"  # wait some seconds for the head to settle
+
+PlanEvent = tuple[str, int | float]
+LinePlan = list[PlanEvent]
+
+# (position in steps from the start of the line, solenoid mask) of each half cell that punches
+# positions are exact, they are only rounded to whole steps when planned
+LineLayout = list[tuple[float, int]]
+
+class LinePlanner:
+    '''
+    Turns the cells of a physical line into the events needed to punch it.
+
+    This is done in two steps. layout() does the work that only depends on the
+    cells, and can be done well ahead of printing. plan() turns a layout into
+    events from wherever the print head is, in either direction, just before
+    the line is printed.
+    '''
+
+    def __init__(self, half_char_steps: float, space_steps: float, settle_pause: float) -> None:
+        '''
+        Args:
+            half_char_steps (float): steps between the two halves of a cell
+            space_steps (float): steps from the start of one cell to the next
+            settle_pause (float): seconds to wait before firing
+        '''
+        self.half_char_steps = half_char_steps
+        self.space_steps = space_steps
+        self.settle_pause = settle_pause
+
+    def layout(self, cells: bytes) -> LineLayout:
+        '''
+        Find where every half cell that punches something is on the line.
+        Blank halves are left out.
+
+        Args:
+            cells (bytes): the cells of the line, in printing order
+        Returns:
+            LineLayout: the halves, in order along the line
+        '''
+        layout: LineLayout = []
+
+        for i, cell in enumerate(cells):
+            # computed from the start of the line every time so rounding never builds up
+            position = i * self.space_steps
+            left_half, right_half = BrailleTranscriber.cell_halves(cell)
+
+            # second half first because paper is punched upside down,
+            # so the characters need to be vertically reflected
+            if right_half:
+                layout.append((position, right_half))
+            if left_half:
+                layout.append((position + self.half_char_steps, left_half))
+
+        return layout
+
+    def plan(self, layout: LineLayout, head_position: int = 0, origin: float = 0, reverse: bool = False) -> LinePlan:
+        '''
+        Plan a line from where the print head is.
+
+        Moves between firings are merged into one, and the line ends at the last
+        half that punches anything instead of travelling past trailing blanks.
+        In reverse the halves are punched from the end of the line back to its
+        start, so each cell's halves come in the opposite order.
+
+        Every half is moved to at its exact position rounded to the nearest step,
+        so the fractions of a step carry over and the cell pitch stays exact
+        across the whole line.
+
+        Args:
+            layout (LineLayout): the halves of the line
+            head_position (int): where the print head is, in steps
+            origin (float): where the line starts, in steps
+            reverse (bool): punch the line from its end back to its start
+        Returns:
+            LinePlan: the events, in order
+        '''
+        plan: LinePlan = []
+        position = head_position
+
+        for offset, sol_mask in (reversed(layout) if reverse else layout):
+            target = round(origin + offset)
+            if target != position:
+                plan.append((MOVE, target - position))
+                position = target
+            plan.append((DWELL, self.settle_pause))
+            plan.append((FIRE, sol_mask))
+
+        return plan
+
+    @staticmethod
+    def nearest_end_is_last(layout: LineLayout, head_position: int, origin: float = 0) -> bool:
+        '''Whether the print head is closer to the end of the line than its start'''
+        if not layout:
+            return False
+        first, last = origin + layout[0][0], origin + layout[-1][0]
+        return abs(head_position - last) < abs(head_position - first)
+
+
+if __name__ == "__main__":
+    planner = LinePlanner(2, 10, 0.5)
+
+    # 'a' is only dot 1, so only the left half fires
+    cells, _ = BrailleTranscriber.encode_cells("  a  ")
+    assert(planner.layout(cells) == [(22, 0b001)])
+    assert(planner.plan(planner.layout(cells)) == [(MOVE, 22), (DWELL, 0.5), (FIRE, 0b001)])
+    assert(planner.plan(planner.layout(cells), head_position=30, origin=5) == [(MOVE, -3), (DWELL, 0.5), (FIRE, 0b001)])
+
+    # '&' has dots on both halves
+    cells, _ = BrailleTranscriber.encode_cells("&")
+    layout = planner.layout(cells)
+    assert(planner.plan(layout) == [(DWELL, 0.5), (FIRE, 0b101), (MOVE, 2), (DWELL, 0.5), (FIRE, 0b111)])
+    assert(planner.plan(layout, head_position=2, reverse=True) == [(DWELL, 0.5), (FIRE, 0b111), (MOVE, -2), (DWELL, 0.5), (FIRE, 0b101)])
+    assert(not planner.nearest_end_is_last(layout, 0) and planner.nearest_end_is_last(layout, 2))
+
+    assert(planner.plan(planner.layout(b"\x00\x00")) == [])
+
+    # a pitch of 2.4 steps would lose 12 steps over 30 cells if truncated every cell
+    planner = LinePlanner(1.2, 2.4, 0.5)
+    cells, _ = BrailleTranscriber.encode_cells("a" * 30)
+    moves = [steps for kind, steps in planner.plan(planner.layout(cells), origin=10.3) if kind == MOVE]
+    assert(sum(moves) == round(10.3 + 29 * 2.4 + 1.2) and set(moves[1:]) == {2, 3})
+
+    print("All tests passed!")
@@ -0,0 +1,167 @@
+############################
+## Renders documents into physical lines of braille cells, either
+## in process or spread over a pool of worker processes for long jobs.
+##
+## Nothing in here runs hardware, so it is safe to import in workers.
+############################
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, Iterator
+import metrics
+from transcriber import BrailleTranscriber, UNSUPPORTED_CELL
+
+def render_string(s: str, chars_per_line: int) -> list[bytes]:
+    '''
+    Prepare a string for printing: transliterate it, chunk it into lines of
+    chars_per_line, and put the cells of each line in the order they are printed.
+
+    Args:
+        s (string): The string to be printed, devoid of new lines
+        chars_per_line (int): how many characters fit on a physical line
+    Returns:
+        list[bytes]: the cells of each physical line, in printing order
+    '''
+    transcriber = BrailleTranscriber()
+    cells, _ = transcriber.encode_cells(transcriber.transliterate_string(s))
+
+    # lines are printed backwards, and unsupported characters are not printed at all
+    return [
+        cells[in_index:in_index + chars_per_line][::-1].replace(bytes([UNSUPPORTED_CELL]), b"")
+        for in_index in range(0, len(cells), chars_per_line)
+    ]
+
+def render_piece(lines: list[str], chars_per_line: int) -> list[list[bytes]]:
+    '''Render a piece of a document line by line, see render_string(). Runs in a worker.'''
+    return [render_string(line, chars_per_line) for line in lines]
+
+def render_piece_measured(lines: list[str], chars_per_line: int, measure: bool) -> tuple[list[list[bytes]], dict | None]:
+    '''
+    Render a piece like render_piece(), along with what metrics recorded
+    while rendering it if measure, for the daemon to merge into its own.
+    Runs in a worker, whose metrics are only on while the daemon's are.
+    '''
+    metrics.enable(measure)
+    rendered = render_piece(lines, chars_per_line)
+    return rendered, metrics.take() if measure else None
+
+def init_worker() -> None:
+    '''Build the transcriber and its tables once when a worker starts'''
+    BrailleTranscriber().reload_tables()
+
+def start_pool(workers: int) -> ProcessPoolExecutor:
+    '''
+    Start a pool of rendering workers.
+
+    The workers are forked, since spawning them would import the daemon's
+    main module again, which opens the message queues and the spool. This
+    should be called before the daemon starts any threads, including the
+    driver's stepping threads, and it waits for the workers to be running
+    so none are forked later.
+
+    Args:
+        workers (int): how many worker processes to run
+    Returns:
+        ProcessPoolExecutor: the running pool
+    '''
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=init_worker,
+    )
+    pool.submit(int).result()
+    return pool
+
+def split_document(lines: Iterable[str], piece_lines: int) -> Iterator[list[str]]:
+    '''
+    Split a document into pieces that can be rendered independently.
+
+    A piece ends at the first paragraph (blank line) or page (form feed) boundary
+    once it is long enough, or at twice that length if there is no boundary.
+    Pieces start at a single line and double up to piece_lines, so the first
+    piece is ready quickly even while the rest of the job is still arriving.
+
+    Args:
+        lines (Iterable[string]): the lines of the document
+        piece_lines (int): how many lines a piece should have
+    Returns:
+        Iterator[list[string]]: the pieces, in order
+    '''
+    target = 1
+    piece: list[str] = []
+
+    for line in lines:
+        piece.append(line)
+        at_boundary = line.strip() == "" or "\f" in line
+        if (at_boundary and len(piece) >= target) or len(piece) >= 2 * target:
+            yield piece
+            piece = []
+            target = min(2 * target, piece_lines)
+
+    if piece:
+        yield piece
+
+def prerender_lines(lines: Iterable[str], pool: ProcessPoolExecutor, chars_per_line: int,
+                    piece_lines: int, max_pending: int) -> Iterator[list[bytes]]:
+    '''
+    Render a document on a pool of workers, yielding the physical lines of each
+    of its lines in order as soon as the piece they are in is ready.
+
+    Args:
+        lines (Iterable[string]): the lines of the document
+        pool (ProcessPoolExecutor): the pool from start_pool()
+        chars_per_line (int): how many characters fit on a physical line
+        piece_lines (int): how many lines a piece should have, see split_document()
+        max_pending (int): most pieces being rendered at once
+    Returns:
+        Iterator[list[bytes]]: for each line of the document, the cells of its physical lines in printing order
+    '''
+    pending: deque[Future] = deque()
+
+    for piece in split_document(lines, piece_lines):
+        pending.append(pool.submit(render_piece_measured, piece, chars_per_line, metrics.ENABLED))
+
+        # hand over finished pieces right away, but only in order
+        while pending and (len(pending) >= max_pending or pending[0].done()):
+            yield from finished(pending.popleft())
+
+    while pending:
+        yield from finished(pending.popleft())
+
+def finished(piece: Future) -> list[list[bytes]]:
+    '''The lines of a piece rendered by a worker, recording the metrics it sent with them'''
+    rendered, measured = piece.result()
+    if measured is not None:
+        metrics.merge(measured)
+    return rendered
+
+def prerender(lines: Iterable[str], pool: ProcessPoolExecutor, chars_per_line: int,
+              piece_lines: int, max_pending: int) -> Iterator[bytes]:
+    '''
+    Render a document on a pool of workers like prerender_lines(), yielding
+    the physical lines on their own.
+
+    Returns:
+        Iterator[bytes]: the cells of each physical line, in printing order
+    '''
+    for physical_lines in prerender_lines(lines, pool, chars_per_line, piece_lines, max_pending):
+        yield from physical_lines
+
+if __name__ == "__main__":
+    with open("endpoem.txt", "r") as f:
+        document = f.read().split('\n')
+
+    expected = [cells for line in document for cells in render_string(line, 30)]
+
+    pool = start_pool(4)
+    assert(list(prerender(document, pool, 30, 16, 8)) == expected)
+    assert(list(prerender_lines(document, pool, 30, 16, 8)) == [render_string(line, 30) for line in document])
+    assert(sum(map(len, split_document(document, 16))) == len(document))
+
+    # transliterating in the workers is counted by this process's metrics
+    metrics.enable()
+    list(prerender(document, pool, 30, 16, 8))
+    assert(f'event="characters"}} {float(sum(map(len, document)))}' in metrics.render())
+    pool.shutdown()
+
+    print("All tests passed!")
@@ -0,0 +1,239 @@
+############################
+## Parses the text2type braille protocol (see protocol.md) as it arrives,
+## a chunk at a time: documents between @startdoc and @enddoc, the \@
+## escape, and blocks of @bytes that are taken as they are.
+##
+## Each connection gets its own parser, so documents from different
+## writers are never run together. Parsing is linear in what arrives,
+## and only the line being read is held on to.
+##
+## Nothing in here runs hardware.
+############################
+import codecs
+
+# kinds of protocol event
+START   = "start"    # a document starts, True if it was started by @startdoc
+LINE    = "line"     # a line of the document, without its new line
+END     = "end"      # the document ends, True if it was ended by @enddoc
+CONTROL = "control"  # a control code that isn't understood, as it was sent
+
+ProtocolEvent = tuple[str, str | bool]
+
+STARTDOC = "@startdoc"
+ENDDOC   = "@enddoc"
+BYTES    = "@bytes"
+PRIORITY = "@priority" # passed on as a CONTROL event, the daemon sets the document's priority
+
+# lines longer than this are split, so a line with no end can't take up all the memory
+MAX_LINE_BYTES = 1 << 16
+
+class DocumentParser:
+    '''
+    Turns a stream of bytes into the documents in it. Feed it chunks as they
+    arrive and it returns the events they complete.
+
+    Text outside of @startdoc and @enddoc is a document of its own, which ends
+    when the stream does (or when a @startdoc arrives), so writers that don't
+    use control codes print like they always have.
+    '''
+
+    def __init__(self, max_line_bytes: int = MAX_LINE_BYTES) -> None:
+        '''
+        Args:
+            max_line_bytes (int): longest line kept whole, longer lines are split
+        '''
+        self.max_line_bytes = max_line_bytes
+
+        self.__partial: list[bytes] = [] # the line being read
+        self.__partial_bytes = 0
+        self.__continued = False         # whether the line being read was split, so can't be a control code
+        self.__raw_bytes = 0             # bytes left of a @bytes block
+        self.__decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        self.__framed: bool | None = None # None outside of a document
+        self.__has_lines = False
+
+    @property
+    def in_document(self) -> bool:
+        '''Whether a document has started and not ended'''
+        return self.__framed is not None
+
+    def feed(self, data: bytes) -> list[ProtocolEvent]:
+        '''
+        Parse the next chunk of the stream.
+
+        Args:
+            data (bytes): the chunk, split anywhere
+        Returns:
+            list[ProtocolEvent]: the events completed by the chunk, in order
+        '''
+        events: list[ProtocolEvent] = []
+        i = 0
+
+        while i < len(data):
+            if self.__raw_bytes:
+                block = data[i:i + self.__raw_bytes]
+                i += len(block)
+                self.__raw_bytes -= len(block)
+                self.__read_lines(block, events, raw=True)
+                if not self.__raw_bytes and self.__partial_bytes:
+                    # the block ends its last line
+                    self.__line(self.__take_partial(), events, raw=True)
+                continue
+
+            i += self.__read_lines(data[i:], events, raw=False)
+
+        return events
+
+    def close(self) -> list[ProtocolEvent]:
+        '''
+        End the stream, ending the line and document being read.
+
+        Returns:
+            list[ProtocolEvent]: the events the end completes
+        '''
+        events: list[ProtocolEvent] = []
+        if self.__partial_bytes:
+            self.__line(self.__take_partial(), events, raw=self.__raw_bytes > 0)
+        self.__raw_bytes = 0
+        self.__end(False, events)
+        return events
+
+    def __read_lines(self, data: bytes, events: list[ProtocolEvent], raw: bool) -> int:
+        '''Parse the complete lines in data, keeping the rest for later. Returns how much of data was parsed.'''
+        i = 0
+        while (newline := data.find(b"\n", i)) != -1:
+            self.__partial.append(data[i:newline])
+            self.__partial_bytes += newline - i
+            i = newline + 1
+            self.__line(self.__take_partial(), events, raw)
+
+            # a @bytes block starts right after its line, so the rest is parsed as the block
+            if not raw and self.__raw_bytes:
+                return i
+
+        if i < len(data):
+            self.__partial.append(data[i:])
+            self.__partial_bytes += len(data) - i
+            if self.__partial_bytes > self.max_line_bytes:
+                self.__line(self.__take_partial(), events, raw, split=True)
+        return len(data)
+
+    def __take_partial(self) -> bytes:
+        line = b"".join(self.__partial)
+        self.__partial.clear()
+        self.__partial_bytes = 0
+        return line
+
+    def __line(self, line: bytes, events: list[ProtocolEvent], raw: bool, split: bool = False) -> None:
+        '''Handle a whole line, or a piece of a long one if split'''
+        continued, self.__continued = self.__continued, split
+        # only a whole line is a control code, the pieces of a long one are text
+        if not raw and not continued and not split and line.startswith(b"@"):
+            self.__control(line.decode("ascii", errors="replace").strip(), events)
+            return
+
+        text = self.__decoder.decode(line, final=not split)
+        if not split:
+            # trailing whitespace would only move the head
+            text = text.rstrip()
+        if not raw:
+            text = text.replace("\\@", "@")
+
+        if not self.in_document:
+            # whitespace between documents isn't a document
+            if not text.strip():
+                return
+            self.__start(False, events)
+        elif not self.__has_lines and not text.strip():
+            # nor is whitespace at the start of one
+            return
+
+        self.__has_lines = True
+        events.append((LINE, text))
+
+    def __control(self, code: str, events: list[ProtocolEvent]) -> None:
+        name, _, argument = code.partition(" ")
+        if name == STARTDOC:
+            self.__end(False, events)
+            self.__start(True, events)
+        elif name == ENDDOC:
+            self.__end(True, events)
+        elif name == BYTES and argument.strip().isdigit():
+            if not self.in_document:
+                self.__start(False, events)
+            self.__raw_bytes = int(argument)
+        else:
+            events.append((CONTROL, code))
+
+    def __start(self, framed: bool, events: list[ProtocolEvent]) -> None:
+        self.__framed = framed
+        self.__has_lines = False
+        events.append((START, framed))
+
+    def __end(self, by_enddoc: bool, events: list[ProtocolEvent]) -> None:
+        if self.in_document:
+            events.append((END, by_enddoc))
+            self.__framed = None
+
+def encode_document(text: str, length_prefixed: bool = False, priority: int = 0) -> bytes:
+    '''
+    Encode text as one document, for writers.
+
+    Args:
+        text (string): the document
+        length_prefixed (bool): send the text as a @bytes block, which is taken as it is,
+            instead of escaping every '@'
+        priority (int): the document's priority, see scheduler.py
+    Returns:
+        bytes: the document, from @startdoc to @enddoc
+    '''
+    start = f"{STARTDOC}\n" + (f"{PRIORITY} {priority}\n" if priority else "")
+    if length_prefixed:
+        body = text.encode()
+        # the block ends its last line, so @enddoc follows straight after
+        return f"{start}{BYTES} {len(body)}\n".encode() + body + f"{ENDDOC}\n".encode()
+    escaped = text.replace("@", "\\@")
+    return f"{start}{escaped}\n{ENDDOC}\n".encode()
+
+
+if __name__ == "__main__":
+    def parse(*chunks: bytes, max_line_bytes: int = MAX_LINE_BYTES) -> list[ProtocolEvent]:
+        parser = DocumentParser(max_line_bytes)
+        events = [event for chunk in chunks for event in parser.feed(chunk)]
+        return events + parser.close()
+
+    def split_everywhere(data: bytes) -> list[bytes]:
+        return [data[i:i + 1] for i in range(len(data))]
+
+    # two documents in one stream stay apart, whatever the chunks
+    stream = encode_document("hello\n@home") + encode_document("  \nsecond\\\nlast   ")
+    expected = [
+        (START, True), (LINE, "hello"), (LINE, "@home"), (END, True),
+        (START, True), (LINE, "second\\"), (LINE, "last"), (END, True),
+    ]
+    assert(parse(stream) == expected)
+    assert(parse(*split_everywhere(stream)) == expected)
+
+    # text outside of a document is a document that ends with the stream, or at the next @startdoc
+    assert(parse(b"\n\n  one\ntwo") == [(START, False), (LINE, "  one"), (LINE, "two"), (END, False)])
+    assert(parse(b"one\n@startdoc\ntwo\n") == [(START, False), (LINE, "one"), (END, False), (START, True), (LINE, "two"), (END, False)])
+
+    # a @bytes block is taken as it is, control codes, escapes, and all
+    raw = "@enddoc\nnot \\@ escaped\n\u00e9t\u00e9"
+    assert(parse(encode_document(raw, length_prefixed=True)) == [
+        (START, True), (LINE, "@enddoc"), (LINE, "not \\@ escaped"), (LINE, "\u00e9t\u00e9"), (END, True),
+    ])
+    assert(parse(*split_everywhere(encode_document(raw, length_prefixed=True))) == parse(encode_document(raw, length_prefixed=True)))
+
+    # unknown control codes are passed on, and a line that has no end is split rather than kept
+    assert(parse(b"@jam now\n") == [(CONTROL, "@jam now")])
+    assert(parse(encode_document("x", priority=-2)) == [(START, True), (CONTROL, "@priority -2"), (LINE, "x"), (END, True)])
+    assert(parse(*split_everywhere(("\u00e9" * 10 + "\n@enddoc\n").encode()), max_line_bytes=7) == [
+        (START, False), (LINE, "\u00e9" * 4), (LINE, "\u00e9" * 4), (LINE, "\u00e9" * 2), (END, True),
+    ])
+    assert(parse(*split_everywhere(b"@enddoc and more text\n"), max_line_bytes=7) == [
+        (START, False), (LINE, "@enddoc "), (LINE, "and more"), (LINE, " text"), (END, False),
+    ])
+
+    print("All tests passed!")
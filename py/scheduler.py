@@ -0,0 +1,269 @@
+############################
+## Decides which spooled job prints next. Jobs wait in a heap ordered by
+## the scheduling policy in config.toml:
+##     "fifo"      in the order they arrived
+##     "priority"  highest priority first
+##     "shortest"  shortest estimated printing time first
+##
+## Under "priority" and "shortest" a job's place improves the longer it
+## waits (aging), so long or unimportant jobs aren't put off forever.
+## Every waiting job ages at the same rate, so aging never reorders the
+## heap: a job's key is fixed when it is queued.
+##
+## Only used on the event loop. Nothing in here runs hardware.
+############################
+import asyncio
+import heapq
+import itertools
+import time
+from spool import SpoolJob
+
+FIFO     = "fifo"
+PRIORITY = "priority"
+SHORTEST = "shortest"
+POLICIES = (FIFO, PRIORITY, SHORTEST)
+
+class ScheduledJob:
+    '''A job waiting to be printed'''
+
+    def __init__(self, job: SpoolJob, cost: float | None, queued_at: float) -> None:
+        '''
+        Args:
+            job (SpoolJob): the job
+            cost (float | None): estimated seconds to print it, None if it isn't known yet
+            queued_at (float): time.monotonic() when it was queued
+        '''
+        self.job = job
+        self.cost = cost
+        self.queued_at = queued_at
+        self.key = 0.0
+        self.order = 0 # breaks ties between equal keys, and tells an entry in the heap is stale
+
+    def as_dict(self, position: int) -> dict:
+        return {"job": self.job.id, "position": position, "priority": self.job.priority, "cost": self.cost}
+
+
+class JobScheduler:
+    '''The queue of jobs waiting to be printed'''
+
+    def __init__(self, policy: str = FIFO, priority_aging: float = 0.0, shortest_aging: float = 0.0) -> None:
+        '''
+        Args:
+            policy (string): FIFO, PRIORITY, or SHORTEST
+            priority_aging (float): priority a job gains for every second it waits, under PRIORITY
+            shortest_aging (float): seconds of printing a job is let off for every second it waits, under SHORTEST
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f"JobScheduler(): unknown policy '{policy}', not one of {POLICIES}")
+        self.policy = policy
+        self.priority_aging = priority_aging
+        self.shortest_aging = shortest_aging
+
+        self.__waiting: dict[int, ScheduledJob] = {}
+        self.__heap: list[tuple[float, int, int]] = [] # (key, order, job ID)
+        self.__orders = itertools.count()
+        self.__added = asyncio.Event()
+
+        # seconds the job get() last took off the queue had waited
+        self.last_waited = 0.0
+
+        # jobs whose cost isn't known yet are taken to be as long as the longest one so far
+        self.__longest_cost = 0.0
+
+    def __len__(self) -> int:
+        return len(self.__waiting)
+
+    def __contains__(self, job_id: int) -> bool:
+        return job_id in self.__waiting
+
+    def add(self, job: SpoolJob, cost: float | None = None) -> int:
+        '''
+        Queue a job.
+
+        Args:
+            job (SpoolJob): the job
+            cost (float | None): estimated seconds to print it, None if it isn't known yet
+        Returns:
+            int: its place in the queue, 1 being next
+        '''
+        scheduled = ScheduledJob(job, cost, time.monotonic())
+        if cost is not None:
+            self.__longest_cost = max(self.__longest_cost, cost)
+        self.__waiting[job.id] = scheduled
+        self.__push(scheduled, self.__key(scheduled))
+        self.__added.set()
+        return self.position(job.id)
+
+    async def get(self) -> SpoolJob:
+        '''Wait for the job to print next, and take it off the queue'''
+        while True:
+            while self.__heap:
+                _, order, job_id = heapq.heappop(self.__heap)
+                scheduled = self.__waiting.get(job_id)
+                if scheduled is not None and scheduled.order == order:
+                    del self.__waiting[job_id]
+                    self.last_waited = time.monotonic() - scheduled.queued_at
+                    return scheduled.job
+            self.__added.clear()
+            await self.__added.wait()
+
+    def cancel(self, job_id: int) -> SpoolJob | None:
+        '''
+        Take a job off the queue without printing it.
+
+        Returns:
+            SpoolJob | None: the job, None if it isn't waiting
+        '''
+        scheduled = self.__waiting.pop(job_id, None)
+        return scheduled.job if scheduled is not None else None
+
+    def set_priority(self, job_id: int, priority: int) -> SpoolJob | None:
+        '''
+        Change a waiting job's priority, which puts it back where the policy places it.
+
+        Returns:
+            SpoolJob | None: the job, None if it isn't waiting
+        '''
+        if (scheduled := self.__waiting.get(job_id)) is None:
+            return None
+        scheduled.job.priority = priority
+        self.__push(scheduled, self.__key(scheduled))
+        return scheduled.job
+
+    def set_cost(self, job_id: int, cost: float) -> bool:
+        '''Set a waiting job's estimated cost once it is known. Returns whether it is waiting.'''
+        if (scheduled := self.__waiting.get(job_id)) is None:
+            return False
+        scheduled.cost = cost
+        self.__longest_cost = max(self.__longest_cost, cost)
+        self.__push(scheduled, self.__key(scheduled))
+        return True
+
+    def move(self, job_id: int, position: int) -> bool:
+        '''
+        Move a waiting job to a place in the queue, whatever the policy would
+        place it. Jobs queued later are still placed by the policy.
+
+        Args:
+            job_id (int): the job's ID
+            position (int): its new place in the queue, 1 being next
+        Returns:
+            bool: whether the job is waiting
+        '''
+        if (scheduled := self.__waiting.get(job_id)) is None:
+            return False
+        others = [other for other in self.ordered() if other is not scheduled]
+        index = min(max(position, 1), len(others) + 1) - 1
+
+        # a key between the jobs either side of the new place
+        if not others:
+            key = scheduled.key
+        elif index == 0:
+            key = others[0].key - 1
+        elif index == len(others):
+            key = others[-1].key + 1
+        else:
+            key = (others[index - 1].key + others[index].key) / 2
+        self.__push(scheduled, key)
+        return True
+
+    def ordered(self) -> list[ScheduledJob]:
+        '''The waiting jobs in the order they will print'''
+        return sorted(self.__waiting.values(), key=lambda scheduled: (scheduled.key, scheduled.order))
+
+    def position(self, job_id: int) -> int:
+        '''A waiting job's place in the queue, 1 being next'''
+        scheduled = self.__waiting[job_id]
+        return 1 + sum((other.key, other.order) < (scheduled.key, scheduled.order) for other in self.__waiting.values())
+
+    def __key(self, scheduled: ScheduledJob) -> float:
+        # aging takes the same off every waiting job's key every second, so
+        # only when a job was queued changes how it compares with the others
+        if self.policy == PRIORITY:
+            return -scheduled.job.priority + self.priority_aging * scheduled.queued_at
+        if self.policy == SHORTEST:
+            cost = scheduled.cost if scheduled.cost is not None else self.__longest_cost
+            return cost + self.shortest_aging * scheduled.queued_at
+        return scheduled.queued_at
+
+    def __push(self, scheduled: ScheduledJob, key: float) -> None:
+        # the job's old entry stays in the heap, and is skipped as stale when it comes up
+        scheduled.key, scheduled.order = key, next(self.__orders)
+        heapq.heappush(self.__heap, (key, scheduled.order, scheduled.job.id))
+
+        # don't let stale entries outgrow the jobs waiting
+        if len(self.__heap) > 2 * len(self.__waiting) + 16:
+            self.__heap = [(s.key, s.order, s.job.id) for s in self.__waiting.values()]
+            heapq.heapify(self.__heap)
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+
+    def job(job_id: int, priority: int = 0) -> SpoolJob:
+        new = SpoolJob(job_id, Path(f"{job_id}.txt"), False)
+        new.priority = priority
+        return new
+
+    async def drain(scheduler: JobScheduler) -> list[int]:
+        return [(await scheduler.get()).id for _ in range(len(scheduler))]
+
+    async def tests() -> None:
+        # shortest first puts the label ahead of the long job, fifo doesn't
+        for policy, expected in ((FIFO, [1, 2, 3]), (SHORTEST, [2, 3, 1])):
+            scheduler = JobScheduler(policy)
+            assert(scheduler.add(job(1), 600.0) == 1)
+            assert(scheduler.add(job(2), 5.0) == (2 if policy == FIFO else 1))
+            scheduler.add(job(3), 10.0)
+            assert(await drain(scheduler) == expected)
+
+        # higher priorities first, and a job that waited long enough gets ahead of a higher priority
+        scheduler = JobScheduler(PRIORITY)
+        scheduler.add(job(1, priority=0))
+        scheduler.add(job(2, priority=5))
+        assert(await drain(scheduler) == [2, 1])
+        scheduler = JobScheduler(PRIORITY, priority_aging=100.0)
+        scheduler.add(job(3, priority=0))
+        await asyncio.sleep(0.05)
+        scheduler.add(job(4, priority=1))
+        assert(await drain(scheduler) == [3, 4])
+        assert(0 <= scheduler.last_waited < 0.05)
+
+        # a job whose cost isn't known waits behind the known ones until it is
+        scheduler = JobScheduler(SHORTEST)
+        scheduler.add(job(1), 30.0)
+        scheduler.add(job(2))
+        scheduler.add(job(3), 60.0)
+        assert([scheduled.job.id for scheduled in scheduler.ordered()] == [1, 2, 3])
+        scheduler.set_cost(2, 1.0)
+        assert(scheduler.position(2) == 1)
+
+        # cancelled jobs never print, and moved jobs go where they were put
+        assert(scheduler.cancel(1).id == 1 and scheduler.cancel(1) is None)
+        scheduler.add(job(4), 0.5)
+        assert(scheduler.move(3, 1) and not scheduler.move(99, 1))
+        assert(scheduler.move(4, 2))
+        assert([scheduled.as_dict(i)["job"] for i, scheduled in enumerate(scheduler.ordered(), 1)] == [3, 4, 2])
+        assert(await drain(scheduler) == [3, 4, 2])
+
+        # get() waits for a job to be added
+        waiting = asyncio.create_task(scheduler.get())
+        await asyncio.sleep(0)
+        assert(not waiting.done())
+        scheduler.add(job(5))
+        assert((await asyncio.wait_for(waiting, 1)).id == 5)
+
+        # stale entries from many changes don't pile up
+        scheduler.add(job(6))
+        for priority in range(1000):
+            scheduler.set_cost(6, priority)
+        assert(await drain(scheduler) == [6])
+
+        try:
+            JobScheduler("lottery")
+            assert(False)
+        except ValueError:
+            pass
+
+    asyncio.run(tests())
+    print("All tests passed!")
@@ -0,0 +1,209 @@
+############################
+## A simulated printer. It keeps track of where the steppers are, records
+## every step and firing, and draws the dots it punched. Time is virtual,
+## so a page that takes minutes on paper simulates in well under a second.
+##
+## Run it to print a test line on the simulator:
+##     python3 simulator.py
+############################
+import threading
+from typing import Any
+from hardware import PrinterHardware
+from stepping import Clock, FORWARD, BACKWARD
+
+class VirtualClock(Clock):
+    '''
+    Time that only passes when something sleeps. Every thread keeps its own
+    time, and StepperMove passes it along when a thread starts or waits on a
+    move, so steppers running side by side overlap like they would for real.
+    '''
+
+    def __init__(self) -> None:
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.elapsed = 0.0 # latest time any thread has reached
+
+    def now(self) -> float:
+        return getattr(self.__local, "time", 0.0)
+
+    def sleep_until(self, deadline: float) -> None:
+        if deadline > self.now():
+            self.__local.time = deadline
+            with self.__lock:
+                self.elapsed = max(self.elapsed, deadline)
+
+    def sleep(self, seconds: float) -> None:
+        self.sleep_until(self.now() + seconds)
+
+
+class SimulatedStepper:
+    '''A stepper that counts its steps, each taking step_seconds of virtual time'''
+
+    def __init__(self, clock: Clock, step_seconds: float, forward: int, position: int = 0, minimum: int | None = None) -> None:
+        '''
+        Args:
+            clock (Clock): the simulation's clock
+            step_seconds (float): how long one step takes, like the I2C writes of a real step
+            forward (int): the direction, FORWARD or BACKWARD, that counts up
+            position (int): where it starts
+            minimum (int | None): where it stops against the end of its travel, if anywhere
+        '''
+        self.clock = clock
+        self.step_seconds = step_seconds
+        self.forward = forward
+        self.position = position
+        self.minimum = minimum
+        self.steps = 0
+        self.reversals = 0
+        self.__last_direction = 0
+
+    def onestep(self, direction: int = FORWARD, style: int | None = None) -> None:
+        self.clock.sleep(self.step_seconds)
+        self.steps += 1
+        if self.__last_direction not in (0, direction):
+            self.reversals += 1
+        self.__last_direction = direction
+
+        self.position += 1 if direction == self.forward else -1
+        if self.minimum is not None:
+            self.position = max(self.position, self.minimum)
+
+    def release(self) -> None:
+        pass
+
+
+class SimulatedSolenoid:
+    '''A solenoid that punches a dot where the head is if it is powered for long enough'''
+
+    def __init__(self, hardware: "SimulatedHardware", row: int) -> None:
+        self.hardware = hardware
+        self.row = row
+        self.__started_at: float | None = None
+
+    def start(self, duty_cycle: float) -> None:
+        self.__started_at = self.hardware.clock.now()
+
+    def stop(self) -> None:
+        if self.__started_at is None:
+            return
+        self.hardware.fire(self.row, self.hardware.clock.now() - self.__started_at)
+        self.__started_at = None
+
+
+class SimulatedHardware(PrinterHardware):
+    '''
+    A printer that only exists in memory. The print head starts some way from
+    the home button, which is pressed once the head is back at position 0.
+
+    Directions match how the real printer is wired: the head moves away from
+    home stepping BACKWARD, and the paper feeds stepping BACKWARD.
+    '''
+
+    def __init__(self, step_seconds: float = 0.0, min_pulse: float = 0.0, head_start_steps: int = 0) -> None:
+        '''
+        Args:
+            step_seconds (float): how long one step takes
+            min_pulse (float): shortest solenoid pulse that punches a dot, in seconds
+            head_start_steps (int): how far from the home button the print head starts
+        '''
+        self.clock = VirtualClock()
+        self.head_stepper = SimulatedStepper(self.clock, step_seconds, BACKWARD, head_start_steps, minimum=0)
+        self.paper_stepper = SimulatedStepper(self.clock, step_seconds, BACKWARD)
+        self.solenoids = [SimulatedSolenoid(self, row) for row in range(3)]
+        self.min_pulse = min_pulse
+
+        # (paper position, head position, solenoid) of every dot punched
+        self.dots: list[tuple[int, int, int]] = []
+        self.firings = 0
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "SimulatedHardware":
+        '''Build the simulator from the [SIMULATOR] section of config.toml'''
+        return cls(
+            config["SIMULATOR"]["STEP_SECONDS"],
+            config["SIMULATOR"]["MIN_PULSE"],
+            config["SIMULATOR"]["HEAD_START_STEPS"],
+        )
+
+    def home_pressed(self) -> bool:
+        return self.head_stepper.position <= 0
+
+    def fire(self, row: int, pulse: float) -> None:
+        '''Record a solenoid being powered for pulse seconds'''
+        self.firings += 1
+        if pulse >= self.min_pulse:
+            self.dots.append((self.paper_stepper.position, self.head_stepper.position, row))
+
+    def stats(self) -> dict[str, float]:
+        '''How long the printing took in virtual seconds, and how much hardware it took'''
+        return {
+            "seconds": self.clock.elapsed,
+            "head_steps": self.head_stepper.steps,
+            "head_reversals": self.head_stepper.reversals,
+            "paper_steps": self.paper_stepper.steps,
+            "firings": self.firings,
+            "dots": len(self.dots),
+        }
+
+    def render_dots(self, column_steps: float, mirror: bool = False) -> str:
+        '''
+        Draw the punched dots, 'o' for a dot and '.' for none, as seen from the
+        side that is punched. Each line of braille is three rows, one per solenoid.
+
+        Args:
+            column_steps (float): head steps per column drawn, like HALF_CHAR_STEPS
+            mirror (bool): draw it as seen from the other side, which is the side that is read
+        Returns:
+            string: the drawing, with a blank row between lines of braille
+        '''
+        if not self.dots:
+            return ""
+
+        lines = sorted({paper for paper, _, _ in self.dots})
+        columns = [round(head / column_steps) for _, head, _ in self.dots]
+        first, width = min(columns), max(columns) - min(columns) + 1
+
+        grid = [["."] * width for _ in range(3 * len(lines))]
+        for (paper, _, row), column in zip(self.dots, columns):
+            grid[3 * lines.index(paper) + row][column - first] = "o"
+
+        rows = ["".join(reversed(cells) if mirror else cells) for cells in grid]
+        return "\n\n".join("\n".join(rows[i:i + 3]) for i in range(0, len(rows), 3))
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    import control
+    from control import BraillePrinterDriver
+    from planner import FIRE
+
+    hardware = SimulatedHardware(step_seconds=0.001, min_pulse=0.01, head_start_steps=500)
+    control.DEBUG = False
+    driver = BraillePrinterDriver(hardware)
+
+    start = perf_counter()
+    driver.print_lines(["and the"])
+    real_seconds = perf_counter() - start
+
+    # "and the" contracts to "& !", read from the back: '&' is dots 1-2-3-4-6, '!' is dots 2-3-4-6
+    drawing = hardware.render_dots(driver.HALF_CHAR_STEPS, mirror=True)
+    assert(drawing.split("\n") == [
+        "oo.......o",
+        "o.......o.",
+        "oo......oo",
+    ])
+    assert(hardware.home_pressed() is False and hardware.head_stepper.steps > 500)
+
+    # one firing per solenoid per half, and every half is its own firing
+    fires = [value for kind, value in driver.planner.plan(driver.planner.layout(driver.render_string("and the")[0])) if kind == FIRE]
+    assert(hardware.firings == sum(bin(mask).count("1") for mask in fires) == len(hardware.dots))
+
+    # a pulse too short to punch still fires, but leaves no dot
+    driver.pulse_solenoid(0, 0.001)
+    assert(hardware.firings == len(hardware.dots) + 1)
+
+    stats = hardware.stats()
+    assert(stats["seconds"] > 10 * real_seconds)
+    print(drawing)
+    print(f"{stats} in {real_seconds:.3f} real seconds")
+    print("All tests passed!")
@@ -0,0 +1,340 @@
+############################
+## The spool: print jobs kept on disk until they are printed, so none are
+## lost when the daemon stops, jams, or loses power.
+##
+## Every job's text is a file in the spool directory, which is read back
+## with mmap while it prints rather than held in memory. The journal is
+## an append-only log of jobs being queued and done.
+## How far each job has printed is kept in a small checkpoint file of its
+## own, rewritten in place after every line, so the journal only grows by
+## a few records per job and recovery reads a few records per job.
+##
+## Nothing in here runs hardware.
+############################
+import json
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Iterator
+
+JOURNAL = "journal.log"
+
+# (byte offset to resume reading the text from, physical lines of that line already printed)
+CHECKPOINT = struct.Struct("<QQ")
+
+class SpoolJob:
+    '''A job in the spool'''
+
+    def __init__(self, job_id: int, path: Path, eject: bool) -> None:
+        '''
+        Args:
+            job_id (int): the job's ID, unique for as long as the spool directory is kept
+            path (Path): the file the job's text is in
+            eject (bool): eject the paper once the job is printed
+        '''
+        self.id = job_id
+        self.path = path
+        self.eject = eject
+        self.priority = 0 # higher prints sooner, see scheduler.py
+        self.estimate = None # PrintEstimate of what was left to print when it was estimated, see estimator.py
+
+        # whether all of the text has arrived, readers wait for more until it has
+        self.complete = False
+        self.offset = 0
+        self.skip = 0
+
+        self.grown = threading.Condition()
+        self.text_fd: int | None = None
+        self.checkpoint_fd: int | None = None
+
+    @property
+    def checkpoint_path(self) -> Path:
+        return self.path.with_suffix(".pos")
+
+
+class Spool:
+    '''The jobs in a spool directory'''
+
+    def __init__(self, directory: Path) -> None:
+        '''
+        Args:
+            directory (Path): where the spool is kept, made if need be
+        '''
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.__next_id = 1
+        self.__journal = None
+
+    def recover(self) -> list[SpoolJob]:
+        '''
+        Read back the jobs that hadn't been printed when the daemon last
+        stopped, and start a new journal with only them in it. Text of jobs that
+        never got queued is deleted, and jobs whose text is gone are dropped.
+        Jobs that were still arriving are taken as they are, since whoever was
+        sending them is gone.
+
+        Returns:
+            list[SpoolJob]: the jobs, in the order they were queued, each from its checkpoint
+        '''
+        jobs: dict[int, SpoolJob] = {}
+        journal_path = self.directory / JOURNAL
+        if journal_path.exists():
+            with open(journal_path, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                        job_id = record["job"]
+                    except (ValueError, KeyError, TypeError):
+                        continue # a record torn by a crash
+                    # "next" is the ID to give out next, not a job's
+                    self.__next_id = max(self.__next_id, job_id + (record["event"] != "next"))
+
+                    if record["event"] == "queued":
+                        jobs[job_id] = SpoolJob(job_id, self.__text_path(job_id), record["eject"])
+                        jobs[job_id].priority = record.get("priority", 0)
+                    elif record["event"] == "priority" and job_id in jobs:
+                        jobs[job_id].priority = record["priority"]
+                    elif record["event"] == "done":
+                        jobs.pop(job_id, None)
+
+        # a job queued from another spool, or whose text was deleted by hand, can't be printed
+        jobs = {job_id: job for job_id, job in jobs.items() if job.path.exists()}
+
+        for job in jobs.values():
+            job.complete = True
+            try:
+                job.offset, job.skip = CHECKPOINT.unpack(job.checkpoint_path.read_bytes())
+            except (OSError, struct.error):
+                pass
+
+        # delete whatever isn't part of a job that is left
+        keep = {path for job in jobs.values() for path in (job.path, job.checkpoint_path)}
+        for path in self.directory.iterdir():
+            if path.suffix in (".txt", ".pos") and path not in keep:
+                path.unlink()
+
+        # the new journal starts with the jobs left, and the next ID so IDs aren't reused
+        records = [{"event": "next", "job": self.__next_id}]
+        records += [{"event": "queued", "job": job.id, "eject": job.eject, "priority": job.priority} for job in jobs.values()]
+        tmp_path = journal_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as journal:
+            journal.writelines(json.dumps(record) + "\n" for record in records)
+            journal.flush()
+            os.fsync(journal.fileno())
+        tmp_path.replace(journal_path)
+        self.__sync_directory()
+
+        self.__journal = open(journal_path, "a")
+        return list(jobs.values())
+
+    def create(self, eject: bool = False) -> SpoolJob:
+        '''
+        Start a job whose text is still to arrive. It is only kept over a
+        restart once it is queued.
+
+        Args:
+            eject (bool): eject the paper once the job is printed
+        Returns:
+            SpoolJob: the new job
+        '''
+        job = SpoolJob(self.__next_id, self.__text_path(self.__next_id), eject)
+        self.__next_id += 1
+        job.text_fd = os.open(job.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+        return job
+
+    def append(self, job: SpoolJob, lines: list[str]) -> None:
+        '''Add lines to the text of a job, which readers waiting on it then get'''
+        if job.text_fd is None:
+            return # the job was cancelled while it was arriving
+        os.write(job.text_fd, "".join(line + "\n" for line in lines).encode())
+        with job.grown:
+            job.grown.notify_all()
+
+    def queue(self, job: SpoolJob) -> None:
+        '''Record a job as queued, so it is printed even if the daemon restarts'''
+        # the text that has arrived, and the file itself, have to outlast a power loss before the record does
+        if job.text_fd is not None:
+            os.fsync(job.text_fd)
+        self.__sync_directory()
+        self.__record({"event": "queued", "job": job.id, "eject": job.eject, "priority": job.priority})
+
+    def prioritize(self, job: SpoolJob, priority: int) -> None:
+        '''Change a job's priority, and record it for after a restart'''
+        job.priority = priority
+        self.__record({"event": "priority", "job": job.id, "priority": priority})
+
+    def close(self, job: SpoolJob) -> None:
+        '''Record that all of a job's text has arrived'''
+        if job.text_fd is not None:
+            os.fsync(job.text_fd)
+            os.close(job.text_fd)
+            job.text_fd = None
+        with job.grown:
+            job.complete = True
+            job.grown.notify_all()
+
+    def lines(self, job: SpoolJob, start: int | None = None, end: int | None = None) -> Iterator[tuple[int, int, str]]:
+        '''
+        Read a job's lines with mmap, waiting for more until all of its text has arrived.
+
+        Args:
+            job (SpoolJob): the job
+            start (int | None): byte offset of the first line, by default the job's checkpoint
+            end (int | None): byte offset to stop at, by default the end of the job
+        Returns:
+            Iterator[tuple[int, int, string]]: the byte offsets of the start and end of each line, and the line
+        '''
+        position = job.offset if start is None else start
+        text: mmap.mmap | None = None
+        try:
+            with open(job.path, "rb") as f:
+                while end is None or position < end:
+                    newline = text.find(b"\n", position) if text is not None else -1
+                    if newline != -1:
+                        yield position, newline + 1, text[position:newline].decode("utf-8", errors="replace")
+                        position = newline + 1
+                        continue
+
+                    # map the text again if it has grown since it was mapped
+                    mapped = len(text) if text is not None else 0
+                    if os.fstat(f.fileno()).st_size > mapped:
+                        if text is not None:
+                            text.close()
+                        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        continue
+
+                    with job.grown:
+                        finished = job.complete and os.fstat(f.fileno()).st_size == mapped
+                        if not finished:
+                            job.grown.wait_for(lambda: job.complete or os.fstat(f.fileno()).st_size > mapped)
+                    if finished:
+                        # a crash can leave the last line without its new line
+                        if position < mapped:
+                            yield position, mapped, text[position:].decode("utf-8", errors="replace")
+                        break
+        finally:
+            if text is not None:
+                text.close()
+
+    def checkpoint(self, job: SpoolJob, offset: int, skip: int = 0) -> None:
+        '''
+        Record how far a job has printed, to resume from after a restart.
+
+        Args:
+            job (SpoolJob): the job
+            offset (int): byte offset of the first line not completely printed
+            skip (int): physical lines of that line already printed
+        '''
+        if job.checkpoint_fd is None:
+            job.checkpoint_fd = os.open(job.checkpoint_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        # small enough to always be written whole
+        os.pwrite(job.checkpoint_fd, CHECKPOINT.pack(offset, skip), 0)
+        os.fdatasync(job.checkpoint_fd)
+        job.offset, job.skip = offset, skip
+
+    def finish(self, job: SpoolJob) -> None:
+        '''Record a job as done, printed or not, and delete it'''
+        self.__record({"event": "done", "job": job.id})
+        self.discard(job)
+
+    def discard(self, job: SpoolJob) -> None:
+        '''Delete a job that was never queued. Anything still arriving for it is dropped.'''
+        for fd in (job.text_fd, job.checkpoint_fd):
+            if fd is not None:
+                os.close(fd)
+        job.text_fd = job.checkpoint_fd = None
+        for path in (job.path, job.checkpoint_path):
+            path.unlink(missing_ok=True)
+
+        # readers waiting for more of it stop waiting
+        with job.grown:
+            job.complete = True
+            job.grown.notify_all()
+
+    def close_journal(self) -> None:
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+
+    def __record(self, record: dict) -> None:
+        self.__journal.write(json.dumps(record) + "\n")
+        self.__journal.flush()
+        os.fsync(self.__journal.fileno())
+
+    def __text_path(self, job_id: int) -> Path:
+        return self.directory / f"{job_id}.txt"
+
+    def __sync_directory(self) -> None:
+        '''Make renames and new files in the directory last through a power loss'''
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        spool = Spool(Path(tmp))
+        assert(spool.recover() == [])
+
+        # a job is read as it arrives, and the reader waits for the rest
+        first = spool.create(eject=True)
+        spool.queue(first)
+        spool.prioritize(first, 3)
+        spool.append(first, ["one", "two"])
+        read: list[str] = []
+        reader = threading.Thread(target=lambda: read.extend(line for _, _, line in spool.lines(first)))
+        reader.start()
+        spool.append(first, ["thrée"])
+        spool.close(first)
+        reader.join(5)
+        assert(read == ["one", "two", "thrée"])
+
+        # offsets resume a job part way through
+        offsets = [(start, end) for start, end, _ in spool.lines(first)]
+        assert(offsets == [(0, 4), (4, 8), (8, 15)])
+        spool.checkpoint(first, 4, 1)
+
+        # a job that finished, and one that never got queued, aren't recovered
+        done = spool.create()
+        spool.queue(done)
+        spool.close(done)
+        spool.finish(done)
+        unqueued = spool.create()
+        spool.append(unqueued, ["never queued"])
+
+        # nor one whose text is gone
+        lost = spool.create()
+        spool.queue(lost)
+        spool.close(lost)
+        spool.checkpoint(lost, 0)
+        lost.path.unlink()
+
+        # neither is a record torn by a crash
+        spool.close_journal()
+        with open(Path(tmp) / JOURNAL, "a") as journal:
+            journal.write('{"event": "queued", "jo')
+
+        spool = Spool(Path(tmp))
+        jobs = spool.recover()
+        assert([(job.id, job.eject, job.priority, job.offset, job.skip) for job in jobs] == [(first.id, True, 3, 4, 1)])
+        assert([line for _, _, line in spool.lines(jobs[0])] == ["two", "thrée"])
+        assert(sorted(path.name for path in Path(tmp).iterdir()) == [f"{first.id}.pos", f"{first.id}.txt", JOURNAL])
+
+        # IDs carry on from the last one given out before the restart, and the journal only holds what is left
+        assert(spool.create().id == lost.id + 1)
+        assert(len((Path(tmp) / JOURNAL).read_text().splitlines()) == 2)
+        spool.close_journal()
+
+        # and recovering again doesn't use any up
+        spool = Spool(Path(tmp))
+        spool.recover()
+        assert(spool.create().id == lost.id + 1)
+        spool.close_journal()
+
+    print("All tests passed!")
@@ -0,0 +1,251 @@
+############################
+## Publishes the daemon's status on the status message queue as JSON
+## events, {"topic": ..., ...}, without ever waiting on whoever reads it.
+##
+## Every topic has one slot for each job holding its latest event (one
+## in all for events not about a job, like "jobs"). A newer event replaces
+## one of the same job that hasn't been sent yet, so a reader that falls
+## behind gets what is true now rather than a backlog, and the printer
+## never waits on it, but the last event of a job is never replaced by
+## the next job's. Each topic is sent at most max_rate times a second.
+##
+## Topics:
+##     "jobs"      the jobs waiting to print, see JobScheduler.ordered()
+##     "estimate"  the latest job estimated, see PrintEstimate
+##     "progress"  the job printing, see JobProgress
+##
+## Nothing in here runs hardware.
+############################
+import asyncio
+import json
+import threading
+from typing import Any
+from DriverCommunicator import BrailleDriverCommunicator
+
+class StatusPublisher:
+    '''Sends the latest event of every topic as a status, as soon and as often as it may'''
+
+    def __init__(self, communicator: BrailleDriverCommunicator, max_rate: float = 0.0) -> None:
+        '''
+        Args:
+            communicator (BrailleDriverCommunicator): the status queue
+            max_rate (float): most events a second of each topic, 0 for no limit
+        '''
+        self.communicator = communicator
+        self.interval = 1 / max_rate if max_rate > 0 else 0.0
+
+        self.__lock = threading.Lock()
+        self.__slots: dict[tuple[str, Any], str] = {}  # (topic, job) -> latest event not sent yet
+        self.__last_sent: dict[str, float] = {}        # topic -> loop.time() it was last sent
+        self.__loop: asyncio.AbstractEventLoop | None = None
+        self.__flush_scheduled = False
+        self.__timer: asyncio.TimerHandle | None = None
+        self.__waiting_for_room = False
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        '''Start sending on an event loop, beginning with anything published before'''
+        self.__loop = loop
+        self.__schedule_flush()
+
+    def stop(self) -> None:
+        '''Send what can be sent straight away, whatever the rate, and stop sending'''
+        if self.__loop is None:
+            return
+        self.__stop_waiting()
+        with self.__lock:
+            for slot in list(self.__slots):
+                if not self.communicator.write_status(self.__slots[slot]):
+                    break
+                del self.__slots[slot]
+        self.__loop = None
+
+    def publish(self, topic: str, event: dict[str, Any]) -> None:
+        '''
+        Publish an event, replacing the last of its topic and job if that hasn't
+        been sent yet. Never waits, and can be called from any thread.
+
+        Args:
+            topic (string): what the event is about
+            event (dict[str, Any]): the event, which is sent as JSON with "topic" added. Its "job", if
+                it has one, keeps it from replacing events of other jobs
+        Returns:
+            None
+        '''
+        message = json.dumps({"topic": topic, **event})
+        with self.__lock:
+            self.__slots[(topic, event.get("job"))] = message
+        self.__schedule_flush()
+
+    def __schedule_flush(self) -> None:
+        with self.__lock:
+            if self.__loop is None or self.__flush_scheduled:
+                return
+            self.__flush_scheduled = True
+        self.__loop.call_soon_threadsafe(self.__flush)
+
+    def __flush(self) -> None:
+        '''Send every topic that is due, on the event loop'''
+        if self.__loop is None:
+            return
+        self.__stop_waiting()
+        now = self.__loop.time()
+        next_due = None
+
+        with self.__lock:
+            self.__flush_scheduled = False
+            sent: set[str] = set()
+            try:
+                # slots are sent in the order they were filled, so a topic's events keep their order
+                for slot in list(self.__slots):
+                    topic = slot[0]
+                    due = self.__last_sent.get(topic, -self.interval) + self.interval
+                    if due > now and topic not in sent:
+                        next_due = due if next_due is None else min(next_due, due)
+                        continue
+                    if not self.communicator.write_status(self.__slots[slot]):
+                        # the queue is full, so wait until a reader makes room
+                        self.__loop.add_writer(self.communicator.status_mq.mqd, self.__flush)
+                        self.__waiting_for_room = True
+                        return
+                    del self.__slots[slot]
+                    sent.add(topic)
+            finally:
+                for topic in sent:
+                    self.__last_sent[topic] = now
+
+        if next_due is not None:
+            self.__timer = self.__loop.call_at(next_due, self.__flush)
+
+    def __stop_waiting(self) -> None:
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if self.__waiting_for_room:
+            self.__loop.remove_writer(self.communicator.status_mq.mqd)
+            self.__waiting_for_room = False
+
+
+class JobProgress:
+    '''How far the job printing has got, for "progress" events. Only used on the hardware thread.'''
+
+    def __init__(self, job_id: int) -> None:
+        self.job_id = job_id
+        self.lines = 0
+        self.cells = 0
+        self.seconds = 0.0 # spent printing lines, not counting pauses
+
+    def line_printed(self, cells: bytes, seconds: float) -> None:
+        '''Count a physical line that took so many seconds to print'''
+        self.lines += 1
+        self.cells += len(cells.rstrip(b"\x00"))
+        self.seconds += seconds
+
+    def event(self, state: str, estimate=None) -> dict[str, Any]:
+        '''
+        The job's progress as an event.
+
+        Args:
+            state (string): "printing", "paused", "done", "cancelled", "failed" when its text can't be read,
+                or "stopped" when the daemon is shutting down
+            estimate (PrintEstimate | None): the estimate of the job, if it has one
+        Returns:
+            dict[str, Any]: the event, with the estimate's lines as the total, and the time left at the
+                speed printed so far (or as estimated, until a line is printed)
+        '''
+        lines_total = estimate.lines if estimate is not None else None
+        if lines_total is None:
+            eta_seconds = None
+        elif self.lines == 0:
+            eta_seconds = estimate.seconds
+        else:
+            eta_seconds = max(lines_total - self.lines, 0) * self.seconds / self.lines
+        return {
+            "job": self.job_id,
+            "state": state,
+            "lines_done": self.lines,
+            "lines_total": lines_total,
+            "cells_per_minute": 60 * self.cells / self.seconds if self.seconds > 0 else 0.0,
+            "eta_seconds": eta_seconds,
+        }
+
+
+if __name__ == "__main__":
+    import posix_ipc
+    from estimator import PrintEstimate
+
+    progress = JobProgress(7)
+    estimate = PrintEstimate(seconds=40.0, lines=4, pages=1, cells=0, firings=0, phases={}, raw_phases={})
+    assert(progress.event("printing", estimate)["eta_seconds"] == 40.0)
+    progress.line_printed(b"\x01\x02\x00\x00", 15.0)
+    assert(progress.event("printing", estimate) == {
+        "job": 7, "state": "printing", "lines_done": 1, "lines_total": 4, "cells_per_minute": 8.0, "eta_seconds": 45.0,
+    })
+    assert(progress.event("paused")["eta_seconds"] is None)
+
+    class TestCommunicator(BrailleDriverCommunicator):
+        STATUS_QUEUE = "/text2touch_status_test"
+        COMMAND_QUEUE = "/text2touch_command_test"
+
+    async def tests() -> None:
+        loop = asyncio.get_running_loop()
+        communicator = TestCommunicator()
+        status = StatusPublisher(communicator, max_rate=10)
+        status.start(loop)
+
+        def received() -> list[dict]:
+            events = []
+            while True:
+                try:
+                    events.append(json.loads(communicator.status_mq.receive(0)[0]))
+                except posix_ipc.BusyError:
+                    return events
+
+        # the latest of a topic replaces the ones not sent yet, and topics are sent at most max_rate times a second
+        for lines in range(100):
+            status.publish("progress", {"lines_done": lines})
+        status.publish("jobs", {"jobs": []})
+        await asyncio.sleep(0.01)
+        assert(received() == [{"topic": "progress", "lines_done": 99}, {"topic": "jobs", "jobs": []}])
+        status.publish("progress", {"lines_done": 100})
+        await asyncio.sleep(0.01)
+        assert(received() == [])
+        await asyncio.sleep(0.1)
+        assert(received() == [{"topic": "progress", "lines_done": 100}])
+
+        # a full queue doesn't hold anything up, and the latest is sent once there is room
+        filler = 0
+        while communicator.write_status("filler"):
+            filler += 1
+        await asyncio.sleep(0.1)
+        for lines in range(5):
+            status.publish("progress", {"lines_done": lines})
+        await asyncio.sleep(0.2)
+        communicator.status_mq.receive(0)
+        await asyncio.sleep(0.01)
+        messages = [communicator.status_mq.receive(0)[0].decode() for _ in range(filler)]
+        assert(json.loads(messages[-1]) == {"topic": "progress", "lines_done": 4})
+
+        # the end of a job isn't replaced by the next job, or its estimate by the next estimate
+        await asyncio.sleep(0.1)
+        status.publish("progress", {"job": 1, "state": "printing"})
+        status.publish("progress", {"job": 1, "state": "cancelled"})
+        status.publish("progress", {"job": 2, "state": "printing"})
+        status.publish("estimate", {"job": 1})
+        status.publish("estimate", {"job": 2})
+        await asyncio.sleep(0.01)
+        assert(received() == [
+            {"topic": "progress", "job": 1, "state": "cancelled"}, {"topic": "progress", "job": 2, "state": "printing"},
+            {"topic": "estimate", "job": 1}, {"topic": "estimate", "job": 2},
+        ])
+        await asyncio.sleep(0.1)
+
+        # events published from other threads get sent too
+        await asyncio.to_thread(status.publish, "estimate", {"job": 1})
+        await asyncio.sleep(0.01)
+        assert(received() == [{"topic": "estimate", "job": 1}])
+
+        status.stop()
+        communicator.stop()
+
+    asyncio.run(tests())
+    print("All tests passed!")
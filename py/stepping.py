@@ -0,0 +1,299 @@
+############################
+## Steps stepper motors on their own threads, timing every step
+## against a velocity profile so moves can ramp up and down.
+##
+## Nothing in here knows about the motor hat, an axis only needs
+## a motor with onestep() and release(). Motors that can also run()
+## a whole move themselves, like native.NativeStepper, are given
+## each move in one call.
+############################
+import math
+import os
+import threading
+from queue import Queue
+from time import perf_counter, sleep
+from typing import Any, Callable
+
+# step directions and style, the same values as adafruit_motor.stepper
+FORWARD   = 1
+BACKWARD  = 2
+MICROSTEP = 4
+
+# how long before a step's deadline to stop sleeping and spin instead,
+# sleep() on its own overshoots by more than a step at full speed
+SPIN_SECONDS = 0.0005
+
+class Clock:
+    '''
+    Where the driver's timing comes from. This one is the real time; the
+    simulator swaps in a virtual clock so nothing actually has to wait.
+    '''
+
+    def now(self) -> float:
+        '''Seconds since some fixed point, like perf_counter()'''
+        return perf_counter()
+
+    def sleep_until(self, deadline: float) -> None:
+        '''Sleep until now() reaches deadline, as close to it as possible'''
+        remaining = deadline - perf_counter()
+        if remaining > SPIN_SECONDS:
+            sleep(remaining - SPIN_SECONDS)
+        while perf_counter() < deadline:
+            pass
+
+    def sleep(self, seconds: float) -> None:
+        sleep(seconds)
+
+class VelocityProfile:
+    '''How fast an axis steps over the course of a move'''
+
+    NONE        = "none"         # step as fast as the motor can be driven
+    TRAPEZOIDAL = "trapezoidal"  # constant acceleration up to max_speed and back down
+    S_CURVE     = "s-curve"      # acceleration eases in and out, gentler on the mechanics
+
+    def __init__(self, kind: str, max_speed: float, acceleration: float, start_speed: float) -> None:
+        '''
+        Args:
+            kind (str): NONE, TRAPEZOIDAL, or S_CURVE
+            max_speed (float): fastest speed, in steps per second
+            acceleration (float): average acceleration, in steps per second squared
+            start_speed (float): speed a move starts and ends at, in steps per second
+        '''
+        if kind not in (self.NONE, self.TRAPEZOIDAL, self.S_CURVE):
+            raise ValueError(f"VelocityProfile(): unknown profile '{kind}'")
+
+        self.kind = kind
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.start_speed = min(start_speed, max_speed)
+
+        # steps it takes to get from start_speed to max_speed
+        self.ramp_steps = math.ceil((self.max_speed ** 2 - self.start_speed ** 2) / (2 * self.acceleration))
+        self.__intervals: dict[int, list[float]] = {}
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any], axis: str) -> "VelocityProfile":
+        '''Build the profile of an axis from the [STEPPERS] section of config.toml'''
+        return cls(
+            config[f"{axis}_PROFILE"],
+            config[f"{axis}_MAX_SPEED"],
+            config[f"{axis}_ACCELERATION"],
+            config[f"{axis}_START_SPEED"],
+        )
+
+    def speed_at(self, steps_from_end: int) -> float:
+        '''Speed in steps per second this many steps from the nearer end of a move'''
+        if steps_from_end >= self.ramp_steps:
+            return self.max_speed
+
+        if self.kind == self.TRAPEZOIDAL:
+            return math.sqrt(self.start_speed ** 2 + 2 * self.acceleration * steps_from_end)
+
+        # smoothstep between the start and max speeds
+        f = steps_from_end / self.ramp_steps
+        return self.start_speed + (self.max_speed - self.start_speed) * (3 * f ** 2 - 2 * f ** 3)
+
+    def intervals(self, steps: int) -> list[float]:
+        '''
+        Seconds from each step of a move to the next. Short moves never reach
+        max_speed; they ramp up halfway and back down.
+
+        Args:
+            steps (int): how many steps the move is
+        Returns:
+            list[float]: one interval per step
+        '''
+        if self.kind == self.NONE:
+            return [0.0] * steps
+
+        if (intervals := self.__intervals.get(steps)) is None:
+            intervals = [1 / self.speed_at(min(i, steps - 1 - i)) for i in range(steps)]
+            self.__intervals[steps] = intervals
+        return intervals
+
+
+class StepperMove:
+    '''
+    A move handed to a StepperAxis, which can be waited on.
+
+    It starts no earlier than it was queued and whoever waits on it carries on
+    no earlier than it finished, by the clock. With the real clock that is
+    always true already; with the simulator's it is how time is passed between threads.
+    '''
+
+    def __init__(self, steps: int | None, direction: int, release: bool, clock: Clock,
+                 stop: Callable[[], bool] | None = None) -> None:
+        self.steps = steps
+        self.direction = direction
+        self.release = release
+        self.clock = clock
+        self.stop = stop
+        self.steps_taken = 0
+        self.error: Exception | None = None
+        self.queued_at = clock.now()
+        self.finished_at = self.queued_at
+        self.__done = threading.Event()
+
+    def finish(self, error: Exception | None = None) -> None:
+        self.error = error
+        self.finished_at = self.clock.now()
+        self.__done.set()
+
+    def done(self) -> bool:
+        return self.__done.is_set()
+
+    def wait(self) -> int:
+        '''
+        Block until the move is done.
+
+        Returns:
+            int: how many steps were taken
+        '''
+        self.__done.wait()
+        self.clock.sleep_until(self.finished_at)
+        if self.error is not None:
+            raise self.error
+        return self.steps_taken
+
+
+class StepperAxis:
+    '''
+    One stepper motor driven by its own thread. Moves are queued and run one
+    after another, each step at a deadline from the axis' velocity profile.
+    '''
+
+    def __init__(self, motor: Any, profile: VelocityProfile, style: int, name: str = "axis", clock: Clock = Clock()) -> None:
+        '''
+        Args:
+            motor (Any): the stepper, anything with onestep(direction=, style=) and release()
+            profile (VelocityProfile): how fast to step
+            style (int): step style to pass to onestep(), like MICROSTEP
+            name (str): name of the stepping thread
+            clock (Clock): what steps are timed by
+        '''
+        self.motor = motor
+        self.profile = profile
+        self.style = style
+        self.clock = clock
+        self.__moves: Queue[StepperMove] = Queue()
+        self.__last_move: StepperMove | None = None
+
+        threading.Thread(target=self.__run, name=name, daemon=True).start()
+
+    def move(self, steps: int, direction: int, release: bool = True) -> StepperMove:
+        '''
+        Queue a move and return without waiting for it.
+
+        Args:
+            steps (int): how many steps to take
+            direction (int): direction to pass to onestep(), like FORWARD
+            release (bool): release the motor afterwards, otherwise it keeps holding torque
+        Returns:
+            StepperMove: the queued move
+        '''
+        return self.__queue(StepperMove(steps, direction, release, self.clock))
+
+    def move_until(self, stop: Callable[[], bool], direction: int, release: bool = True) -> StepperMove:
+        '''
+        Queue a move that steps at the profile's start speed until stop() is true,
+        checking before every step. Used for homing against a switch.
+        '''
+        return self.__queue(StepperMove(None, direction, release, self.clock, stop))
+
+    def wait(self) -> None:
+        '''Block until every queued move is done'''
+        if self.__last_move is not None:
+            self.__last_move.wait()
+
+    def __queue(self, move: StepperMove) -> StepperMove:
+        self.__last_move = move
+        self.__moves.put(move)
+        return move
+
+    def __run(self) -> None:
+        self.__raise_priority()
+
+        while True:
+            move = self.__moves.get()
+            self.clock.sleep_until(move.queued_at)
+            try:
+                if move.stop is None:
+                    self.__step(move, move.steps, self.profile.intervals(move.steps))
+                else:
+                    self.__step_until(move)
+                if move.release:
+                    self.motor.release()
+                move.finish()
+            except Exception as e:
+                move.finish(e)
+
+    def __step(self, move: StepperMove, steps: int, intervals: list[float]) -> None:
+        if hasattr(self.motor, "run"):
+            move.steps_taken = self.motor.run(move.direction, intervals)
+            return
+
+        # deadlines are kept from the start of the move so timing errors don't build up
+        deadline = self.clock.now()
+        for i in range(steps):
+            self.clock.sleep_until(deadline)
+            self.motor.onestep(direction=move.direction, style=self.style)
+            move.steps_taken += 1
+
+            deadline += intervals[i]
+            # if stepping fell behind (a slow bus), start the schedule again from
+            # now rather than rushing the steps that were missed
+            now = self.clock.now()
+            if now > deadline + intervals[i]:
+                deadline = now
+
+    def __step_until(self, move: StepperMove) -> None:
+        interval = 1 / self.profile.start_speed if self.profile.kind != VelocityProfile.NONE else 0.0
+        deadline = self.clock.now()
+        while not move.stop():
+            self.clock.sleep_until(deadline)
+            self.motor.onestep(direction=move.direction, style=self.style)
+            move.steps_taken += 1
+            deadline = max(deadline + interval, self.clock.now() - interval)
+
+    @staticmethod
+    def __raise_priority() -> None:
+        '''Run this thread with real time priority when allowed to (e.g. as root)'''
+        try:
+            # pid 0 is the calling thread on linux
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        except (AttributeError, OSError):
+            pass
+
+
+if __name__ == "__main__":
+    class CountingMotor:
+        def __init__(self) -> None:
+            self.steps: list[tuple[int, float]] = []
+            self.released = 0
+        def onestep(self, direction: int, style: int) -> None:
+            self.steps.append((direction, perf_counter()))
+        def release(self) -> None:
+            self.released += 1
+
+    for kind in (VelocityProfile.TRAPEZOIDAL, VelocityProfile.S_CURVE):
+        profile = VelocityProfile(kind, 4000, 40000, 500)
+        intervals = profile.intervals(1000)
+        assert(intervals[0] == intervals[-1] == 1 / 500 and min(intervals) == 1 / 4000)
+        assert(intervals == sorted(intervals[:500], reverse=True) + sorted(intervals[500:]))
+
+    motor = CountingMotor()
+    axis = StepperAxis(motor, VelocityProfile(VelocityProfile.TRAPEZOIDAL, 4000, 40000, 500), style=0)
+    first = axis.move(300, direction=1, release=False)
+    axis.move(200, direction=2)
+    assert(not first.done())
+    axis.wait()
+    assert(first.wait() == 300 and len(motor.steps) == 500 and motor.released == 1)
+
+    # ramping takes longer than running at full speed, but not much
+    expected = sum(axis.profile.intervals(300)[:-1])
+    assert(expected * 0.95 < motor.steps[299][1] - motor.steps[0][1] < expected * 1.5)
+
+    count = iter(range(10))
+    assert(axis.move_until(lambda: next(count) == 5, direction=1).wait() == 5)
+
+    print("All tests passed!")
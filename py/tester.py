@@ -3,15 +3,65 @@
 ## Not nesseccarily the purely logical parts
 ## of the driver.
 ######################################
-import RPi.GPIO as GPIO
 from time import sleep
 from control import BraillePrinterDriver
+from planner import MOVE
 from math import pi
 
 TEST_MESSAGE = "Hello!\nThis is a test. !123"
 
+# shortest pulse tried when calibrating, in seconds
+CALIBRATION_MIN_ON_TIME = 0.005
+# how many times the range of pulse lengths is halved before settling on one
+CALIBRATION_ROUNDS = 6
+# how many dots in a row a pulse must punch to count as reliable
+CALIBRATION_REPEATS = 5
+# margin added to the measured pulse for the on times it suggests
+CALIBRATION_MARGIN = 1.25
+
 driver = BraillePrinterDriver()
 
+def calibrate_solenoid(solenoid: int) -> float:
+    '''
+    Find the shortest pulse that reliably punches a dot with one solenoid, by
+    bisecting between CALIBRATION_MIN_ON_TIME and its configured on time. Every
+    try punches onto the next cell, and whoever is running this says whether it
+    came out clean. Each solenoid starts on a new line. Paper must be loaded
+    and the head started.
+
+    Args:
+        solenoid (int): which solenoid to calibrate
+    Returns:
+        float: the shortest pulse that punched every dot, in seconds
+    '''
+    driver.new_line()
+    cells_used = 0
+    def punch(on_time: float) -> None:
+        nonlocal cells_used
+        if cells_used == driver.CHARS_PER_LINE:
+            driver.new_line()
+            cells_used = 0
+        driver.execute_plan([(MOVE, round(driver.SPACE_STEPS))])
+        driver.pulse_solenoid(solenoid, on_time)
+        cells_used += 1
+
+    too_short, long_enough = CALIBRATION_MIN_ON_TIME, driver.SOL_ON_TIMES[solenoid]
+    for _ in range(CALIBRATION_ROUNDS):
+        on_time = (too_short + long_enough) / 2
+        punch(on_time)
+        if input(f"Solenoid {solenoid}, {on_time * 1000:.1f} ms: did it punch a clean dot? (y/N) ").lower() == 'y':
+            long_enough = on_time
+        else:
+            too_short = on_time
+
+    # one good dot can be luck, so make sure it punches every time
+    while True:
+        for _ in range(CALIBRATION_REPEATS):
+            punch(long_enough)
+        if input(f"Solenoid {solenoid}, {long_enough * 1000:.1f} ms: were all {CALIBRATION_REPEATS} dots clean? (y/N) ").lower() == 'y':
+            return long_enough
+        long_enough *= CALIBRATION_MARGIN
+
 # if input("Test steppers? (y/N) ").lower() == 'y':
 #     n_steps = driver.__mm_to_steps(driver.PAPER_STEPPER_DIAMETER * 2 * pi, 10)
 #     print("Testing Paper Stepper (10 mm)")
@@ -36,14 +86,18 @@ driver = BraillePrinterDriver()
 if input("Test solenoids? (y/N) ").lower() == 'y':
     for i in range(3):
         print(f"Testing solenoid {i}")
-        driver.pwm_solenoids[i].start(driver.SOL_DUTY_CYCLE)
-        sleep(driver.SOL_PAUSE)
-        driver.pwm_solenoids[i].stop()
-        sleep(driver.SOL_PAUSE)
+        driver.pulse_solenoid(i, driver.SOL_ON_TIMES[i])
+
+if input("Calibrate solenoid pulses? \033[33mPAPER SHOULD BE LOADED AND BUTTON WORKING\033[0m (y/N) ").lower() == 'y':
+    driver.reset_print_head()
+    driver.start_print_head()
+    on_times = [calibrate_solenoid(i) for i in range(3)]
+    print("Measured on times:", [round(t, 4) for t in on_times])
+    print(f"Suggested for config.toml: SOL_ON_TIMES={[round(t * CALIBRATION_MARGIN, 4) for t in on_times]}")
 
 if input("Test button? (y/N) ").lower() == 'y':
     print("Waiting for button press")
-    while (GPIO.input(driver.BUTTON_PIN) == GPIO.HIGH):
+    while not driver.hardware.home_pressed():
         sleep(0.5)
     print("Button pressed")
 
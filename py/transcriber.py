@@ -1,17 +1,178 @@
 import tomllib
-from typing import Any
+from typing import Any, Callable
+from collections import OrderedDict
+from pathlib import Path
+import codecs
 import re
+import time
+import metrics
+import translation_tables
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 BrailleHalfChar = tuple[bool, bool, bool]
 BrailleArray = tuple[BrailleHalfChar, BrailleHalfChar]
 
+UNSUPPORTED_CELL = translation_tables.UNSUPPORTED_CELL
+
+# characters outside of Latin-1 are encoded as DEL, which has no braille cell,
+# so every character still lines up with exactly one byte
+codecs.register_error("braille_cell", lambda e: ("\x7f" * (e.end - e.start), e.end))
+
+class ContractionTrie:
+    '''
+    Prefix tree of contractions for longest-match lookups inside a word.
+
+    Every entry remembers where in a word it may be used, so one walk down the
+    tree finds the longest contraction that is allowed at a given position.
+    The cost of a lookup depends only on the length of the match, not on how
+    many contractions are in the tree.
+    '''
+
+    # where in a word a contraction may be used
+    ANYWHERE = "anywhere"
+    INITIAL  = "initial"  # must start the word
+    MEDIAL   = "medial"   # may neither start nor end the word
+    FINAL    = "final"    # must end the word
+
+    # key for the (replacement, position) stored on nodes that end an entry
+    __END = ""
+
+    def __init__(self, reverse: bool = False) -> None:
+        '''
+        Args:
+            reverse (bool): store keys backwards, for matching from the end of a word
+        '''
+        self.root: dict[str, Any] = {}
+        self.reverse = reverse
+
+    def insert(self, key: str, replacement: str, position: str = ANYWHERE) -> None:
+        '''Add a contraction. If the key is already present the first one added wins.'''
+        node = self.root
+        for c in (reversed(key) if self.reverse else key):
+            node = node.setdefault(c, {})
+        node.setdefault(self.__END, (replacement, position))
+
+    def longest_match(self, word: str, start: int, end: int) -> tuple[int, str] | None:
+        '''
+        Find the longest contraction in word[start:end] beginning at start, or
+        ending at end - 1 for a reversed tree.
+
+        Args:
+            word (str): the whole word, used to check where the contraction sits
+            start (int): first index of word that may be matched
+            end (int): one past the last index of word that may be matched
+        Returns:
+            tuple[int, str] | None: the length of the match and its replacement,
+            or None if nothing matches
+        '''
+        node = self.root
+        best = None
+        length = 0
+        n = len(word)
+
+        indices = range(end - 1, start - 1, -1) if self.reverse else range(start, end)
+        for i in indices:
+            node = node.get(word[i])
+            if node is None:
+                break
+            length += 1
+
+            if (entry := node.get(self.__END)) is not None:
+                replacement, position = entry
+                first, last = (i, end - 1) if self.reverse else (start, i)
+                if position == self.INITIAL and first != 0:
+                    continue
+                if position == self.MEDIAL and (first == 0 or last == n - 1):
+                    continue
+                if position == self.FINAL and last != n - 1:
+                    continue
+                best = (length, replacement)
+
+        return best
+
+
+class WordCache:
+    '''
+    Bounded least recently used cache of transliterated words.
+
+    Keeps count of hits, misses, and evictions so the size can be tuned
+    to the memory available.
+    '''
+
+    def __init__(self, max_size: int, transliterate: Callable[[str], str]) -> None:
+        '''
+        Args:
+            max_size (int): how many words to remember before evicting the least recently used
+            transliterate (Callable[[str], str]): computes a word's transliteration on a miss
+        '''
+        self.max_size = max_size
+        self.transliterate = transliterate
+        self.__entries: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, word: str) -> str:
+        '''Return the transliteration of word, computing and remembering it if need be'''
+        entries = self.__entries
+        if (transliteration := entries.get(word)) is not None:
+            entries.move_to_end(word)
+            self.hits += 1
+            return transliteration
+
+        self.misses += 1
+        transliteration = entries[word] = self.transliterate(word)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return transliteration
+
+    def clear(self) -> None:
+        '''Forget every cached word. The counters are kept.'''
+        self.__entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        '''Counters for sizing the cache, hit_rate is between 0.0 and 1.0'''
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
 class BrailleTranscriber:
     '''Singleton for transcribing ASCII to Unicode Braille and array representation Braille'''
 
-    symbol_pattern = re.compile(r"({-;{{[^}]+}}-;})")
+    BRAILLE_CAPITAL_SIGN = ','
+
+    # special word collections that may also be contracted inside a longer word
+    # and where in the word they may be used, every other collection is whole word only
+    PART_WORD_COLLECTIONS: dict[str, str] = {
+        "strong-contractions":      ContractionTrie.ANYWHERE,
+        "strong-groupsigns":        ContractionTrie.ANYWHERE,
+        "lower-groupsigns":         ContractionTrie.ANYWHERE,
+        "initial-lower-groupsigns": ContractionTrie.INITIAL,
+        "medial-lower-groupsigns":  ContractionTrie.MEDIAL,
+    }
+
+    CONFIG_PATH = Path(__file__).resolve().parent / "config.toml"
+
+    BRAILLE_JUMP = translation_tables.BRAILLE_JUMP
+    CELL_TABLE = translation_tables.build_cell_table(BRAILLE_JUMP)
+
+    # loaded lazily on the first transliteration, see reload_tables()
+    word_table: dict[str, str] | None = None
 
     @staticmethod
-    def __toml_open_and_load(file_path: str) -> dict[str, Any]:
+    def __toml_open_and_load(file_path: str | Path) -> dict[str, Any]:
         with open(file_path, "rb") as f:
             return tomllib.load(f)
         
@@ -24,16 +185,30 @@ class BrailleTranscriber:
         cls.__instance = super(BrailleTranscriber, cls).__new__(cls)
 
         # set up class variables
-        cls.BRAILLE_JUMP = "⠀⠮⠐⠼⠫⠩⠯⠄⠷⠾⠡⠬⠠⠤⠨⠌⠴⠂⠆⠒⠲⠢⠖⠶⠦⠔⠱⠰⠣⠿⠜⠹⠈⠁⠃⠉⠙⠑⠋⠛⠓⠊⠚⠅⠇⠍⠝⠕⠏⠟⠗⠎⠞⠥⠧⠺⠭⠽⠵⠪⠳⠻⠘⠸"
-        cls.BRAILLE_SPECIAL_WORDS   = cls.__toml_open_and_load("../brailleTransliterations/special-words.toml")
-        cls.BRAILLE_SPECIAL_SYMBOLS = cls.__toml_open_and_load("../brailleTransliterations/special-symbols.toml")
-        cls.BRAILLE_SPECIAL_SUFFIXES = cls.__toml_open_and_load("../brailleTransliterations/special-suffixes.toml")
+        config = cls.__toml_open_and_load(cls.CONFIG_PATH).get("TRANSCRIBER", {})
+        cache_size = config.get("WORD_CACHE_SIZE", 0)
+        cls.word_cache = WordCache(cache_size, cls.__instance.__transliterate_words) if cache_size > 0 else None
 
         return cls.__instance
     
     def __init__(self):
         return
 
+    @classmethod
+    def reload_tables(cls) -> None:
+        '''
+        (Re)load the translation tables, from the precompiled artifact if it is
+        up to date and from the TOML files otherwise. Any cached words are
+        dropped since they may no longer be correct.
+        '''
+        tables = translation_tables.load_tables()
+        cls.BRAILLE_JUMP             = tables["BRAILLE_JUMP"]
+        cls.BRAILLE_SPECIAL_WORDS    = tables["BRAILLE_SPECIAL_WORDS"]
+        cls.BRAILLE_SPECIAL_SYMBOLS  = tables["BRAILLE_SPECIAL_SYMBOLS"]
+        cls.BRAILLE_SPECIAL_SUFFIXES = tables["BRAILLE_SPECIAL_SUFFIXES"]
+        cls.CELL_TABLE = translation_tables.build_cell_table(cls.BRAILLE_JUMP)
+        cls.__compile_tables()
+
     @staticmethod
     def ascii2braille(c: str) -> str:
         '''
@@ -87,73 +262,104 @@ class BrailleTranscriber:
                 (bool(braille_offset & 1 << 3), bool(braille_offset & 1 << 4), bool(braille_offset & 1 << 5))
             )
 
-    def transliterate_string(self, s: str) -> str:
+    @staticmethod
+    def encode_cells(s: str, as_numpy: bool = False) -> tuple[bytes, list[int]]:
         '''
-        Take a string composed of ASCII characters (0x20-0x5F) and apply Braille 
-        contractions, shorthands, and punctuation.
+        Encode a whole (transliterated) string as braille cells in one go.
 
-        The string should NOT have new lines present.
+        Each character becomes one byte holding its six dots, in the same bit
+        order as braille2array(): bits 0-2 are the left half of the cell and
+        bits 3-5 the right half. Characters without a braille representation
+        are encoded as UNSUPPORTED_CELL and reported by position.
 
-        Args:
-            s (string): The string to be transliterated, devoid of new lines
-        Returns:
-            string, the transliterated string, still in ASCII
+        Inputs:
+            s: str, the string to encode
+            as_numpy: bool, return a numpy uint8 array instead of bytes
+        Outputs:
+            tuple[bytes, list[int]]: one cell per character, and the indices of
+            unsupported characters
         '''
+        cells = s.encode("latin-1", "braille_cell").translate(BrailleTranscriber.CELL_TABLE)
 
-        # do symbol transliteration first to not mess with future symbols added
-        # in shortforms, numbers, etc.
-        # this is just a placeholder replacement, the actual symbols are added later
-        # to not interfere with the braille special words
-        symbol_level_transliteration, symbol_placeholders = self.__transliterate_symbols(s)
+        unsupported: list[int] = []
+        i = cells.find(UNSUPPORTED_CELL)
+        while i != -1:
+            unsupported.append(i)
+            i = cells.find(UNSUPPORTED_CELL, i + 1)
 
-        # handle word level transliterations
-        # a "chunk" is a collection of words and symbols
-        # the words should be transliterated, but not symbols
-        chunks: list[str] = symbol_level_transliteration.split(" ")
-        transliterated_words: list[str] = []
+        if as_numpy:
+            if numpy is None:
+                raise ImportError("encode_cells(): as_numpy requires numpy to be installed")
+            return numpy.frombuffer(cells, dtype=numpy.uint8), unsupported
 
-        for chunk in chunks:
-            # parse out the actual word, not the symbols
-            word_and_syms = re.split(self.symbol_pattern, chunk)
-            
-            
-            # transliterate the chunk
-            word_transliteration = [self.__transliterate_words(word) for word in word_and_syms]
+        return cells, unsupported
 
-            # rejoin the chunk and append it to the final output
-            transliterated_words.append("".join(word_transliteration))
+    @staticmethod
+    def cell_halves(cell: int) -> tuple[int, int]:
+        '''
+        Split a cell from encode_cells() into the solenoid masks of its halves.
+        Bit i of a mask is solenoid i.
+
+        Inputs:
+            cell: int, the packed cell
+        Outputs:
+            tuple[int, int]: the left half and the right half
+        '''
+        return cell & 0b111, cell >> 3
 
-        transliterated_string = " ".join(transliterated_words) # add spaces between processed words
+    def transliterate_string(self, s: str) -> str:
+        '''
+        Take a string composed of ASCII characters (0x20-0x5F) and apply Braille 
+        contractions, shorthands, and punctuation.
 
-        # finally, replace the symbol placeholders with the actual symbols
-        for symbol_placeholder, symbol in symbol_placeholders.items():
-            # replace the placeholder with the actual symbol
-            transliterated_string = re.sub(re.escape(symbol_placeholder), symbol, transliterated_string)
+        The string should NOT have new lines present.
 
-        return transliterated_string
+        This is a single left to right pass: the string is split into tokens
+        (spaces, special symbols, and runs of everything else) by one compiled
+        pattern, and each run is broken into words at capital letters before
+        being handed to the word level transliteration.
 
-    @staticmethod
-    def __replace_suffixes(suffixes: dict, word: str) -> str:
-        for suffix in suffixes.keys():
-            if word.endswith(suffix):
-                return word.removesuffix(suffix) + suffixes[suffix]
-        return word
-    
-    @staticmethod
-    def __replace_prefix(prefixes: dict, word: str) -> str:
-        for prefix in prefixes.keys():
-            if word.startswith(prefix):
-                return word.removeprefix(prefix) + prefixes[prefix]
-        return word
+        Args:
+            s (string): The string to be transliterated, devoid of new lines
+        Returns:
+            string, the transliterated string, still in ASCII
+        '''
+        if self.word_table is None:
+            self.reload_tables()
+
+        started = time.perf_counter() if metrics.ENABLED else None
+        symbols = self.BRAILLE_SPECIAL_SYMBOLS
+        transliterate_word = self.__transliterate_words if self.word_cache is None else self.word_cache.lookup
+        transliterated: list[str] = []
+
+        for token in self.token_pattern.findall(s):
+            if token == " ":
+                transliterated.append(token)
+            elif token in symbols:
+                transliterated.append(symbols[token])
+            elif token.islower():
+                # fast path, no capitals means the whole token is one word
+                transliterated.append(transliterate_word(token))
+            else:
+                # every capital starts a new word and is marked with a comma
+                word: list[str] = []
+                for c in token:
+                    if c.isupper():
+                        transliterated.append(transliterate_word("".join(word)))
+                        transliterated.append(self.BRAILLE_CAPITAL_SIGN)
+                        word.clear()
+                    word.append(c.lower())
+                transliterated.append(transliterate_word("".join(word)))
+
+        if started is not None:
+            metrics.observe("transcriber", "transliterate", time.perf_counter() - started)
+            metrics.count("transcriber", "characters", len(s))
+        return "".join(transliterated)
     
     def __transliterate_words(self, word: str) -> str:
         '''Given a word return the transliterated version of the word
         if it exists, otherwise return the word itself
         '''
-        if re.match(self.symbol_pattern, word) is not None:
-            # "word" is a symbol, so skip
-            return word
-
         # handle numbers
         if word.isnumeric():
             # turn numbers into cooresponding braille alphabetic character
@@ -169,61 +375,59 @@ class BrailleTranscriber:
                     
             return ('#' + "".join(numbers_as_letters)) # prefix with number prefix '#'
 
-        # handle suffixes
-        for collection in self.BRAILLE_SPECIAL_SUFFIXES.values():
-            if (suffix_word := self.__replace_suffixes(collection, word)) != word:
-                # if found a suffix, finish processing that word
-                return suffix_word
+        # handle whole special words
+        if (special_word := self.word_table.get(word)) is not None:
+            return special_word
+
+        # handle suffixes, the longest matching suffix wins
+        stem_end = len(word)
+        suffix = ""
+        if (match := self.suffix_trie.longest_match(word, 0, stem_end)) is not None:
+            suffix_length, suffix = match
+            stem_end -= suffix_length
+
+        # handle contractions inside the rest of the word, longest match first
+        contracted: list[str] = []
+        i = 0
+        while i < stem_end:
+            if (match := self.contraction_trie.longest_match(word, i, stem_end)) is not None:
+                match_length, replacement = match
+                contracted.append(replacement)
+                i += match_length
+            else:
+                contracted.append(word[i])
+                i += 1
 
-        # handle other special words
-        # collection is an inner dictionary
-        for collection in self.BRAILLE_SPECIAL_WORDS.values():
-            if word in collection:
-                return collection[word]
+        contracted.append(suffix)
+        return "".join(contracted)
 
-        # didn't encounter any special collection words
-        # if nothing else, just return the word 
-        return word
+    @classmethod
+    def __compile_tables(cls) -> None:
+        '''
+        Flatten the TOML collections into the lookup tables used while transliterating.
+        Collections are searched in file order, so the first collection to define
+        a word, suffix, or contraction takes precedence.
+        '''
+        if cls.word_cache is not None:
+            cls.word_cache.clear()
 
+        cls.suffix_trie = ContractionTrie(reverse=True)
+        for collection in cls.BRAILLE_SPECIAL_SUFFIXES.values():
+            for suffix, replacement in collection.items():
+                cls.suffix_trie.insert(suffix, replacement, ContractionTrie.FINAL)
 
-    def __transliterate_symbols(self, s: str) -> tuple[str, dict[str,str]]:
-        '''Individual symbol transliteration, not word level
-        
-        Returns
-            tuple[str, dict[str,str]]: the transliterated string and a dictionary of temporary symbol replacements
-        '''
-        all_chars: list[str] = []
-        placeholders: dict[str, str] = {}
-
-        for c in s:
-            if c in self.BRAILLE_SPECIAL_SYMBOLS:
-                placeholder = self.wrap_symbol(c)
-                new_c = self.BRAILLE_SPECIAL_SYMBOLS[c]
-
-                # add a new placeholder
-                # may overwrite an existing one, but that's okay
-                # since the same symbol will be replaced with the same placeholder
-                placeholders[placeholder] = new_c
-                
-                # add the placeholder to the list
-                all_chars.append(placeholder)
+        cls.word_table: dict[str, str] = {}
+        cls.contraction_trie = ContractionTrie()
+        for name, collection in cls.BRAILLE_SPECIAL_WORDS.items():
+            position = cls.PART_WORD_COLLECTIONS.get(name)
+            for word, replacement in collection.items():
+                cls.word_table.setdefault(word, replacement)
+                if position is not None:
+                    cls.contraction_trie.insert(word, replacement, position)
 
-            else:
-                # character isn't a special symbol
-                # check for uppercase case
-                if c.isupper():
-                    placeholder = self.wrap_symbol('upper')
-                    placeholders[placeholder] = ',' # add comma for uppercase
-                    all_chars.append(placeholder) # add comma for uppercase
-                new_c = c
-                all_chars.append(new_c.lower())
-
-        return "".join(all_chars), placeholders
-    
-    @staticmethod
-    def wrap_symbol(s: str) -> str:
-        '''Simple helper. Given a string, wrap it in the symbols markings'''
-        return "{-;{{" + s + "}}-;}"
+        # a token is a space, a single special symbol, or a run of anything else
+        symbol_chars = "".join(re.escape(c) for c in cls.BRAILLE_SPECIAL_SYMBOLS if len(c) == 1)
+        cls.token_pattern = re.compile(f"[ {symbol_chars}]|[^ {symbol_chars}]+")
 
 
 def assert_equal_strings_verbose(s0: str, s1: str) -> None:
@@ -241,6 +445,13 @@ if __name__ == "__main__":
     assert_equal_strings_verbose(transcriber.braille2array('⠢'), ((0,1,0),(0,0,1)))
     assert_equal_strings_verbose(transcriber.braille2array('⠯'), ((1,1,1),(1,0,1)))
 
+    cells, unsupported = transcriber.encode_cells("a5&~\u2603z")
+    assert(unsupported == [3, 4])
+    for c, cell in zip("a5&z", cells[:3] + cells[5:]):
+        assert(transcriber.cell_halves(cell) == tuple(
+            sum(dot << i for i, dot in enumerate(half)) for half in transcriber.braille2array(transcriber.ascii2braille(c))
+        ))
+
     assert_equal_strings_verbose(transcriber.transliterate_string("but"), "b")
     assert_equal_strings_verbose(transcriber.transliterate_string("about"), "ab")
     assert_equal_strings_verbose(transcriber.transliterate_string("themselves"), "!mvs")
@@ -248,9 +459,29 @@ if __name__ == "__main__":
     assert_equal_strings_verbose(transcriber.transliterate_string("190"), "#aij")
     assert_equal_strings_verbose(transcriber.transliterate_string("and"), "&")
     assert_equal_strings_verbose(transcriber.transliterate_string("his"), "8")
+    assert_equal_strings_verbose(transcriber.transliterate_string("question"), '"q')
+
+    # contractions inside words
+    assert_equal_strings_verbose(transcriber.transliterate_string("other"), "o!r")
+    assert_equal_strings_verbose(transcriber.transliterate_string("outside"), "\\tside")
+    assert_equal_strings_verbose(transcriber.transliterate_string("mention"), "m5;n")
+    assert_equal_strings_verbose(transcriber.transliterate_string("each"), "ea*")
 
     assert_equal_strings_verbose(transcriber.transliterate_string("1 themselves"), "#a !mvs")
     assert_equal_strings_verbose(transcriber.transliterate_string("Hello, world!"), ",hello1 _w6")
+    assert_equal_strings_verbose(transcriber.transliterate_string("The (and) {and}"), ',! "<&"> _<&_>')
+
+    # the word cache must not change any output
+    uncached_endpoem = [transcriber.transliterate_string(line) for line in open("endpoem.txt")]
+    word_cache = BrailleTranscriber.word_cache
+    BrailleTranscriber.word_cache = WordCache(8, transcriber._BrailleTranscriber__transliterate_words)
+    for line, uncached in zip(open("endpoem.txt"), uncached_endpoem):
+        assert_equal_strings_verbose(uncached, transcriber.transliterate_string(line))
+    stats = transcriber.word_cache.stats()
+    assert(stats["size"] == 8 and stats["hits"] > 0 and stats["evictions"] == stats["misses"] - 8)
+    transcriber.reload_tables()
+    assert(transcriber.word_cache.stats()["size"] == 0)
+    BrailleTranscriber.word_cache = word_cache
 
     print("\n\nThe follwing asserations being right or wrong depends on exact braille specification desired.\n" \
     "Output represents lines that don't match. " \
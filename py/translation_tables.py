@@ -0,0 +1,146 @@
+############################
+## Loads the braille translation tables, either from a precompiled
+## artifact or straight from the TOML files they are written in.
+##
+## Build (or rebuild) the artifact with:
+##     python3 translation_tables.py
+############################
+import hashlib
+import marshal
+import mmap
+import struct
+import tomllib
+from pathlib import Path
+from typing import Any
+
+# ASCII 0x20 (SPACE) to 0x5F (underscore), in order, as unicode braille
+BRAILLE_JUMP = "⠀⠮⠐⠼⠫⠩⠯⠄⠷⠾⠡⠬⠠⠤⠨⠌⠴⠂⠆⠒⠲⠢⠖⠶⠦⠔⠱⠰⠣⠿⠜⠹⠈⠁⠃⠉⠙⠑⠋⠛⠓⠊⠚⠅⠇⠍⠝⠕⠏⠟⠗⠎⠞⠥⠧⠺⠭⠽⠵⠪⠳⠻⠘⠸"
+
+# cell value in a packed cell buffer for a character with no braille representation
+UNSUPPORTED_CELL = 0xFF
+
+# paths are relative to this file so the daemon can be started from anywhere
+TABLES_DIR = Path(__file__).resolve().parent.parent / "brailleTransliterations"
+ARTIFACT_PATH = Path(__file__).resolve().parent / "translation-tables.bin"
+
+# table name => TOML file it is written in
+TABLE_FILES = {
+    "BRAILLE_SPECIAL_WORDS":    "special-words.toml",
+    "BRAILLE_SPECIAL_SYMBOLS":  "special-symbols.toml",
+    "BRAILLE_SPECIAL_SUFFIXES": "special-suffixes.toml",
+}
+
+# bump whenever the layout of the artifact changes
+ARTIFACT_VERSION = 1
+ARTIFACT_MAGIC = b"T2TT"
+
+# magic, artifact version, marshal version, sha256 of the sources
+ARTIFACT_HEADER = struct.Struct("<4sHH32s")
+
+def sources_digest() -> bytes:
+    '''
+    Fingerprint of everything the artifact is built from. If any TOML file or
+    the jump table changes, the digest changes and the artifact is stale.
+
+    Returns:
+        bytes: sha256 digest of the sources
+    '''
+    digest = hashlib.sha256(BRAILLE_JUMP.encode())
+    for file_name in TABLE_FILES.values():
+        digest.update((TABLES_DIR / file_name).read_bytes())
+    return digest.digest()
+
+def build_cell_table(jump: str) -> bytes:
+    '''
+    Build a 256 entry lookup table from a Latin-1 character code to its braille
+    cell, for use with bytes.translate(). A cell holds the six dots as bits,
+    the same bits as the offset from 0x2800 of the unicode braille character.
+
+    Args:
+        jump (str): the jump table, like BRAILLE_JUMP
+    Returns:
+        bytes: the cell for every character code, UNSUPPORTED_CELL if there is none
+    '''
+    table = bytearray([UNSUPPORTED_CELL]) * 256
+    for code in range(256):
+        # only uppercase characters are in the jump table
+        upper = chr(code).upper()
+        if len(upper) == 1 and 0x0 <= (ascii_offset := ord(upper) - 0x20) <= 0x3F:
+            table[code] = ord(jump[ascii_offset]) - 0x2800
+    return bytes(table)
+
+def load_toml_tables() -> dict[str, Any]:
+    '''Parse every table from its TOML file'''
+    tables: dict[str, Any] = {"BRAILLE_JUMP": BRAILLE_JUMP}
+    for name, file_name in TABLE_FILES.items():
+        with open(TABLES_DIR / file_name, "rb") as f:
+            tables[name] = tomllib.load(f)
+    return tables
+
+def build_artifact(path: Path = ARTIFACT_PATH) -> None:
+    '''
+    Compile the TOML tables and the jump table into one binary artifact.
+
+    Args:
+        path (Path): where to write the artifact
+    Returns:
+        None
+    '''
+    header = ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, marshal.version, sources_digest())
+    payload = marshal.dumps(load_toml_tables())
+
+    # write then rename so a reader never sees half an artifact
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header + payload)
+    tmp_path.replace(path)
+
+def load_artifact(path: Path = ARTIFACT_PATH) -> dict[str, Any] | None:
+    '''
+    Memory map the artifact and load the tables from it.
+
+    Args:
+        path (Path): where the artifact lives
+    Returns:
+        dict[str, Any] | None: the tables, or None if the artifact is missing,
+        unreadable, built by another version, or older than the TOML files
+    '''
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < ARTIFACT_HEADER.size:
+                return None
+            magic, version, marshal_version, digest = ARTIFACT_HEADER.unpack_from(mm)
+            if (magic, version, marshal_version) != (ARTIFACT_MAGIC, ARTIFACT_VERSION, marshal.version):
+                return None
+
+            # the sources may not be deployed next to the artifact, in which case trust it
+            try:
+                if digest != sources_digest():
+                    return None
+            except FileNotFoundError:
+                pass
+
+            with memoryview(mm) as view:
+                return marshal.loads(view[ARTIFACT_HEADER.size:])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+
+def load_tables() -> dict[str, Any]:
+    '''
+    Load the translation tables, preferring the artifact and falling back
+    to the TOML files if it is missing or stale.
+
+    Returns:
+        dict[str, Any]: table name => table
+    '''
+    if (tables := load_artifact()) is not None:
+        return tables
+
+    print(f"{ARTIFACT_PATH} missing or stale, loading tables from {TABLES_DIR}")
+    return load_toml_tables()
+
+
+if __name__ == "__main__":
+    build_artifact()
+    assert(load_artifact() == load_toml_tables())
+    print(f"Wrote {ARTIFACT_PATH}")